@@ -0,0 +1,67 @@
+"""
+Measures how long it takes to import lollylib modules, each in a fresh python interpreter.
+Usage:
+    python benchmarks/import_time.py [--runs N] [--cold] [module ...]
+By default bytecode caches are kept in a temporary directory and warmed up first, so the numbers show what
+an installed package costs on every invocation; --cold compiles the modules on each run instead.
+Modules imported on behalf of lollylib are listed for the last module, which helps to spot heavy
+dependencies that should be imported lazily.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_MODULES = ['lollylib', 'lollylib.lolly_helpers', 'lollylib.lolly_wiz']
+
+
+def import_times(module, env):
+    """
+    Imports 'module' with -X importtime.
+    :return: list of tuples (cumulative microseconds, module name) for every imported module
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                               stderr=subprocess.PIPE, env=env, check=True)
+    times = []
+    for line in completed.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        times.append((int(fields[1]), fields[2].strip()))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lollylib import time benchmark')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--cold', action='store_true', help="don't use bytecode cache")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR
+    with tempfile.TemporaryDirectory() as pycache_dir:
+        if args.cold:
+            env['PYTHONDONTWRITEBYTECODE'] = '1'
+        else:
+            env.pop('PYTHONDONTWRITEBYTECODE', None)
+            env['PYTHONPYCACHEPREFIX'] = pycache_dir
+            for module in args.modules:
+                import_times(module, env)  # warm up bytecode cache
+        for module in args.modules:
+            totals = sorted(import_times(module, env)[-1][0] for _ in range(args.runs))
+            print('%-28s median %7.2f ms   min %7.2f ms' % (module, totals[len(totals) // 2] / 1000.0,
+                                                             totals[0] / 1000.0))
+        baseline = set(name for t, name in import_times('os', env))
+        imported = []
+        for t, name in import_times(args.modules[-1], env):
+            if name not in baseline and name not in imported:
+                imported.append(name)
+        print('\nmodules imported by ' + args.modules[-1] + ':')
+        print('    ' + ', '.join(imported))
+
+
+if __name__ == '__main__':
+    main()
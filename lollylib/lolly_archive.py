@@ -0,0 +1,366 @@
+"""
+Tar archives compressed with gzip, xz, bzip2 or zstd (zstd requires Python 3.14 'compression.zstd').
+Archives are compressed in independent blocks by a pool of threads (like pigz does): each block becomes
+a separate gzip member or xz/bzip2 stream or zstd frame, which standard tools and python's gzip, lzma,
+bz2 and tarfile modules read as a single stream.
+Extraction is streaming: the archive is read once, from start to end, and only selected members are written.
+"""
+import os
+import ntpath
+import collections
+import gzip
+import bz2
+import lzma
+import tarfile
+import zlib
+from concurrent import futures
+from . import lolly_helpers
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+_EXTENSIONS = [('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.xz', 'xz'), ('.txz', 'xz'),
+               ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.tar.zst', 'zst'), ('.tzst', 'zst'), ('.tar', '')]
+_MAGIC = [(b'\x1f\x8b', 'gz'), (b'\xfd7zXZ\x00', 'xz'), (b'BZh', 'bz2'), (b'\x28\xb5\x2f\xfd', 'zst')]
+
+
+def _zstd_module():
+    try:
+        from compression import zstd
+    except ImportError:
+        return None
+    return zstd
+
+
+def supported_compressions():
+    """
+    Compression names that may be used on this python installation.
+    :return: list of strings, empty string means plain tar
+    """
+    result = ['', 'gz', 'xz', 'bz2']
+    if _zstd_module() is not None:
+        result.append('zst')
+    return result
+
+
+def compression_from_filename(filename):
+    """
+    Guesses compression from archive file extension, e.g. 'gz' for 'a.tar.gz' or '' for 'a.tar'.
+    :param filename: string
+    :return: compression name or None if extension is unknown
+    """
+    lower = filename.lower()
+    for ext, compression in _EXTENSIONS:
+        if lower.endswith(ext):
+            return compression
+    return None
+
+
+def _block_compressor(compression, level):
+    if compression == 'gz':
+        level = 6 if level is None else level
+
+        def compress(block):
+            # wbits=31 writes a complete gzip member with zero mtime, so output is reproducible
+            c = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return c.compress(block) + c.flush()
+        return compress
+    if compression == 'xz':
+        preset = 6 if level is None else level
+        return lambda block: lzma.compress(block, format=lzma.FORMAT_XZ, preset=preset)
+    if compression == 'bz2':
+        level = 9 if level is None else level
+        return lambda block: bz2.compress(block, level)
+    if compression == 'zst':
+        zstd = _zstd_module()
+        if zstd is None:
+            raise ValueError("zstd compression is not supported by this python version")
+        if level is None:
+            return zstd.compress
+        return lambda block: zstd.compress(block, level)
+    if compression == '':
+        return bytes
+    raise ValueError("unknown compression '" + str(compression) + "'")
+
+
+def _open_decompressed(fileobj):
+    """ Detects compression by magic bytes and wraps 'fileobj' into a streaming decompressor. """
+    head = fileobj.peek(6)[:6] if hasattr(fileobj, 'peek') else b''
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            if compression == 'gz':
+                return gzip.GzipFile(fileobj=fileobj, mode='rb')
+            if compression == 'xz':
+                return lzma.LZMAFile(fileobj, mode='rb')
+            if compression == 'bz2':
+                return bz2.BZ2File(fileobj, mode='rb')
+            zstd = _zstd_module()
+            if zstd is None:
+                raise ValueError("zstd compression is not supported by this python version")
+            return zstd.ZstdFile(fileobj, mode='rb')
+    return fileobj
+
+
+class ParallelCompressedWriter:
+    """
+    Write-only file-like object that splits written data into blocks, compresses the blocks in a thread pool
+    and writes them to 'fileobj' in the original order. zlib, lzma and bz2 release the GIL while compressing,
+    so compression scales with the number of threads. The number of blocks in flight is bounded.
+    """
+    def __init__(self, fileobj, compression='gz', level=None, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        :param fileobj: binary file-like object opened for writing
+        :param compression: 'gz', 'xz', 'bz2', 'zst' or '' (no compression)
+        :param level: compression level or preset, None means the default level of the compressor
+        :param threads: number of compression threads, defaults to the number of CPUs
+        :param block_size: size of uncompressed block in bytes
+        """
+        self._compress = _block_compressor(compression, level)
+        self._fileobj = fileobj
+        self.block_size = max(1, block_size)
+        threads = threads or os.cpu_count() or 1
+        self._executor = futures.ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = threads * 2
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._blocks_total = 0
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Compresses remaining data and waits until all blocks are written. 'fileobj' is not closed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer or not self._blocks_total:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_first_pending()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(self._compress, block))
+        self._blocks_total += 1
+        while len(self._pending) > self._max_pending:
+            self._write_first_pending()
+
+    def _write_first_pending(self):
+        data = self._pending.popleft().result()
+        self._fileobj.write(data)
+        self.bytes_out += len(data)
+
+
+def create_archive(source, dest_arch_name, compression=None, level=None, threads=None,
+                   block_size=DEFAULT_BLOCK_SIZE, arcname=None, progress=None):
+    """
+    Creates tar archive of a file or directory tree compressed in parallel blocks (do not raise exceptions).
+    The archive is written to a temporary file that replaces 'dest_arch_name' only when complete.
+    :param source: file or directory
+    :param dest_arch_name: archive file name
+    :param compression: 'gz', 'xz', 'bz2', 'zst', '' for plain tar or None to guess it from 'dest_arch_name'
+    :param level: compression level, None for default
+    :param threads: number of compression threads, defaults to the number of CPUs
+    :param block_size: size of independently compressed block in bytes
+    :param arcname: name of 'source' inside the archive, defaults to its base name; absolute names and names
+                    with '..' components are rejected
+    :param progress: optional callable, called with dict {'name': member name, 'bytes_in': uncompressed bytes so far}
+    :return: Dict - 'members': number of archived members;
+                    'bytes_in': size of uncompressed tar stream;
+                    'bytes_out': size of the archive;
+                    'error': empty string if success or error message otherwise;
+    """
+    result = {'members': 0, 'bytes_in': 0, 'bytes_out': 0, 'error': ''}
+    if not lolly_helpers.get_filesystem_item_type(source)['exists']:
+        result['error'] = 'source does not exist'
+        return result
+    if compression is None:
+        compression = compression_from_filename(dest_arch_name)
+        if compression is None:
+            compression = 'gz'
+    if arcname is None:
+        arcname = lolly_helpers.path_base_and_leaf(source)['leaf']
+    normalized = arcname.replace('\\', '/')
+    if ntpath.isabs(arcname) or ntpath.splitdrive(arcname)[0] or '..' in normalized.split('/'):
+        result['error'] = "'" + arcname + "' is not a valid name inside the archive"
+        return result
+    tmp_name = dest_arch_name + '.part'
+    try:
+        with open(tmp_name, 'wb') as f:
+            with ParallelCompressedWriter(f, compression, level, threads, block_size) as writer:
+                with tarfile.open(fileobj=writer, mode='w|') as tar:
+                    def count_member(tarinfo):
+                        result['members'] += 1
+                        if progress is not None:
+                            progress({'name': tarinfo.name, 'bytes_in': writer.bytes_in})
+                        return tarinfo
+                    tar.add(source, arcname=arcname, filter=count_member)
+            result['bytes_in'] = writer.bytes_in
+            result['bytes_out'] = writer.bytes_out
+        os.replace(tmp_name, dest_arch_name)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        lolly_helpers.silent_remove_file(tmp_name)
+        result['error'] = str(e)
+    return result
+
+
+def _is_within(base, path):
+    base = os.path.realpath(base)
+    path = os.path.realpath(path)
+    return path == base or path.startswith(base + os.sep)
+
+
+def is_safe_member(member, dest_dir):
+    """
+    Checks that archive member can be extracted without writing outside of 'dest_dir':
+    absolute names, '..' components, links pointing outside and device files are not safe.
+    :param member: tarfile.TarInfo
+    :param dest_dir: extraction directory
+    :return: True or False
+    """
+    name = member.name.replace('\\', '/')
+    if name.startswith('/') or os.path.isabs(name) or '..' in name.split('/'):
+        return False
+    if member.isdev():
+        return False
+    target = os.path.join(dest_dir, name)
+    if not _is_within(dest_dir, target):
+        return False
+    if member.issym():
+        link_target = os.path.join(os.path.dirname(target), member.linkname)
+        if os.path.isabs(member.linkname) or not _is_within(dest_dir, link_target):
+            return False
+    if member.islnk():
+        if os.path.isabs(member.linkname) or not _is_within(dest_dir, os.path.join(dest_dir, member.linkname)):
+            return False
+    return True
+
+
+def _member_selector(members):
+    if members is None:
+        return lambda name: True
+    if callable(members):
+        return members
+    names = set(m.rstrip('/') for m in members)
+
+    def select(name):
+        name = name.rstrip('/')
+        if name in names:
+            return True
+        # a selected directory selects everything inside it
+        parts = name.split('/')
+        for n in range(1, len(parts)):
+            if '/'.join(parts[:n]) in names:
+                return True
+        return False
+    return select
+
+
+def _is_up_to_date(member, target):
+    try:
+        st = os.lstat(target)
+    except OSError:
+        return False
+    if member.isdir():
+        return os.path.isdir(target)
+    return member.isfile() and st.st_size == member.size and int(st.st_mtime) == int(member.mtime)
+
+
+def _is_extractable(member, dest_dir, data_filter):
+    if data_filter is None:
+        return is_safe_member(member, dest_dir)
+    try:
+        data_filter(member, dest_dir)
+    except tarfile.FilterError:
+        return False
+    return True
+
+
+def extract_archive(arch_file, dest_dir, members=None, skip_existing=True, progress=None):
+    """
+    Extracts tar archive (plain or compressed with any supported compression) in one streaming pass
+    (do not raise exceptions). Members that would be written outside of 'dest_dir' are rejected.
+    :param arch_file: archive file name
+    :param dest_dir: destination directory, created if not exists
+    :param members: None to extract everything, list of member names (a directory name selects its contents)
+                    or callable that receives member name and returns True if the member must be extracted
+    :param skip_existing: if True, regular files that already exist with the same size and mtime are not rewritten
+    :param progress: optional callable, called with dict {'name': member name, 'status': 'extracted', 'skipped'
+                     or 'rejected'}
+    :return: Dict - 'extracted': list of extracted member names;
+                    'skipped': list of member names that were already up to date;
+                    'rejected': list of unsafe member names;
+                    'bytes': total size of extracted files;
+                    'error': empty string if success or error message otherwise;
+    """
+    result = {'extracted': [], 'skipped': [], 'rejected': [], 'bytes': 0, 'error': ''}
+    if not lolly_helpers.file_exists(arch_file):
+        result['error'] = 'archive does not exist'
+        return result
+    create_result = lolly_helpers.silent_create_path(dest_dir)
+    if create_result['error']:
+        result['error'] = create_result['error']
+        return result
+    select = _member_selector(members)
+    # a list of plain file names allows to stop reading the archive when all of them are found
+    remaining = None
+    if members is not None and not callable(members):
+        remaining = set(m.rstrip('/') for m in members)
+    # the 'data' extraction filter of Python 3.12+ (and security releases of older versions) rejects unsafe
+    # members and strips dangerous permission bits, is_safe_member() is used where it's not available
+    data_filter = getattr(tarfile, 'data_filter', None)
+    extract_kwargs = {} if data_filter is None else {'filter': 'data'}
+    try:
+        with open(arch_file, 'rb') as raw:
+            with _open_decompressed(raw) as stream:
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    for member in tar:
+                        if not select(member.name):
+                            continue
+                        if remaining is not None:
+                            if member.isdir():
+                                remaining = None  # directory contents may be anywhere further in the archive
+                            else:
+                                remaining.discard(member.name.rstrip('/'))
+                        if not _is_extractable(member, dest_dir, data_filter):
+                            status = 'rejected'
+                        elif skip_existing and _is_up_to_date(member, os.path.join(dest_dir, member.name)):
+                            status = 'skipped'
+                        else:
+                            tar.extract(member, dest_dir, **extract_kwargs)
+                            if member.isfile():
+                                result['bytes'] += member.size
+                            status = 'extracted'
+                        result[status].append(member.name)
+                        if progress is not None:
+                            progress({'name': member.name, 'status': status})
+                        if remaining is not None and not remaining:
+                            break
+    except (OSError, EOFError, ValueError, tarfile.TarError, zlib.error, lzma.LZMAError) as e:
+        result['error'] = str(e)
+    return result
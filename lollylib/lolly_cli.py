@@ -0,0 +1,175 @@
+"""
+Command-line batch renderer: instantiates templates listed in a JSON-lines manifest.
+
+Each non-empty line of the manifest is a job:
+    {"template": template dir (or "lib": library template name), "dest": destination dir,
+     "definitions": list of strings, "replacements": dict of string:string pairs}
+Relative paths are relative to the current directory. Jobs are rendered by a pool of worker threads
+that share template sources, compiled templates and parsed instruction files (see lolly_server.RenderServer),
+or are sent to a running render server with --server. The manifest is read as jobs are dispatched and
+results are written as jobs finish, so memory use does not depend on the number of jobs.
+
+For every job a JSON line is written to the output:
+    {"job": line number in the manifest, "dest": ..., "error": empty string or error, "message": ..., "duration": ...}
+A summary {"jobs": ..., "failed": ..., "duration": ...} is written to stderr. Exit status is 0 if all jobs
+succeeded, 1 if any job failed and 2 if the manifest can't be read or the server can't be reached.
+
+Usage:
+    lollywiz jobs.jsonl --jobs 8 --output results.jsonl
+    python -m lollylib.lolly_cli - < jobs.jsonl
+"""
+import json
+import os
+import sys
+from . import lolly_helpers
+
+
+def _parse_address(address):
+    """
+    :param address: 'host:port' or path of a Unix socket
+    :return: tuple (host, port) or path
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def iter_manifest(stream):
+    """
+    Reads jobs one by one.
+    :param stream: text file-like object
+    :return: generator of tuples (line number, render request for lolly_server or None, error message)
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            yield number, None, 'malformed job: ' + str(e)
+            continue
+        if not isinstance(job, dict) or not isinstance(job.get('dest'), str) or \
+                not (job.get('template') or job.get('lib')):
+            yield number, None, "job must be an object with 'dest' and either 'template' or 'lib'"
+            continue
+        request = {'dest': os.path.abspath(job['dest']), 'definitions': job.get('definitions') or [],
+                   'replacements': job.get('replacements') or {}}
+        if job.get('lib'):
+            request['lib'] = job['lib']
+        else:
+            request['src'] = os.path.abspath(job['template'])
+        yield number, request, ''
+
+
+def render_manifest(stream, output, max_workers=4, server=None, renderer=None):
+    """
+    Renders all jobs of a manifest, at most 2 * max_workers jobs are in flight at any time.
+    :param stream: text file-like object with the manifest
+    :param output: text file-like object that receives a result line per job
+    :param max_workers: number of jobs rendered at the same time
+    :param server: address of a running lolly_server (path or (host, port)), None to render in this process
+    :param renderer: lolly_server.RenderServer used to render in this process, a new one by default
+    :return: Dict - 'jobs': number of jobs; 'failed': number of failed jobs; 'duration': seconds;
+                    'error': empty string or error message if rendering was aborted;
+    """
+    from concurrent import futures
+    from . import lolly_server
+    summary = {'jobs': 0, 'failed': 0, 'duration': 0.0, 'error': ''}
+    timer = lolly_helpers.Timer()
+    if server is not None:
+        client = lolly_server.RenderClient(server)
+        status = client.status()
+        if status['error']:
+            summary['error'] = "can't connect to render server: " + status.get('message', status['error'])
+            return summary
+        render = client.render_request
+    else:
+        if renderer is None:
+            renderer = lolly_server.RenderServer(max_workers=max_workers)
+        render = renderer.render
+
+    def emit(number, request, result):
+        summary['jobs'] += 1
+        if result['error']:
+            summary['failed'] += 1
+        line = {'job': number, 'dest': request['dest'] if request else None, 'error': result['error'],
+                'message': result.get('message', ''), 'duration': result.get('duration', 0.0)}
+        output.write(json.dumps(line) + '\n')
+        output.flush()
+
+    def emit_done(pending, return_when):
+        done, not_done = futures.wait(pending, return_when=return_when)
+        for future in done:
+            number, request = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:  # report and continue with other jobs
+                result = {'error': 'internal', 'message': repr(e)}
+            emit(number, request, result)
+
+    max_workers = max(1, max_workers)
+    pending = {}  # future: (line number, request)
+    with futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lolly_cli') as pool:
+        for number, request, error in iter_manifest(stream):
+            if error:
+                emit(number, None, {'error': 'manifest', 'message': error})
+                continue
+            pending[pool.submit(render, request)] = (number, request)
+            if len(pending) >= 2 * max_workers:
+                emit_done(pending, futures.FIRST_COMPLETED)
+        if pending:
+            emit_done(pending, futures.ALL_COMPLETED)
+    summary['duration'] = timer.stop()
+    return summary
+
+
+def main(argv=None):
+    """
+    Console entry point 'lollywiz', see module description.
+    :return: exit status
+    """
+    import argparse
+    import contextlib
+    parser = argparse.ArgumentParser(prog='lollywiz', description='Renders LollyWiz templates listed in '
+                                                                  'a JSON-lines manifest.')
+    parser.add_argument('manifest', help="manifest file, '-' for stdin")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 4,
+                        help='number of jobs rendered at the same time, number of CPUs by default')
+    parser.add_argument('-o', '--output', default='-', help="file that receives results, '-' for stdout (default)")
+    parser.add_argument('--server', help="render with a running lolly_server: 'host:port' or Unix socket path")
+    args = parser.parse_args(argv)
+
+    try:
+        stream = sys.stdin if args.manifest == '-' else open(args.manifest, 'r')
+    except OSError as e:
+        print("* lollywiz error: can't read manifest: ", e, file=sys.stderr)
+        return 2
+    try:
+        output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    except OSError as e:
+        print("* lollywiz error: can't write results: ", e, file=sys.stderr)
+        if stream is not sys.stdin:
+            stream.close()
+        return 2
+    server = _parse_address(args.server) if args.server else None
+    try:
+        # LollyWiz prints its error messages, they must not be mixed with results
+        with contextlib.redirect_stdout(sys.stderr):
+            summary = render_manifest(stream, output, args.jobs, server)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        if output is not sys.stdout:
+            output.close()
+    if summary['error']:
+        print('* lollywiz error: ', summary['error'], file=sys.stderr)
+        return 2
+    print(json.dumps({'jobs': summary['jobs'], 'failed': summary['failed'], 'duration': summary['duration']}),
+          file=sys.stderr)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
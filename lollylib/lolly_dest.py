@@ -0,0 +1,503 @@
+"""
+Destinations where LollyWiz writes instantiated templates, see LollyWiz.set_dest_backend().
+Destination methods receive destination paths as LollyWiz builds them (destination root + '/' + relative path),
+source paths ('origin') always refer to the local file system. Like lolly_helpers 'silent_*' functions,
+the methods do not raise exceptions and return dicts with 'error' key.
+"""
+import os
+import io
+import ntpath
+import threading
+import time
+from . import lolly_helpers
+
+
+class Destination:
+    """
+    Interface of LollyWiz destination backends. Every method except get_item_type() returns
+    Dict - 'error': empty string if success or error message otherwise.
+    """
+    def get_item_type(self, path):
+        """
+        :return: Dict - 'exists': True or False; 'type': 'file', 'dir', 'symlink' or empty string
+        """
+        raise NotImplementedError
+
+    def create_path(self, path):
+        """ Creates directory and all its missing parents. """
+        raise NotImplementedError
+
+    def write_text_file(self, path, contents):
+        """ Creates or overwrites a text file, its directory must exist. """
+        raise NotImplementedError
+
+    def write_binary_file(self, path, data):
+        """ Creates or overwrites a binary file, its directory must exist. """
+        raise NotImplementedError
+
+    def copy_file(self, origin, dest):
+        """ Copies local file 'origin' to 'dest'. """
+        raise NotImplementedError
+
+    def copy_dir(self, origin, dest):
+        """ Copies local directory tree 'origin' to 'dest', old 'dest' is removed first. """
+        raise NotImplementedError
+
+    def remove_file(self, path):
+        """ Removes a file, removing of not existing file is not an error. """
+        raise NotImplementedError
+
+    def remove_dir(self, path):
+        """ Removes directory tree, removing of not existing directory is not an error. """
+        raise NotImplementedError
+
+    def remove_symlink(self, path):
+        """ Removes a symlink, removing of not existing symlink is not an error. """
+        raise NotImplementedError
+
+    def close(self):
+        """ Flushes everything that is written. """
+        return {'error': ''}
+
+
+class DiskDestination(Destination):
+    """
+    Default destination: the local file system.
+    """
+    def get_item_type(self, path):
+        return lolly_helpers.get_filesystem_item_type(path)
+
+    def create_path(self, path):
+        return lolly_helpers.silent_create_path(path)
+
+    def write_text_file(self, path, contents):
+        return lolly_helpers.silent_write_text_file(path, contents)
+
+    def write_binary_file(self, path, data):
+        return lolly_helpers.silent_write_binary_file(path, data)
+
+    def copy_file(self, origin, dest):
+        return lolly_helpers.silent_copy_file(origin, dest)
+
+    def copy_dir(self, origin, dest):
+        return lolly_helpers.silent_copy_dir(origin, dest)
+
+    def remove_file(self, path):
+        return lolly_helpers.silent_remove_file(path)
+
+    def remove_dir(self, path):
+        return lolly_helpers.silent_remove_dir(path)
+
+    def remove_symlink(self, path):
+        return lolly_helpers.silent_remove_symlink(path)
+
+
+class ArchiveDestination(Destination):
+    """
+    Writes instantiated template directly into an archive stream, without creating files on disk.
+    Destination directory of LollyWiz becomes the top-level directory inside the archive ('.' puts files
+    to the archive root). Absolute paths and paths with '..' components are rejected, so an archive never has members
+    that would be extracted outside of the extraction directory. Archive streams are append-only: items that are
+    already written can't be removed.
+    The archive is complete only after close() is called; the object may be used as a context manager.
+    Example:
+        with lolly_dest.ArchiveDestination('scaffold.tar.gz') as archive:
+            wiz = LollyWiz(src_dir, 'my_project')
+            wiz.set_dest_backend(archive)
+            wiz.instantiate()
+    """
+    FORMATS = ['tar', 'tar.gz', 'tar.xz', 'tar.bz2', 'tar.zst', 'zip']
+
+    def __init__(self, target, archive_format=None, level=None, threads=None, mtime=None):
+        """
+        :param target: archive file name or binary file-like object opened for writing (e.g. io.BytesIO or a socket
+                       file); streams don't need to be seekable
+        :param archive_format: one of ArchiveDestination.FORMATS, guessed from file name if None ('tar.gz' for streams)
+        :param level: compression level, None for default
+        :param threads: number of compression threads for compressed tar formats, defaults to the number of CPUs
+        :param mtime: modification time of generated items, current time if None
+        """
+        from . import lolly_archive
+        import tarfile
+        import zipfile
+        if archive_format is None:
+            archive_format = 'tar.gz'
+            if isinstance(target, str):
+                if target.lower().endswith('.zip'):
+                    archive_format = 'zip'
+                else:
+                    compression = lolly_archive.compression_from_filename(target)
+                    if compression is not None:
+                        archive_format = 'tar.' + compression if compression else 'tar'
+        if archive_format not in self.FORMATS:
+            raise ValueError("unknown archive format '" + str(archive_format) + "'")
+        self.archive_format = archive_format
+        self.mtime = mtime
+        self._lock = threading.Lock()
+        self._items = {}  # archive name: 'file' or 'dir'
+        self._own_file = isinstance(target, str)
+        self._file = open(target, 'wb') if self._own_file else target
+        self._writer = None
+        self._tar = None
+        self._zip = None
+        self.closed = False
+        if archive_format == 'zip':
+            self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            compression = archive_format[4:]
+            self._writer = lolly_archive.ParallelCompressedWriter(self._file, compression, level, threads)
+            self._tar = tarfile.open(fileobj=self._writer, mode='w|')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @staticmethod
+    def archive_name(path):
+        """
+        Converts destination path into a name inside the archive, e.g. './a//b/' -> 'a/b'.
+        """
+        parts = [p for p in path.replace('\\', '/').split('/') if p and p != '.']
+        return '/'.join(parts)
+
+    def names(self):
+        """
+        :return: Dict - archive name: item type ('file' or 'dir') for every written item
+        """
+        with self._lock:
+            return dict(self._items)
+
+    def get_item_type(self, path):
+        result = {'exists': False, 'type': ''}
+        with self._lock:
+            item_type = self._items.get(self.archive_name(path))
+        if item_type is not None:
+            result['exists'] = True
+            result['type'] = item_type
+        return result
+
+    def create_path(self, path):
+        with self._lock:
+            return self._run(lambda: self._add_dirs(self._member_name(path)))
+
+    def write_text_file(self, path, contents):
+        return self.write_binary_file(path, contents.encode('utf-8'))
+
+    def write_binary_file(self, path, data):
+        with self._lock:
+            return self._run(lambda: self._add_bytes(self._member_name(path), data))
+
+    def copy_file(self, origin, dest):
+        if not lolly_helpers.file_exists(origin):
+            return {'error': 'origin does not exist'}
+        with self._lock:
+            return self._run(lambda: self._add_local_file(origin, self._member_name(dest)))
+
+    def copy_dir(self, origin, dest):
+        if not lolly_helpers.dir_exists(origin):
+            return {'error': 'origin does not exist'}
+        with self._lock:
+            return self._run(lambda: self._add_local_dir(origin, self._member_name(dest)))
+
+    def remove_file(self, path):
+        return self._remove(path)
+
+    def remove_dir(self, path):
+        return self._remove(path)
+
+    def remove_symlink(self, path):
+        return self._remove(path)
+
+    def close(self):
+        """
+        Finishes the archive. The target file is closed only if it was opened by ArchiveDestination.
+        :return: Dict - 'error': empty string if success or error message otherwise;
+        """
+        with self._lock:
+            if self.closed:
+                return {'error': ''}
+            self.closed = True
+            return self._run(self._close)
+
+    # PRIVATE METHODS
+
+    def _run(self, func, *args):
+        import tarfile
+        import zipfile
+        result = {'error': ''}
+        if self.closed and func != self._close:
+            result['error'] = 'archive is closed'
+            return result
+        try:
+            func(*args)
+        except (OSError, ValueError, tarfile.TarError, zipfile.BadZipFile) as e:
+            result['error'] = str(e)
+        return result
+
+    def _member_name(self, path):
+        """
+        archive_name() of a destination path that is relative and has no '..' components.
+        :return: string; raises ValueError for other paths
+        """
+        normalized = path.replace('\\', '/')
+        if ntpath.isabs(path) or ntpath.splitdrive(path)[0] or '..' in normalized.split('/'):
+            raise ValueError("'" + path + "' is not a valid destination inside the archive")
+        return self.archive_name(path)
+
+    def _remove(self, path):
+        result = {'error': ''}
+        name = self.archive_name(path)
+        with self._lock:
+            exists = name in self._items
+        if exists:
+            result['error'] = "can't remove '" + name + "' from archive stream"
+        return result
+
+    def _item_mtime(self):
+        return time.time() if self.mtime is None else self.mtime
+
+    def _add_dirs(self, name):
+        import tarfile
+        import zipfile
+        if not name:
+            return
+        parts = name.split('/')
+        for n in range(1, len(parts) + 1):
+            dir_name = '/'.join(parts[:n])
+            item_type = self._items.get(dir_name)
+            if item_type == 'dir':
+                continue
+            if item_type == 'file':
+                raise ValueError("can't create directory '" + dir_name + "', file with the same name exists")
+            if self._zip is not None:
+                info = zipfile.ZipInfo(dir_name + '/', time.localtime(self._item_mtime())[:6])
+                info.external_attr = (0o40755 << 16) | 0x10
+                self._zip.writestr(info, b'')
+            else:
+                info = tarfile.TarInfo(dir_name)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = self._item_mtime()
+                self._tar.addfile(info)
+            self._items[dir_name] = 'dir'
+
+    def _add_bytes(self, name, data, mode=0o644, mtime=None):
+        import tarfile
+        import zipfile
+        if self._items.get(name) is not None:
+            raise ValueError("'" + name + "' already exists in archive stream")
+        self._add_dirs(name.rpartition('/')[0])
+        if mtime is None:
+            mtime = self._item_mtime()
+        if self._zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            info.external_attr = (0o100000 | mode) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self._zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = mtime
+            self._tar.addfile(info, io.BytesIO(data))
+        self._items[name] = 'file'
+
+    def _add_local_file(self, origin, name):
+        st = os.stat(origin)
+        with open(origin, 'rb') as f:
+            data = f.read()
+        self._add_bytes(name, data, st.st_mode & 0o777, st.st_mtime)
+
+    def _add_local_dir(self, origin, name):
+        self._add_dirs(name)
+        for root, dirs, files in os.walk(origin):
+            dirs.sort()
+            base = self.archive_name(name + '/' + os.path.relpath(root, origin))
+            for d in dirs:
+                self._add_dirs(self.archive_name(base + '/' + d))
+            for f in sorted(files):
+                self._add_local_file(os.path.join(root, f), self.archive_name(base + '/' + f))
+
+    def _close(self):
+        try:
+            if self._tar is not None:
+                self._tar.close()
+                self._writer.close()
+            if self._zip is not None:
+                self._zip.close()
+        finally:
+            if self._own_file:
+                self._file.close()
+
+
+class MemoryDestination(Destination):
+    """
+    Keeps instantiated template in memory as a dict of path: bytes, nothing is written to disk.
+    Paths are normalized like names inside archives ('./a//b/' is 'a/b'), so LollyWiz destination directory
+    becomes the first path component ('' or '.' keeps paths relative to the template root).
+    Directories behave like on a file system: a file can be written only into an existing directory,
+    removing a directory removes everything inside it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}  # path: bytes
+        self._dirs = set()
+
+    normalize_path = staticmethod(ArchiveDestination.archive_name)
+
+    def files(self):
+        """
+        :return: Dict - path: bytes for every file
+        """
+        with self._lock:
+            return dict(self._files)
+
+    def dirs(self):
+        """
+        :return: sorted list of all directories
+        """
+        with self._lock:
+            return sorted(self._dirs)
+
+    def read_binary_file(self, path):
+        """
+        :return: Dict - 'contents': bytes; 'error': empty string if success or error message otherwise;
+        """
+        result = {'contents': b'', 'error': ''}
+        with self._lock:
+            data = self._files.get(self.normalize_path(path))
+        if data is None:
+            result['error'] = 'file_not_exists'
+        else:
+            result['contents'] = data
+        return result
+
+    def read_text_file(self, path):
+        """
+        :return: Dict - 'contents': string; 'error': empty string if success or error message otherwise;
+        """
+        result = self.read_binary_file(path)
+        if not result['error']:
+            result['contents'] = result['contents'].decode('utf-8')
+        else:
+            result['contents'] = ''
+        return result
+
+    def get_item_type(self, path):
+        result = {'exists': False, 'type': ''}
+        name = self.normalize_path(path)
+        with self._lock:
+            is_file = name in self._files
+            is_dir = name in self._dirs or not name
+        if is_file:
+            result['exists'] = True
+            result['type'] = 'file'
+        elif is_dir:
+            result['exists'] = True
+            result['type'] = 'dir'
+        return result
+
+    def create_path(self, path):
+        with self._lock:
+            return self._make_dirs(self.normalize_path(path))
+
+    def write_text_file(self, path, contents):
+        return self.write_binary_file(path, contents.encode('utf-8'))
+
+    def write_binary_file(self, path, data):
+        with self._lock:
+            return self._write(self.normalize_path(path), bytes(data))
+
+    def copy_file(self, origin, dest):
+        result = {'error': ''}
+        if not lolly_helpers.file_exists(origin):
+            result['error'] = 'origin does not exist'
+            return result
+        try:
+            with open(origin, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            result['error'] = str(e)
+            return result
+        with self._lock:
+            return self._write(self.normalize_path(dest), data)
+
+    def copy_dir(self, origin, dest):
+        result = {'error': ''}
+        if not lolly_helpers.dir_exists(origin):
+            result['error'] = 'origin does not exist'
+            return result
+        contents = {}
+        dirs = []
+        try:
+            for root, subdirs, files in os.walk(origin):
+                rel_root = os.path.relpath(root, origin).replace(os.sep, '/')
+                dirs.append(rel_root)
+                for f in files:
+                    with open(os.path.join(root, f), 'rb') as file:
+                        contents[rel_root + '/' + f] = file.read()
+        except OSError as e:
+            result['error'] = str(e)
+            return result
+        name = self.normalize_path(dest)
+        with self._lock:
+            self._remove_tree(name)
+            result = self._make_dirs(name)
+            if result['error']:
+                return result
+            for d in dirs:
+                self._make_dirs(self.normalize_path(name + '/' + d))
+            for rel_name, data in contents.items():
+                self._files[self.normalize_path(name + '/' + rel_name)] = data
+        return result
+
+    def remove_file(self, path):
+        with self._lock:
+            self._files.pop(self.normalize_path(path), None)
+        return {'error': ''}
+
+    def remove_dir(self, path):
+        with self._lock:
+            self._remove_tree(self.normalize_path(path))
+        return {'error': ''}
+
+    def remove_symlink(self, path):
+        return {'error': ''}  # there are no symlinks in memory
+
+    # PRIVATE METHODS
+
+    def _make_dirs(self, name):
+        result = {'error': ''}
+        if not name:
+            return result
+        parts = name.split('/')
+        for n in range(1, len(parts) + 1):
+            dir_name = '/'.join(parts[:n])
+            if dir_name in self._files:
+                result['error'] = "can't create directory '" + dir_name + "', file with the same name exists"
+                return result
+            self._dirs.add(dir_name)
+        return result
+
+    def _write(self, name, data):
+        result = {'error': ''}
+        parent = name.rpartition('/')[0]
+        if name in self._dirs or not name:
+            result['error'] = "'" + name + "' is a directory"
+        elif parent and parent not in self._dirs:
+            result['error'] = "directory '" + parent + "' does not exist"
+        else:
+            self._files[name] = data
+        return result
+
+    def _remove_tree(self, name):
+        if not name:
+            self._files.clear()
+            self._dirs.clear()
+            return
+        prefix = name + '/'
+        self._dirs = set(d for d in self._dirs if d != name and not d.startswith(prefix))
+        for path in [p for p in self._files if p.startswith(prefix)]:
+            del self._files[path]
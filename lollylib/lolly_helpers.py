@@ -1,11 +1,9 @@
-
-import os, shutil, sys, errno, ntpath
-import subprocess # for executing shell commands 
-import urllib.request
-from urllib import error
-import tarfile
+# Only cheap modules are imported here, so that importing lollylib stays fast; heavy modules
+# (asyncio, subprocess, http.client, tarfile...) are imported by the functions that use them.
+import os
+import ntpath
 import time
-import datetime
+import threading
 
 # ---------------------------------------------------------------------------------------------------------------------
 # Files and directories
@@ -52,6 +50,8 @@ def silent_write_text_file(filename, contents=''):
     try:
         f = open(filename, 'w')
         f.write(contents)
+        if _metrics is not None:
+            _metrics.bytes_written.inc(f.tell())
         f.close()
         return result
     except Exception as e:
@@ -59,6 +59,23 @@ def silent_write_text_file(filename, contents=''):
         return result
 
 
+def silent_write_binary_file(filename, data=b''):
+    """
+    Create a new binary file and writes data into it (do not raise exceptions).
+    If file with specified name already exists, it will be overwritten.
+    :return: Dict - 'error': empty string if success, or error message otherwise.
+    """
+    result = {'error': ''}
+    try:
+        with open(filename, 'wb') as f:
+            f.write(data)
+        if _metrics is not None:
+            _metrics.bytes_written.inc(len(data))
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+
 def silent_read_text_file(filename):
     """
     Read a text file (do not raise exceptions).
@@ -73,6 +90,8 @@ def silent_read_text_file(filename):
     try:
         file = open(filename, 'r')
         result['contents'] = file.read()
+        if _metrics is not None:
+            _metrics.bytes_read.inc(file.tell())
         file.close()
     except Exception as e:
         result['contents'] = ''
@@ -137,6 +156,7 @@ def silent_remove_symlink(path):  # TODO: test
 
 
 def remove_dir(dirname):
+    import shutil
     shutil.rmtree(dirname)
 
 
@@ -146,6 +166,7 @@ def silent_remove_dir(path):
     :param path:
     :return: Dict - 'error': empty string if the directory was removed or not exists, or error message otherwise;
     """
+    import shutil
     result = {'error': ''}
     if dir_exists(path):
         try:
@@ -162,6 +183,7 @@ def silent_copy_file(origin, dest):
     :param dest:
     :return: Dict - 'error': empty string if existing file was copied, or error message otherwise;
     """
+    import shutil
     result = {'error': ''}
     if not file_exists(origin):
         result['error'] = 'origin does not exist'
@@ -183,6 +205,7 @@ def silent_move_file(origin, dest):
     :param dest:
     :return: Dict - 'error': empty string if existing file was moved, or error message otherwise;
     """
+    import shutil
     result = {'error': ''}
     if not file_exists(origin):
         result['error'] = 'origin does not exist'
@@ -205,6 +228,7 @@ def silent_copy_dir(origin, dest):
     :param dest:
     :return: Dict - 'error': empty string if directory was copied and exists or error message otherwise;
     """
+    import shutil
     result = {'error': ''}
     if not dir_exists(origin):
         result['error'] = 'origin does not exist'
@@ -228,6 +252,7 @@ def silent_move_dir(origin, dest):
     :param dest:
     :return: Dict - 'error': empty string if success or error message otherwise;
     """
+    import shutil
     result = {'error': ''}
     if not dir_exists(origin):
         result['error'] = 'origin does not exist'
@@ -319,6 +344,478 @@ def get_filesystem_item_type(item_name):
     return result
 
 
+# ---------------------------------------------------------------------------------------------------------------------
+# File fingerprints
+#
+# A fingerprint is a content hash of a file. FingerprintStore remembers fingerprints together with the file's
+# size, mtime_ns and inode, and persists them in a small JSON file, so a file is hashed again only if
+# any of them changed.
+
+_FINGERPRINT_STORE_VERSION = 1
+# files modified less than this many nanoseconds before they were hashed are not remembered: they may change
+# again within the resolution of the file system timestamps without changing size or mtime
+_FINGERPRINT_RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+def file_digest(filename, algorithm='sha256', block_size=1024 * 1024, use_mmap=False):
+    """
+    Computes hash of file contents.
+    :param filename: path to file
+    :param algorithm: name accepted by hashlib.new()
+    :param block_size: size of blocks the file is read in
+    :param use_mmap: hash memory-mapped file instead of reading it (avoids copying of large files)
+    :return: lowercase hex digest
+    """
+    import hashlib
+    import mmap
+    hasher = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    for offset in range(0, size, block_size):
+                        hasher.update(m[offset:offset + block_size])
+            return hasher.hexdigest()
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class FingerprintStore:
+    """
+    Cache of file fingerprints keyed by (path, size, mtime_ns, inode). Thread-safe.
+    May be used as a context manager, the store is saved on exit.
+    """
+    def __init__(self, store_file=None, algorithm='sha256', use_mmap=False, max_workers=4):
+        """
+        :param store_file: JSON file fingerprints are loaded from and saved to; None keeps them in memory only
+        :param algorithm: hash algorithm, see file_digest(); fingerprints of other algorithms are not loaded
+        :param use_mmap: see file_digest()
+        :param max_workers: number of threads hashing files in fingerprint_many()
+        """
+        self.store_file = store_file
+        self.algorithm = algorithm
+        self.use_mmap = use_mmap
+        self.max_workers = max(1, max_workers)
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # real path: [size, mtime_ns, inode, digest]
+        self._dirty = False
+        self._lock = threading.Lock()
+        if store_file is not None:
+            self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+
+    def fingerprint(self, filename):
+        """
+        :param filename: path to file
+        :return: Dict - 'digest': hex digest of file contents; 'size'; 'mtime_ns';
+                        'hashed': True if the file was hashed, False if the fingerprint was known;
+                        'error': empty string if success or error message otherwise;
+        """
+        result = {'digest': '', 'size': 0, 'mtime_ns': 0, 'hashed': False, 'error': ''}
+        try:
+            key = os.path.realpath(filename)
+            st = os.stat(key)
+        except OSError as e:
+            result['error'] = str(e)
+            return result
+        result['size'] = st.st_size
+        result['mtime_ns'] = st.st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                self.hits += 1
+                result['digest'] = entry[3]
+                return result
+            self.misses += 1
+        try:
+            digest = file_digest(key, self.algorithm, use_mmap=self.use_mmap)
+            st_after = os.stat(key)
+        except (OSError, ValueError) as e:
+            result['error'] = str(e)
+            return result
+        result['digest'] = digest
+        result['hashed'] = True
+        stable = (st_after.st_size, st_after.st_mtime_ns, st_after.st_ino) == (st.st_size, st.st_mtime_ns, st.st_ino)
+        if stable and time.time() * 10 ** 9 - st.st_mtime_ns > _FINGERPRINT_RACY_WINDOW_NS:
+            with self._lock:
+                self._entries[key] = [st.st_size, st.st_mtime_ns, st.st_ino, digest]
+                self._dirty = True
+        return result
+
+    def fingerprint_many(self, filenames):
+        """
+        Fingerprints many files, files that must be hashed are hashed in parallel.
+        :param filenames: iterable of paths
+        :return: list of fingerprint() results in the order of 'filenames'
+        """
+        from concurrent import futures
+        filenames = list(filenames)
+        if len(filenames) < 2 or self.max_workers == 1:
+            return [self.fingerprint(f) for f in filenames]
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='lolly_hash') as pool:
+            return list(pool.map(self.fingerprint, filenames))
+
+    def forget(self, filename=None):
+        """
+        Removes remembered fingerprint of 'filename' or of all files if 'filename' is None.
+        :return: None
+        """
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.realpath(filename), None)
+            self._dirty = True
+
+    def prune(self):
+        """
+        Removes fingerprints of files that no longer exist.
+        :return: number of removed fingerprints
+        """
+        with self._lock:
+            missing = [key for key in self._entries if not os.path.isfile(key)]
+            for key in missing:
+                del self._entries[key]
+            if missing:
+                self._dirty = True
+            return len(missing)
+
+    def save(self):
+        """
+        Writes fingerprints to the store file (atomically) if they changed since the last save.
+        :return: Dict - 'error': empty string if success or error message otherwise;
+        """
+        import json
+        result = {'error': ''}
+        with self._lock:
+            if self.store_file is None or not self._dirty:
+                return result
+            data = {'version': _FINGERPRINT_STORE_VERSION, 'algorithm': self.algorithm, 'files': self._entries}
+            tmp_file = self.store_file + '.tmp' + str(os.getpid())
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(data, f, separators=(',', ':'))
+                os.replace(tmp_file, self.store_file)
+                self._dirty = False
+            except (OSError, ValueError) as e:
+                silent_remove_file(tmp_file)
+                result['error'] = str(e)
+        return result
+
+    def _load(self):
+        import json
+        try:
+            with open(self.store_file, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # no store yet or it is damaged, fingerprints are computed again
+        if data.get('version') == _FINGERPRINT_STORE_VERSION and data.get('algorithm') == self.algorithm:
+            self._entries = data.get('files', {})
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Directory diff and sync
+#
+# iter_dir_diff() walks two directory trees side by side, one directory at a time, and yields an entry per item:
+#     {'path': path relative to the roots, '/' delimited; 'type': 'file', 'dir' or 'symlink';
+#      'status': 'added' (exists in src only), 'removed' (exists in dest only), 'changed' or 'unchanged'}.
+# Contents of added and removed directories are not listed, such directories are copied or removed as a whole.
+# Only one directory listing per tree level is kept in memory, so large trees are diffed with bounded memory.
+#
+# Files are compared with one of the modes:
+#     'metadata': same size and mtime;
+#     'content': same size and content hash;
+#     'auto': same size and either same mtime or same content hash.
+# Content hashes are taken from FingerprintStore if one is given, so unchanged files are not read again.
+
+DIR_DIFF_COMPARE_MODES = ('auto', 'metadata', 'content')
+
+
+def _scan_dir_entries(path):
+    entries = {}
+    for entry in os.scandir(path):
+        if entry.is_symlink():
+            entries[entry.name] = ('symlink', entry)
+        elif entry.is_dir():
+            entries[entry.name] = ('dir', entry)
+        elif entry.is_file():
+            entries[entry.name] = ('file', entry)
+    return entries
+
+
+def _same_file_contents(src_entry, dest_entry, compare, fingerprints):
+    src_stat = src_entry.stat()
+    dest_stat = dest_entry.stat()
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    same_mtime = src_stat.st_mtime_ns == dest_stat.st_mtime_ns
+    if compare == 'metadata' or (compare == 'auto' and same_mtime):
+        return same_mtime
+    if fingerprints is not None:
+        src_fp = fingerprints.fingerprint(src_entry.path)
+        dest_fp = fingerprints.fingerprint(dest_entry.path)
+        if src_fp['error'] or dest_fp['error']:
+            raise OSError(src_fp['error'] or dest_fp['error'])
+        return src_fp['digest'] == dest_fp['digest']
+    return file_digest(src_entry.path) == file_digest(dest_entry.path)
+
+
+def iter_dir_diff(src, dest, compare='auto', fingerprints=None):
+    """
+    Compares directory trees, see the comment above. 'dest' may not exist, then everything is 'added'.
+    Raises OSError if a directory can't be read.
+    :param src: source directory
+    :param dest: destination directory
+    :param compare: 'auto', 'metadata' or 'content'
+    :param fingerprints: optional FingerprintStore
+    :return: generator of entries
+    """
+    if compare not in DIR_DIFF_COMPARE_MODES:
+        raise ValueError("unknown compare mode '" + str(compare) + "'")
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        src_entries = _scan_dir_entries(src + '/' + rel_dir if rel_dir else src)
+        dest_dir = dest + '/' + rel_dir if rel_dir else dest
+        dest_entries = _scan_dir_entries(dest_dir) if dir_exists(dest_dir) else {}
+        sub_dirs = []
+        for name in sorted(set(src_entries) | set(dest_entries)):
+            path = rel_dir + '/' + name if rel_dir else name
+            src_item = src_entries.get(name)
+            dest_item = dest_entries.get(name)
+            if dest_item is None:
+                yield {'path': path, 'type': src_item[0], 'status': 'added'}
+                continue
+            if src_item is None:
+                yield {'path': path, 'type': dest_item[0], 'status': 'removed'}
+                continue
+            item_type = src_item[0]
+            if item_type != dest_item[0]:
+                status = 'changed'
+            elif item_type == 'dir':
+                status = 'unchanged'
+                sub_dirs.append(path)
+            elif item_type == 'symlink':
+                same = os.readlink(src_item[1].path) == os.readlink(dest_item[1].path)
+                status = 'unchanged' if same else 'changed'
+            else:
+                same = _same_file_contents(src_item[1], dest_item[1], compare, fingerprints)
+                status = 'unchanged' if same else 'changed'
+            yield {'path': path, 'type': item_type, 'status': status}
+        pending.extend(reversed(sub_dirs))  # directories are visited in sorted order
+
+
+def dir_diff(src, dest, compare='auto', fingerprints=None):
+    """
+    Compares directory trees (do not raise exceptions), see iter_dir_diff().
+    :return: Dict - 'added', 'removed', 'changed', 'unchanged': lists of relative paths;
+                    'error': empty string if success or error message otherwise;
+    """
+    result = {'added': [], 'removed': [], 'changed': [], 'unchanged': [], 'error': ''}
+    try:
+        for entry in iter_dir_diff(src, dest, compare, fingerprints):
+            result[entry['status']].append(entry['path'])
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+    return result
+
+
+def _remove_filesystem_item(path):
+    import shutil
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.remove(path)
+    else:
+        shutil.rmtree(path)
+
+
+def _sync_item(src_path, dest_path, item_type, replace):
+    """ Copies single item, :return: number of copied bytes """
+    import shutil
+    if item_type == 'file':
+        # copy next to the destination first, so the old file is replaced atomically
+        tmp_path = dest_path + '.lolly_sync_tmp'
+        try:
+            shutil.copy2(src_path, tmp_path, follow_symlinks=False)
+            if replace and os.path.isdir(dest_path) and not os.path.islink(dest_path):
+                shutil.rmtree(dest_path)
+            os.replace(tmp_path, dest_path)
+        except OSError:
+            silent_remove_file(tmp_path)
+            raise
+        return os.path.getsize(dest_path)
+    if replace:
+        _remove_filesystem_item(dest_path)
+    if item_type == 'symlink':
+        os.symlink(os.readlink(src_path), dest_path)
+        return 0
+    shutil.copytree(src_path, dest_path, symlinks=True)
+    return sum(os.path.getsize(root + '/' + f) for root, dirs, files in os.walk(dest_path) for f in files)
+
+
+def sync_dir(src, dest, delete_extra=False, compare='auto', fingerprints=None, dry_run=False, on_entry=None):
+    """
+    Makes 'dest' a copy of 'src' by copying only added and changed items (do not raise exceptions).
+    Unlike silent_copy_dir(), unchanged items are left untouched, so repeated syncs cost time proportional
+    to the number of changes (plus one stat per item). Copied files keep their modification time.
+    :param src: source directory
+    :param dest: destination directory, created if needed
+    :param delete_extra: remove items that do not exist in 'src'
+    :param compare: 'auto', 'metadata' or 'content', see iter_dir_diff()
+    :param fingerprints: optional FingerprintStore
+    :param dry_run: report what would be done without changing anything
+    :param on_entry: optional callable on_entry(entry) called with each iter_dir_diff() entry before it is synced
+    :return: Dict - 'copied', 'removed', 'unchanged': numbers of items; 'bytes': size of copied files;
+                    'failed': number of items that could not be synced;
+                    'error': empty string if success or the first error message otherwise;
+    """
+    result = {'copied': 0, 'removed': 0, 'unchanged': 0, 'bytes': 0, 'failed': 0, 'error': ''}
+    if not dir_exists(src):
+        result['error'] = "source directory '" + src + "' does not exist"
+        return result
+    if not dry_run and not dir_exists(dest):
+        created = silent_create_path(dest)
+        if created['error']:
+            result['error'] = created['error']
+            return result
+    try:
+        for entry in iter_dir_diff(src, dest, compare, fingerprints):
+            if on_entry is not None:
+                on_entry(entry)
+            status = entry['status']
+            if status == 'unchanged':
+                if entry['type'] != 'dir':
+                    result['unchanged'] += 1
+                continue
+            if status == 'removed' and not delete_extra:
+                continue
+            dest_path = dest + '/' + entry['path']
+            try:
+                if status == 'removed':
+                    if not dry_run:
+                        _remove_filesystem_item(dest_path)
+                    result['removed'] += 1
+                else:
+                    if not dry_run:
+                        result['bytes'] += _sync_item(src + '/' + entry['path'], dest_path, entry['type'],
+                                                      replace=status == 'changed')
+                    result['copied'] += 1
+            except OSError as e:
+                result['failed'] += 1
+                if not result['error']:
+                    result['error'] = str(e)
+    except (OSError, ValueError) as e:
+        result['failed'] += 1
+        if not result['error']:
+            result['error'] = str(e)
+    return result
+
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Asynchronous file operations
+#
+# Each '*_async' function is a coroutine that runs its synchronous counterpart in a dedicated
+# thread pool, so that the event loop is never blocked by file system calls. The pool size bounds
+# the number of file operations that run concurrently, no matter how many coroutines await them.
+
+_ASYNC_IO_MAX_WORKERS = 8
+_async_io_executor = None
+_async_io_executor_lock = threading.Lock()
+
+
+def set_async_io_max_workers(max_workers):
+    """
+    Sets the maximum number of blocking file operations that may run concurrently on behalf of
+    the '*_async' functions. Operations that are already running are not interrupted.
+    :param max_workers: positive integer
+    :return: None
+    """
+    global _ASYNC_IO_MAX_WORKERS, _async_io_executor
+    if max_workers < 1:
+        raise ValueError("max_workers must be positive")
+    with _async_io_executor_lock:
+        _ASYNC_IO_MAX_WORKERS = max_workers
+        if _async_io_executor is not None:
+            _async_io_executor.shutdown(wait=False)
+            _async_io_executor = None
+
+
+def _get_async_io_executor():
+    global _async_io_executor
+    from concurrent import futures
+    with _async_io_executor_lock:
+        if _async_io_executor is None:
+            _async_io_executor = futures.ThreadPoolExecutor(max_workers=_ASYNC_IO_MAX_WORKERS,
+                                                            thread_name_prefix='lolly_io')
+        return _async_io_executor
+
+
+async def run_blocking_io(func, *args):
+    """
+    Runs blocking function in the file operation thread pool and returns its result.
+    If the awaiting task is cancelled before the function has started, the function is not called at all;
+    a function that has already started runs to completion in its thread.
+    :param func: callable
+    :param args: arguments passed to 'func'
+    :return: whatever 'func' returns
+    """
+    import asyncio
+    future = _get_async_io_executor().submit(func, *args)
+    return await asyncio.wrap_future(future)
+
+
+async def silent_write_text_file_async(filename, contents=''):
+    """ Asynchronous variant of silent_write_text_file(). """
+    return await run_blocking_io(silent_write_text_file, filename, contents)
+
+
+async def silent_read_text_file_async(filename):
+    """ Asynchronous variant of silent_read_text_file(). """
+    return await run_blocking_io(silent_read_text_file, filename)
+
+
+async def silent_create_path_async(path, overwrite=False):
+    """ Asynchronous variant of silent_create_path(). """
+    return await run_blocking_io(silent_create_path, path, overwrite)
+
+
+async def silent_remove_file_async(filename):
+    """ Asynchronous variant of silent_remove_file(). """
+    return await run_blocking_io(silent_remove_file, filename)
+
+
+async def silent_remove_symlink_async(path):
+    """ Asynchronous variant of silent_remove_symlink(). """
+    return await run_blocking_io(silent_remove_symlink, path)
+
+
+async def silent_remove_dir_async(path):
+    """ Asynchronous variant of silent_remove_dir(). """
+    return await run_blocking_io(silent_remove_dir, path)
+
+
+async def silent_copy_file_async(origin, dest):
+    """ Asynchronous variant of silent_copy_file(). """
+    return await run_blocking_io(silent_copy_file, origin, dest)
+
+
+async def silent_copy_dir_async(origin, dest):
+    """ Asynchronous variant of silent_copy_dir(). """
+    return await run_blocking_io(silent_copy_dir, origin, dest)
+
+
+async def get_filesystem_item_type_async(item_name):
+    """ Asynchronous variant of get_filesystem_item_type(). """
+    return await run_blocking_io(get_filesystem_item_type, item_name)
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 # Operations with strings
 
@@ -648,12 +1145,17 @@ def find_line_starting_with_seq(the_list, seq, from_index=0, to_index=-1):
 
 def replace_keys(the_string, the_dict):
     """
-    Replace all keys with their values in 'the_string'
+    Replace all keys with their values in 'the_string'.
+    A value may be a callable (e.g. LazyValue) that returns a string, it is called only if the key occurs.
     :param the_string:
     :param the_dict:
     :return: processed string
     """
     for key, value in the_dict.items():
+        if value.__class__ is not str:
+            if key not in the_string:
+                continue
+            value = value()
         the_string = the_string.replace(key, value)
     return the_string
 
@@ -667,12 +1169,50 @@ def replace_in_string_list(the_list, the_dict):
     """
     tmp = []
     for line in the_list:
-        for key, val in the_dict.items():
-            line = line.replace(key, val)
-        tmp.append(line)
+        tmp.append(replace_keys(line, the_dict))
     return tmp
 
 
+class LazyValue:
+    """
+    Replacement value that is computed on first use, e.g. git metadata or checksum of a file.
+    Calling the object returns the value; the provider is called at most once, also by many threads.
+    """
+    def __init__(self, provider):
+        """
+        :param provider: callable without arguments that returns a string
+        """
+        self.provider = provider
+        self._lock = threading.Lock()
+        self._value = None
+
+    def __call__(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self.provider()
+        return self._value
+
+    @property
+    def is_evaluated(self):
+        return self._value is not None
+
+
+def bind_lazy_values(the_dict):
+    """
+    Wraps callable values into new LazyValue objects, so each of them is computed at most once
+    by users of the returned dict (e.g. during one template instantiation).
+    :param the_dict: dict of string:string or string:callable pairs
+    :return: new dict, strings are kept as they are
+    """
+    bound = {}
+    for key, value in the_dict.items():
+        if value.__class__ is not str:
+            value = LazyValue(value.provider if isinstance(value, LazyValue) else value)
+        bound[key] = value
+    return bound
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 # Environment variables
 
@@ -697,13 +1237,217 @@ def envVarExists(variableName):
 
 # 'cmdAndArgs' must be an array, each argument must be a separate array element
 def executeShellCmd(cmdAndArgs):
-    subprocess.check_call(cmdAndArgs, env=dict(os.environ))
+    import subprocess
+    subprocess.check_call(cmdAndArgs)
+
+
+# run_command() and its batch and asyncio variants do not raise exceptions, each command gets a result dict:
+#     'cmd': the command; 'returncode': exit code, None if the command did not finish;
+#     'stdout', 'stderr': captured output decoded as utf-8 (empty strings if not captured);
+#     'duration': seconds; 'timed_out': True if the command was killed on timeout;
+#     'error': empty string if the command exited with code 0 or error message otherwise.
+# Commands are lists of arguments and are not run by a shell. 'env' is a dict of variables that are set
+# in addition to the environment of this process, which is inherited without copying when 'env' is None.
+
+
+def _command_env(env):
+    if not env:
+        return None
+    merged = dict(os.environ)
+    merged.update(env)
+    return merged
+
+
+def _command_result(cmd):
+    return {'cmd': cmd, 'returncode': None, 'stdout': '', 'stderr': '', 'duration': 0.0, 'timed_out': False,
+            'error': ''}
+
+
+def _finish_command_result(result, returncode, stdout, stderr, started):
+    result['returncode'] = returncode
+    result['stdout'] = b''.join(stdout).decode('utf-8', 'replace')
+    result['stderr'] = b''.join(stderr).decode('utf-8', 'replace')
+    result['duration'] = time.monotonic() - started
+    if result['timed_out']:
+        result['error'] = 'timeout'
+    elif returncode != 0:
+        result['error'] = "'" + ' '.join(result['cmd']) + "' exited with code " + str(returncode)
+    return result
+
+
+def _pump_command_output(stream, name, chunks, on_output):
+    for line in iter(stream.readline, b''):
+        if chunks is not None:
+            chunks.append(line)
+        on_output(name, line.decode('utf-8', 'replace'))
+    stream.close()
+
+
+def run_command(cmd, timeout=None, cwd=None, env=None, capture=True, on_output=None, input=None):
+    """
+    Runs a command and waits for it to finish.
+    :param cmd: list of strings
+    :param timeout: seconds, the command is killed when it runs longer
+    :param cwd: working directory of the command
+    :param env: dict of additional environment variables
+    :param capture: if False, output is not kept in the result ('on_output' still receives it)
+    :param on_output: optional callable on_output(stream_name, line) called with each line of output as soon as
+                      it is produced, stream_name is 'stdout' or 'stderr'; called from helper threads
+    :param input: bytes passed to stdin, stdin is empty by default
+    :return: Dict - see the comment above
+    """
+    import subprocess
+    result = _command_result(cmd)
+    started = time.monotonic()
+    pipe = subprocess.PIPE if capture or on_output is not None else subprocess.DEVNULL
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                stdout=pipe, stderr=pipe, cwd=cwd, env=_command_env(env))
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+    stdout, stderr = [], []
+    if on_output is None:
+        try:
+            out, err = proc.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            result['timed_out'] = True
+            proc.kill()
+            out, err = proc.communicate()
+        if capture:
+            stdout, stderr = [out or b''], [err or b'']
+    else:
+        pumps = [threading.Thread(target=_pump_command_output,
+                                  args=(stream, name, chunks if capture else None, on_output), daemon=True)
+                 for stream, name, chunks in ((proc.stdout, 'stdout', stdout), (proc.stderr, 'stderr', stderr))]
+        for p in pumps:
+            p.start()
+        if input is not None:
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except OSError:
+                pass
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            result['timed_out'] = True
+            proc.kill()
+            proc.wait()
+        for p in pumps:
+            p.join()
+    return _finish_command_result(result, proc.returncode, stdout, stderr, started)
+
+
+def _command_job(job):
+    return job if isinstance(job, dict) else {'cmd': job}
+
+
+def run_commands(cmds, max_workers=4, timeout=None, cwd=None, env=None, capture=True, on_output=None,
+                 progress=None):
+    """
+    Runs many commands, at most 'max_workers' at the same time.
+    :param cmds: iterable of commands (lists of strings) or dicts with 'cmd' and optional 'timeout', 'cwd' and 'env'
+                 keys that override arguments of this function
+    :param on_output: optional callable on_output(index, stream_name, line), index is position of the command in 'cmds'
+    :param progress: optional callable progress(index, result) called as each command finishes
+    :return: list of run_command() results in the order of 'cmds'
+    """
+    from concurrent import futures
+    jobs = [_command_job(c) for c in cmds]
+
+    def run(index):
+        job = jobs[index]
+        output = None
+        if on_output is not None:
+            output = lambda name, line: on_output(index, name, line)
+        result = run_command(job['cmd'], job.get('timeout', timeout), job.get('cwd', cwd), job.get('env', env),
+                             capture, output)
+        if progress is not None:
+            progress(index, result)
+        return result
+
+    if not jobs:
+        return []
+    with futures.ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='lolly_cmd') as pool:
+        return list(pool.map(run, range(len(jobs))))
+
+
+async def _read_command_stream(stream, name, chunks, on_output):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        if chunks is not None:
+            chunks.append(line)
+        if on_output is not None:
+            on_output(name, line.decode('utf-8', 'replace'))
+
+
+async def run_command_async(cmd, timeout=None, cwd=None, env=None, capture=True, on_output=None):
+    """
+    Asynchronous variant of run_command(), the event loop is not blocked while the command runs.
+    'on_output' is called on the event loop thread. If the awaiting task is cancelled, the command is killed.
+    :return: Dict - see run_command()
+    """
+    import asyncio
+    result = _command_result(cmd)
+    started = time.monotonic()
+    pipe = asyncio.subprocess.PIPE if capture or on_output is not None else asyncio.subprocess.DEVNULL
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL, stdout=pipe, stderr=pipe,
+                                                    cwd=cwd, env=_command_env(env))
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+    stdout, stderr = [], []
+    readers = []
+    if pipe == asyncio.subprocess.PIPE:
+        readers = [_read_command_stream(proc.stdout, 'stdout', stdout if capture else None, on_output),
+                   _read_command_stream(proc.stderr, 'stderr', stderr if capture else None, on_output)]
+    try:
+        await asyncio.wait_for(asyncio.gather(proc.wait(), *readers), timeout)
+    except asyncio.TimeoutError:
+        result['timed_out'] = True
+        proc.kill()
+        await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return _finish_command_result(result, proc.returncode, stdout, stderr, started)
+
+
+async def run_commands_async(cmds, max_concurrency=4, timeout=None, cwd=None, env=None, capture=True,
+                             on_output=None, progress=None):
+    """
+    Asynchronous variant of run_commands(), at most 'max_concurrency' commands run at the same time.
+    :return: list of run_command() results in the order of 'cmds'
+    """
+    import asyncio
+    jobs = [_command_job(c) for c in cmds]
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(index):
+        job = jobs[index]
+        output = None
+        if on_output is not None:
+            output = lambda name, line: on_output(index, name, line)
+        async with semaphore:
+            result = await run_command_async(job['cmd'], job.get('timeout', timeout), job.get('cwd', cwd),
+                                             job.get('env', env), capture, output)
+        if progress is not None:
+            progress(index, result)
+        return result
+
+    return list(await asyncio.gather(*[run(i) for i in range(len(jobs))]))
 
 
 # ---------------------------------------------------------------------------------------------------------------------
 # Zip, tar, gzip archives
 
 def unzipTarGz(archFile, destDir, removeArchFile=False):
+    import tarfile
     if not file_exists(archFile):
         return
     if not dir_exists(destDir):
@@ -716,6 +1460,7 @@ def unzipTarGz(archFile, destDir, removeArchFile=False):
 
 
 def zipFileTarGz(sourceFile, destArchName, removeSourceFile=False):
+    import tarfile
     if not file_exists(sourceFile):
         return
     with tarfile.open(destArchName, "w:gz") as tar:
@@ -725,6 +1470,7 @@ def zipFileTarGz(sourceFile, destArchName, removeSourceFile=False):
 
 
 def zipDirTarGz(sourceDir, destArchName, removeSourceDir=False):
+    import tarfile
     if not dir_exists(sourceDir):
         return
     with tarfile.open(destArchName, "w:gz") as tar:
@@ -735,16 +1481,589 @@ def zipDirTarGz(sourceDir, destArchName, removeSourceDir=False):
 
 # ---------------------------------------------------------------------------------------------------------------------
 # File download
+#
+# DownloadManager fetches files over HTTP(S) with a bounded pool of worker threads. Idle keep-alive
+# connections are kept per host and reused by subsequent requests. Each file is downloaded into
+# '<dest>.part' first, interrupted downloads are resumed with HTTP Range requests, and the file is moved
+# to its destination only after it is complete and its checksum (if given) matches.
 
-def silentDownloadFile(fileUrl, destFileName):
-    result = ['']
+_DOWNLOAD_MAX_REDIRECTS = 5
+_DOWNLOAD_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class DownloadError(Exception):
+    def __init__(self, msg, retry=True, status=0):
+        super(DownloadError, self).__init__(msg)
+        self.retry = retry
+        self.status = status
+
+
+def parse_checksum(checksum):
+    """
+    Parses checksum specification.
+    :param checksum: 'algorithm:hexdigest', e.g. 'md5:9e10...', or hex digest of sha256
+    :return: Dict - 'algorithm': name accepted by hashlib.new(); 'digest': lowercase hex digest;
+                    'error': empty string if success or error message otherwise;
+    """
+    import hashlib
+    result = {'algorithm': '', 'digest': '', 'error': ''}
+    algorithm, sep, digest = checksum.strip().rpartition(':')
+    algorithm = algorithm.lower() if sep else 'sha256'
     try:
-        result = urllib.request.urlretrieve(fileUrl, destFileName)
-    except error.URLError as e:
-        pass 
+        hashlib.new(algorithm)
+    except ValueError:
+        result['error'] = "unsupported checksum algorithm '" + algorithm + "'"
+        return result
+    result['algorithm'] = algorithm
+    result['digest'] = digest.lower()
     return result
 
 
+class _HTTPConnectionPool:
+    """
+    Idle keep-alive connections grouped by (scheme, host:port).
+    """
+    def __init__(self, timeout, max_idle_per_host=4):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, netloc):
+        import http.client
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return key, idle.pop()
+        if scheme == 'https':
+            return key, http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return key, http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+class DownloadManager:
+    """
+    Downloads files concurrently. Methods do not raise exceptions, results are reported per file.
+    May be used as a context manager; close() closes idle connections.
+    """
+    def __init__(self, max_workers=4, timeout=30, retries=3, retry_delay=0.5, chunk_size=64 * 1024,
+                 headers=None):
+        """
+        :param max_workers: max number of files downloaded at the same time
+        :param timeout: socket timeout in seconds
+        :param retries: number of additional attempts after network errors and 5xx responses
+        :param retry_delay: delay before the first retry in seconds, doubled on each next retry
+        :param chunk_size: size of blocks read from the network
+        :param headers: dict of additional request headers
+        """
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.chunk_size = chunk_size
+        self.headers = dict(headers or {})
+        self._pool = _HTTPConnectionPool(timeout, max_idle_per_host=self.max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Closes idle connections.
+        :return: None
+        """
+        self._pool.close()
+
+    def download(self, url, dest, checksum=None, progress=None, headers=None):
+        """
+        Downloads single file. Incomplete download is kept in '<dest>.part' and resumed by the next call.
+        :param url: http or https url
+        :param dest: destination file name, parent directories are created if needed
+        :param checksum: optional checksum of the file, see parse_checksum()
+        :param progress: optional callable progress(url, bytes_done, bytes_total), bytes_total is None if unknown;
+                         with download_many() it is called from worker threads
+        :param headers: optional dict of request headers; with 'If-None-Match' or 'If-Modified-Since'
+                        the request is conditional and 304 response is a success that leaves 'dest' untouched
+        :return: Dict - 'url'; 'dest'; 'bytes': file size; 'resumed': True if a partial download was continued;
+                        'attempts': number of requests made; 'status': last HTTP status;
+                        'etag' and 'last_modified': validators sent by the server, empty strings if none;
+                        'headers': http.client.HTTPMessage of the last response or None;
+                        'error': empty string if success or error message otherwise;
+        """
+        import http.client
+        result = {'url': url, 'dest': dest, 'bytes': 0, 'resumed': False, 'attempts': 0, 'status': 0,
+                  'etag': '', 'last_modified': '', 'headers': None, 'error': ''}
+        expected = None
+        if checksum:
+            expected = parse_checksum(checksum)
+            if expected['error']:
+                result['error'] = expected['error']
+                return result
+        part_file = dest + '.part'
+        base = path_base_and_leaf(dest)['base']
+        if base and not dir_exists(base):
+            silent_create_path(base)
+        while True:
+            result['attempts'] += 1
+            try:
+                fetched = self._fetch(url, part_file, expected, progress, headers)
+                break
+            except DownloadError as e:
+                result['status'] = e.status
+                err = e
+            except (OSError, http.client.HTTPException) as e:
+                err = e
+            if not getattr(err, 'retry', True) or result['attempts'] > self.retries:
+                result['error'] = str(err) or err.__class__.__name__
+                return result
+            time.sleep(self.retry_delay * 2 ** (result['attempts'] - 1))
+        result['status'] = fetched['status']
+        result['resumed'] = fetched['resumed']
+        result['bytes'] = fetched['bytes']
+        result['etag'] = fetched['etag']
+        result['last_modified'] = fetched['last_modified']
+        result['headers'] = fetched['headers']
+        if fetched['status'] == 304:
+            return result
+        if expected is not None and fetched['digest'] != expected['digest']:
+            silent_remove_file(part_file)
+            result['error'] = "checksum mismatch: expected " + expected['digest'] + ", got " + fetched['digest']
+            return result
+        try:
+            os.replace(part_file, dest)
+        except OSError as e:
+            result['error'] = str(e)
+        return result
+
+    def download_many(self, jobs, progress=None):
+        """
+        Downloads many files concurrently.
+        :param jobs: iterable of dicts with 'url', 'dest' and optional 'checksum' keys, or tuples (url, dest)
+        :param progress: see download()
+        :return: list of results of download() in the order of 'jobs'
+        """
+        from concurrent import futures
+        jobs = [j if isinstance(j, dict) else {'url': j[0], 'dest': j[1]} for j in jobs]
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='lolly_download') as pool:
+            submitted = [pool.submit(self.download, j['url'], j['dest'], j.get('checksum'), progress) for j in jobs]
+            return [f.result() for f in submitted]
+
+    # PRIVATE METHODS
+
+    def _request(self, url, headers):
+        """
+        Sends GET request following redirects.
+        :return: tuple (response, connection key, connection); the response must be finished with _finish()
+        """
+        import urllib.parse
+        for redirect in range(_DOWNLOAD_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise DownloadError("unsupported url '" + url + "'", retry=False)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            key, conn = self._pool.acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+            if response.status not in _DOWNLOAD_REDIRECT_CODES:
+                return response, key, conn
+            location = response.getheader('Location')
+            self._finish(response, key, conn)
+            if not location:
+                raise DownloadError("redirect without location", retry=False, status=response.status)
+            url = urllib.parse.urljoin(url, location)
+        raise DownloadError("too many redirects", retry=False)
+
+    def _finish(self, response, key, conn, drain=True):
+        """ Returns connection to the pool if it can be reused. """
+        import http.client
+        try:
+            if drain:
+                response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            return
+        if response.will_close:
+            conn.close()
+        else:
+            self._pool.release(key, conn)
+
+    def _fetch(self, url, part_file, expected, progress, extra_headers):
+        import hashlib
+        offset = os.path.getsize(part_file) if file_exists(part_file) else 0
+        headers = dict(self.headers)
+        headers.update(extra_headers or {})
+        conditional = 'If-None-Match' in headers or 'If-Modified-Since' in headers
+        if offset:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+        response, key, conn = self._request(url, headers)
+        status = response.status
+        validators = {'etag': response.getheader('ETag', ''), 'last_modified': response.getheader('Last-Modified', ''),
+                      'headers': response.msg}
+        total = None
+        if status == 304 and conditional:
+            self._finish(response, key, conn)
+            return dict(validators, status=status, resumed=False, bytes=0, digest='')
+        elif status == 206:
+            content_range = response.getheader('Content-Range', '')
+            try:
+                first, last, size = [s for s in content_range.replace('bytes', '').replace('/', '-').split('-')]
+                first = int(first)
+                total = None if size.strip() == '*' else int(size)
+            except ValueError:
+                first = -1
+            if first != offset:
+                conn.close()
+                silent_remove_file(part_file)
+                raise DownloadError("unexpected Content-Range '" + content_range + "'", status=status)
+        elif status == 200:
+            offset = 0  # server ignored Range, start over
+            length = response.getheader('Content-Length')
+            total = int(length) if length and length.isdigit() else None
+        elif status == 416 and offset:
+            self._finish(response, key, conn)
+            silent_remove_file(part_file)  # stale partial download, start over
+            raise DownloadError("requested range not satisfiable", status=status)
+        else:
+            self._finish(response, key, conn)
+            raise DownloadError('HTTP ' + str(status) + ' ' + response.reason,
+                                retry=status >= 500 or status == 429, status=status)
+
+        hasher = None
+        if expected is not None:
+            hasher = hashlib.new(expected['algorithm'])
+            if offset:
+                with open(part_file, 'rb') as f:
+                    for block in iter(lambda: f.read(self.chunk_size), b''):
+                        hasher.update(block)
+        done = offset
+        try:
+            with open(part_file, 'ab' if offset else 'wb') as f:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    done += len(chunk)
+                    if progress is not None:
+                        progress(url, done, total)
+        except Exception:
+            conn.close()
+            raise
+        if total is not None and done < total:
+            conn.close()
+            raise DownloadError("connection closed after " + str(done) + " of " + str(total) + " bytes",
+                                status=status)
+        self._finish(response, key, conn, drain=False)
+        return dict(validators, status=status, resumed=status == 206, bytes=done,
+                    digest=hasher.hexdigest() if hasher is not None else '')
+
+
+_default_download_manager = None
+_default_download_manager_lock = threading.Lock()
+
+
+def silentDownloadFile(fileUrl, destFileName):
+    """
+    Downloads single file (do not raise exceptions). http and https urls are downloaded with the shared
+    DownloadManager, other urls (e.g. file:// or ftp://) with urllib.request.urlretrieve().
+    :return: tuple ('destFileName', headers of the response) like urllib.request.urlretrieve()
+             if success or [''] otherwise
+    """
+    import urllib.parse
+    global _default_download_manager
+    if urllib.parse.urlsplit(fileUrl).scheme not in ('http', 'https'):
+        import urllib.request
+        try:
+            return urllib.request.urlretrieve(fileUrl, destFileName)
+        except (OSError, ValueError):
+            return ['']
+    with _default_download_manager_lock:
+        if _default_download_manager is None:
+            _default_download_manager = DownloadManager()
+    result = _default_download_manager.download(fileUrl, destFileName)
+    if result['error']:
+        silent_remove_file(destFileName + '.part')  # nobody resumes it
+        return ['']
+    return destFileName, result['headers']
+
+
+def _lock_modules():
+    """ :return: tuple (fcntl module or None, msvcrt module or None) """
+    try:
+        import fcntl
+        return fcntl, None
+    except ImportError:  # Windows
+        import msvcrt
+        return None, msvcrt
+
+
+class FileLock:
+    """
+    Exclusive lock on a file shared by threads and processes (fcntl.flock on POSIX, msvcrt.locking on Windows).
+    Use as a context manager; the lock file is created if it does not exist and is never removed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl, msvcrt = _lock_modules()
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK gives up after 10 seconds
+                        pass
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            fcntl, msvcrt = _lock_modules()
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+
+class DownloadCache:
+    """
+    On-disk content-addressed cache of downloaded files that may be shared by many processes.
+
+    Layout of 'cache_dir':
+        objects/ab/abcdef...  file contents named by their sha256, files with same contents are stored once;
+        entries/<sha256 of url>.json  url, validators (ETag, Last-Modified) and object of the last response;
+        tmp/  downloads in progress;
+        lock  file lock that guards entries and objects; it is never held during network transfers.
+    Least recently used objects are evicted when total size exceeds 'max_bytes' (use time is the object mtime).
+    """
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, max_age=0, manager=None):
+        """
+        :param cache_dir: cache directory, created if needed
+        :param max_bytes: size limit of stored objects
+        :param max_age: seconds during which a cached file is used without revalidation; with 0 every fetch()
+                        makes a conditional request, which costs a round-trip with 304 response if nothing changed
+        :param manager: DownloadManager used for requests, a private one by default
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._own_manager = manager is None
+        self._manager = DownloadManager() if manager is None else manager
+        for d in ('objects', 'entries', 'tmp'):
+            silent_create_path(cache_dir + '/' + d)
+        self._lock_file = cache_dir + '/lock'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Closes connections of the private DownloadManager.
+        :return: None
+        """
+        if self._own_manager:
+            self._manager.close()
+
+    def fetch(self, url, dest, max_age=None):
+        """
+        Copies file at 'url' to 'dest', downloading it only if the cached copy is missing or outdated.
+        :param url: http or https url
+        :param dest: destination file name
+        :param max_age: overrides max_age of the cache for this call
+        :return: Dict - 'url'; 'dest'; 'bytes': file size; 'digest': sha256 of the file;
+                        'source': 'cache' (fresh, no request made), 'revalidated' (304 response) or 'network';
+                        'error': empty string if success or error message otherwise;
+        """
+        import tempfile
+        result = {'url': url, 'dest': dest, 'bytes': 0, 'digest': '', 'source': '', 'error': ''}
+        max_age = self.max_age if max_age is None else max_age
+        entry_file = self._entry_file(url)
+        with FileLock(self._lock_file):
+            entry = self._load_entry(entry_file)
+        now = time.time()
+        if entry is not None and now - entry['checked'] < max_age:
+            result['source'] = 'cache'
+            return self._deliver(entry, result)
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir + '/tmp')
+        os.close(fd)
+        try:
+            downloaded = self._manager.download(url, tmp_file, headers=headers)
+            if downloaded['error']:
+                result['error'] = downloaded['error']
+                return result
+            if downloaded['status'] == 304:
+                entry['checked'] = now
+                with FileLock(self._lock_file):
+                    self._save_entry(entry_file, entry)
+                result['source'] = 'revalidated'
+                return self._deliver(entry, result)
+            digest = file_digest(tmp_file)
+            entry = {'url': url, 'etag': downloaded['etag'], 'last_modified': downloaded['last_modified'],
+                     'digest': digest, 'size': downloaded['bytes'], 'checked': now}
+            with FileLock(self._lock_file):
+                object_file = self._object_file(digest)
+                if file_exists(object_file):
+                    os.utime(object_file)
+                else:
+                    silent_create_path(path_base_and_leaf(object_file)['base'])
+                    os.replace(tmp_file, object_file)
+                self._save_entry(entry_file, entry)
+                self._evict(self.max_bytes, keep=digest)
+        finally:
+            silent_remove_file(tmp_file)
+            silent_remove_file(tmp_file + '.part')
+        result['source'] = 'network'
+        return self._deliver(entry, result)
+
+    def evict(self, max_bytes=None):
+        """
+        Removes least recently used objects until their total size is not greater than 'max_bytes'.
+        :param max_bytes: size limit, max_bytes of the cache by default; 0 empties the cache
+        :return: Dict - 'removed': number of removed objects; 'bytes': total size of remaining objects;
+        """
+        with FileLock(self._lock_file):
+            return self._evict(self.max_bytes if max_bytes is None else max_bytes)
+
+    def stats(self):
+        """
+        :return: Dict - 'entries': number of cached urls; 'objects': number of stored files; 'bytes': their size;
+        """
+        objects = self._list_objects()
+        return {'entries': len(os.listdir(self.cache_dir + '/entries')), 'objects': len(objects),
+                'bytes': sum(o[1] for o in objects)}
+
+    # PRIVATE METHODS
+
+    def _entry_file(self, url):
+        import hashlib
+        return self.cache_dir + '/entries/' + hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json'
+
+    def _object_file(self, digest):
+        return self.cache_dir + '/objects/' + digest[:2] + '/' + digest
+
+    def _load_entry(self, entry_file):
+        import json
+        try:
+            with open(entry_file, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not file_exists(self._object_file(entry.get('digest', ''))):
+            return None  # object was evicted
+        return entry
+
+    def _save_entry(self, entry_file, entry):
+        import json
+        tmp_file = entry_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, entry_file)
+
+    def _deliver(self, entry, result):
+        import shutil
+        object_file = self._object_file(entry['digest'])
+        base = path_base_and_leaf(result['dest'])['base']
+        if base and not dir_exists(base):
+            silent_create_path(base)
+        tmp_dest = result['dest'] + '.part'
+        try:
+            with FileLock(self._lock_file):  # object may be evicted by another process otherwise
+                os.utime(object_file)  # mark as recently used
+                shutil.copyfile(object_file, tmp_dest)
+            os.replace(tmp_dest, result['dest'])
+        except OSError as e:
+            silent_remove_file(tmp_dest)
+            result['error'] = str(e)
+            return result
+        result['bytes'] = entry['size']
+        result['digest'] = entry['digest']
+        return result
+
+    def _list_objects(self):
+        """ :return: list of tuples (object file, size, mtime) """
+        objects = []
+        objects_dir = self.cache_dir + '/objects'
+        for sub_dir in os.listdir(objects_dir):
+            for name in os.listdir(objects_dir + '/' + sub_dir):
+                filename = objects_dir + '/' + sub_dir + '/' + name
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                objects.append((filename, st.st_size, st.st_mtime))
+        return objects
+
+    def _evict(self, max_bytes, keep=None):
+        objects = self._list_objects()
+        total = sum(o[1] for o in objects)
+        removed = 0
+        for filename, size, mtime in sorted(objects, key=lambda o: o[2]):
+            if total <= max_bytes:
+                break
+            if keep is not None and filename.endswith('/' + keep):
+                continue
+            if not silent_remove_file(filename)['error']:
+                total -= size
+                removed += 1
+        return {'removed': removed, 'bytes': total}
+
+
 # ---------------------------------------------------------------------------------------------------------------------
 # Git operations (simplified)
 
@@ -759,11 +2078,124 @@ def gitClone(gitUrl, path):
 def gitPull(path):
     if not dir_exists(path):
         return
-    oldPath = os.getcwd()
-    os.chdir(path)
-    cmd = ['git', 'pull']
+    cmd = ['git', '-C', path, 'pull']
     executeShellCmd(cmd)
-    os.chdir(oldPath)
+
+
+# Batch git operations
+#
+# git_sync_repos() clones missing repositories and fast-forwards existing ones, each repository in its own
+# git subprocess running in a bounded thread pool. Commands address the repository with 'git -C', so the
+# process working directory is never changed, and existing checkouts are never removed.
+
+_GIT_ENV_OVERRIDES = {'GIT_TERMINAL_PROMPT': '0'}  # fail instead of waiting for credentials
+
+
+def _run_git(args, deadline):
+    """
+    Runs git command until 'deadline' (time.monotonic() value).
+    :return: Dict - 'output': stdout and stderr; 'error': empty string if success or error message otherwise;
+    """
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        return {'output': '', 'error': 'timeout'}
+    result = run_command(['git'] + args, timeout=timeout, env=_GIT_ENV_OVERRIDES)
+    return {'output': result['stdout'] + result['stderr'], 'error': result['error']}
+
+
+def _git_head(path, deadline):
+    rev = _run_git(['-C', path, 'rev-parse', '--verify', '-q', 'HEAD'], deadline)
+    return rev['output'].strip() if not rev['error'] else ''
+
+
+def git_sync_repo(url, path, branch=None, depth=None, filter_spec=None, timeout=600):
+    """
+    Clones repository into 'path' if it is not a git checkout yet, otherwise fetches and fast-forwards
+    the current branch to its upstream (local changes are kept, diverged branches are reported as errors).
+    :param url: repository url
+    :param path: checkout directory; it must not exist or be empty for cloning
+    :param branch: branch to clone, remote HEAD by default
+    :param depth: if set, shallow clone with history truncated to 'depth' commits
+    :param filter_spec: partial clone filter, e.g. 'blob:none'
+    :param timeout: time limit in seconds for all git commands of the repository
+    :return: Dict - 'url'; 'path'; 'action': 'clone' or 'update'; 'changed': True if HEAD moved;
+                    'old_rev' and 'new_rev': HEAD commit before and after, empty string if none;
+                    'output': git output; 'duration': seconds;
+                    'error': empty string if success or error message otherwise;
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    result = {'url': url, 'path': path, 'action': '', 'changed': False, 'old_rev': '', 'new_rev': '',
+              'output': '', 'duration': 0.0, 'error': ''}
+    if dir_exists(path + '/.git') or file_exists(path + '/.git'):
+        result['action'] = 'update'
+        result['old_rev'] = _git_head(path, deadline)
+        # no --depth here: fetching into a shallow checkout brings only new commits and keeps them
+        # connected to the existing history, while --depth would cut the history and break fast-forward
+        commands = [['-C', path, 'fetch', '--prune', 'origin'], ['-C', path, 'merge', '--ff-only', '@{upstream}']]
+    else:
+        result['action'] = 'clone'
+        clone = ['clone', '--quiet']
+        if depth:
+            clone.append('--depth=' + str(depth))
+        if filter_spec:
+            clone.append('--filter=' + filter_spec)
+        if branch:
+            clone += ['--branch', branch]
+        commands = [clone + ['--', url, path]]
+    for args in commands:
+        run = _run_git(args, deadline)
+        result['output'] += run['output']
+        if run['error']:
+            result['error'] = run['error']
+            break
+    if not result['error'] or result['action'] == 'update':
+        result['new_rev'] = _git_head(path, time.monotonic() + 30)
+    result['changed'] = result['new_rev'] != result['old_rev'] and not result['error']
+    result['duration'] = time.monotonic() - started
+    return result
+
+
+def git_sync_repos(repos, max_workers=8, depth=None, filter_spec=None, timeout=600, progress=None):
+    """
+    Clones or updates many repositories in parallel, see git_sync_repo().
+    :param repos: iterable of dicts with 'url', 'path' and optional 'branch', 'depth', 'filter' and 'timeout' keys
+                  (overriding arguments of this function), or tuples (url, path)
+    :param max_workers: max number of git subprocesses running at the same time
+    :param depth: default depth of shallow clones, None for full history
+    :param filter_spec: default partial clone filter
+    :param timeout: default per-repository time limit in seconds
+    :param progress: optional callable progress(result) called from worker threads as each repository is done
+    :return: Dict - 'results': list of git_sync_repo() results in the order of 'repos';
+                    'cloned', 'updated', 'unchanged', 'failed': numbers of repositories;
+                    'error': empty string if all repositories succeeded or summary of failures otherwise;
+    """
+    from concurrent import futures
+    jobs = [r if isinstance(r, dict) else {'url': r[0], 'path': r[1]} for r in repos]
+
+    def sync(job):
+        result = git_sync_repo(job['url'], job['path'], job.get('branch'), job.get('depth', depth),
+                               job.get('filter', filter_spec), job.get('timeout', timeout))
+        if progress is not None:
+            progress(result)
+        return result
+
+    summary = {'results': [], 'cloned': 0, 'updated': 0, 'unchanged': 0, 'failed': 0, 'error': ''}
+    if jobs:
+        with futures.ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='lolly_git') as pool:
+            summary['results'] = list(pool.map(sync, jobs))
+    for r in summary['results']:
+        if r['error']:
+            summary['failed'] += 1
+        elif r['action'] == 'clone':
+            summary['cloned'] += 1
+        elif r['changed']:
+            summary['updated'] += 1
+        else:
+            summary['unchanged'] += 1
+    if summary['failed']:
+        summary['error'] = str(summary['failed']) + ' of ' + str(len(jobs)) + ' repositories failed'
+    return summary
 
 
 # ---------------------------------------------------------------------------------------------------------------------
@@ -784,9 +2216,170 @@ def gitPull(path):
 
 # ---------------------------------------------------------------------------------------------------------------------
 # Date and time
+#
+# Wall clock time is read through a Clock object, so that it may be injected (see set_clock() and FixedClock).
+# ClockSnapshot captures one moment and formats all derived strings once: everything rendered from
+# the same snapshot shows the same date and time, even if rendering straddles a second or day boundary.
+
+
+class ClockSnapshot:
+    """
+    One moment of wall clock time in UTC and its string representations:
+    'year', 'date', 'datetime', 'time' and 'timestamp_millis' (integer).
+    """
+    def __init__(self, moment):
+        """
+        :param moment: timezone aware datetime.datetime
+        """
+        import datetime
+        moment = moment.astimezone(datetime.timezone.utc)
+        self.moment = moment
+        self.year = str(moment.year)
+        self.date = str(moment.date())
+        self.datetime = str(moment)
+        self.time = str(moment.time())[0:8] + ' UTC+00:00'
+        self.timestamp_millis = int(round(moment.timestamp() * 1000))
+
+
+class Timer:
+    """
+    Measures elapsed time with a monotonic high resolution clock. May be used as a context manager.
+    """
+    def __init__(self, clock=None):
+        self._clock = clock if clock is not None else get_clock()
+        self.started = self._clock.monotonic()
+        self.stopped = None
+
+    def __enter__(self):
+        self.started = self._clock.monotonic()
+        self.stopped = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def stop(self):
+        """
+        :return: elapsed seconds
+        """
+        self.stopped = self._clock.monotonic()
+        return self.elapsed
+
+    @property
+    def elapsed(self):
+        """ Seconds since start, until stop() if the timer is stopped. """
+        end = self.stopped if self.stopped is not None else self._clock.monotonic()
+        return end - self.started
+
+
+class Clock:
+    """
+    System clock: wall clock time in UTC and monotonic time for measuring intervals.
+    """
+    def now_utc(self):
+        """
+        :return: timezone aware datetime.datetime
+        """
+        import datetime
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def snapshot(self):
+        """
+        :return: ClockSnapshot of current moment
+        """
+        return ClockSnapshot(self.now_utc())
+
+    def time(self):
+        """
+        :return: seconds since the epoch as float, without creating datetime objects
+        """
+        return time.time()
+
+    def timestamp_millis(self):
+        """
+        :return: milliseconds since the epoch as int, without creating datetime objects
+        """
+        return time.time_ns() // 1000000
+
+    def monotonic(self):
+        """
+        :return: seconds of a monotonic high resolution clock, only differences between values are meaningful
+        """
+        return time.perf_counter()
+
+    def timer(self):
+        """
+        :return: started Timer
+        """
+        return Timer(self)
+
+
+class FixedClock(Clock):
+    """
+    Clock that always shows the same wall clock time, e.g. to render a batch of templates with one
+    timestamp or to make tests reproducible. Monotonic time is not affected.
+    """
+    def __init__(self, moment=None):
+        """
+        :param moment: timezone aware datetime.datetime, ISO 8601 string (UTC if no offset is given)
+                       or None to fix current moment
+        """
+        import datetime
+        if moment is None:
+            moment = Clock().now_utc()
+        elif isinstance(moment, str):
+            moment = datetime.datetime.fromisoformat(moment)
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        self._snapshot = ClockSnapshot(moment)
+
+    def now_utc(self):
+        return self._snapshot.moment
+
+    def snapshot(self):
+        return self._snapshot  # formatted once for all users of the clock
+
+    def time(self):
+        return self._snapshot.moment.timestamp()
+
+    def timestamp_millis(self):
+        return self._snapshot.timestamp_millis
+
+
+_clock = Clock()
+
+
+def get_clock():
+    """
+    :return: Clock used by the functions below and by default by LollyWiz
+    """
+    return _clock
+
+
+def set_clock(clock=None):
+    """
+    Replaces the default clock.
+    :param clock: Clock or None to restore the system clock
+    :return: None
+    """
+    global _clock
+    _clock = clock if clock is not None else Clock()
+
 
 def utc_timestamp_millis():
-    return int(round(time.time() * 1000))
+    """
+    Current wall clock time as milliseconds since the epoch; use monotonic_millis() to measure intervals.
+    :return: int
+    """
+    return get_clock().timestamp_millis()
+
+
+def monotonic_millis():
+    """
+    Milliseconds of a monotonic clock, only differences between values are meaningful.
+    :return: float
+    """
+    return get_clock().monotonic() * 1000
 
 
 def current_year_utc():
@@ -794,7 +2387,7 @@ def current_year_utc():
     Current year in time zone UTC+00::00 as a string
     :return: string
     """
-    return str(datetime.datetime.now(datetime.timezone.utc).year)
+    return get_clock().snapshot().year
 
 
 def current_date_utc():
@@ -802,7 +2395,7 @@ def current_date_utc():
     Current date in time zone UTC+00::00 as a string
     :return: string
     """
-    return str(datetime.datetime.now(datetime.timezone.utc).date())
+    return get_clock().snapshot().date
 
 
 def current_datetime_utc():
@@ -810,7 +2403,7 @@ def current_datetime_utc():
     Current date and time in time zone UTC+00::00 as a string
     :return: string
     """
-    return str(datetime.datetime.now(datetime.timezone.utc))
+    return get_clock().snapshot().datetime
 
 
 def current_time_utc():
@@ -818,7 +2411,30 @@ def current_time_utc():
     Current time in time zone UTC+00::00 as a string
     :return: string
     """
-    return str(datetime.datetime.now(datetime.timezone.utc).time())[0:8] + ' UTC+00:00'
+    return get_clock().snapshot().time
+
+# ---------------------------------------------------------------------------------------------------------------------
+# Metrics
+
+
+_metrics = None  # lolly_metrics.LollyMetrics fed by file functions above, sources and LollyWiz; None when disabled
+
+
+def get_metrics():
+    """
+    :return: lolly_metrics.LollyMetrics or None if metrics are not collected
+    """
+    return _metrics
+
+
+def set_metrics(metrics=None):
+    """
+    Sets metrics fed by lollylib, see lolly_metrics.enable().
+    :param metrics: lolly_metrics.LollyMetrics or None to stop collecting
+    :return: None
+    """
+    global _metrics
+    _metrics = metrics
 
 # ---------------------------------------------------------------------------------------------------------------------
 # Project-exclusive
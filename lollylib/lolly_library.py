@@ -0,0 +1,169 @@
+"""
+Mini template library that is shipped with lollylib, see LollyWiz.set_src_from_lib().
+
+Templates are kept as loose files in assets/lollywiz_templates and are precompiled by a build step
+into assets/lollywiz_compiled/<template name>.lwc: raw contents of all template files together with
+compiled form of the text ones (see LollyWiz._compile_template()), so instantiation of a library template
+does not parse conditional directives and does not touch the template directory.
+Run the build step after changing any library template:
+    python -m lollylib.lolly_library
+"""
+import os
+import ntpath
+import threading
+from . import lolly_helpers
+from . import lolly_source
+from . import lolly_render
+
+TEMPLATES_DIR = 'assets/lollywiz_templates'
+COMPILED_DIR = 'assets/lollywiz_compiled'
+COMPILED_EXTENSION = '.lwc'
+FORMAT_VERSION = 2  # 2: instruction files with includes are refused
+
+_registry = {}  # template name: lolly_source.PrecompiledSource, filled on first use of each template
+_registry_lock = threading.Lock()
+
+
+def _package_dir():
+    head, tail = ntpath.split(os.path.realpath(__file__))
+    return head
+
+
+def _read_resource(resource):
+    """
+    Reads a file shipped with lollylib, whether the package is a directory or is imported from a zip file.
+    :param resource: path relative to the package
+    :return: bytes or None if the resource does not exist
+    """
+    try:
+        import importlib.resources
+        node = importlib.resources.files('lollylib')
+        for part in resource.split('/'):
+            node = node.joinpath(part)
+        return node.read_bytes()
+    except (ImportError, AttributeError, TypeError):  # package is not importable or python is older than 3.9
+        pass
+    except OSError:
+        return None
+    try:
+        with open(_package_dir() + '/' + resource, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def get_template(name):
+    """
+    Returns precompiled library template, loading it on first use.
+    :param name: template name, e.g. 'git'
+    :return: lolly_source.PrecompiledSource or None if the template was not precompiled
+    """
+    import pickle
+    with _registry_lock:
+        if name in _registry:
+            return _registry[name]
+        source = None
+        data = _read_resource(COMPILED_DIR + '/' + name + COMPILED_EXTENSION)
+        if data is not None:
+            try:
+                compiled = pickle.loads(data)
+            except Exception:
+                compiled = None
+            if compiled is not None and compiled.get('format') == FORMAT_VERSION:
+                source = lolly_source.PrecompiledSource(compiled)
+        _registry[name] = source
+        return source
+
+
+def clear_registry():
+    """
+    Forgets loaded templates, so they are loaded again on next use (e.g. after the build step).
+    :return: None
+    """
+    with _registry_lock:
+        _registry.clear()
+
+
+def compile_template_dir(src_dir, name):
+    """
+    Compiles template located in 'src_dir'.
+    :param src_dir: template directory that contains lollywiz.txt
+    :param name: template name
+    :return: Dict - 'compiled': Dict that can be passed to lolly_source.PrecompiledSource;
+                    'error': empty string if success or error message otherwise;
+    """
+    from .lolly_wiz import LollyWiz
+    result = {'compiled': None, 'error': ''}
+    wiz = LollyWiz()
+    source = lolly_source.DirSource(src_dir, cache=False)
+    if source.get_item_type(wiz.INSTRUCTION_FILE_NAME)['type'] != 'file':
+        result['error'] = "instruction file '" + source.describe(wiz.INSTRUCTION_FILE_NAME) + "' does not exist"
+        return result
+    files = {}
+    compiled = {}
+    for path, item_type in source.walk(''):
+        if item_type != 'file':
+            continue
+        data = source.read_binary_file(path)
+        if data['error']:
+            result['error'] = "can't read file '" + source.describe(path) + "': " + data['error']
+            return result
+        files[path] = data['contents']
+        try:
+            text = lolly_source._decode_text(data['contents'])
+        except UnicodeDecodeError:
+            continue  # binary files can only be copied
+        segments = wiz._compile_template(text, source.describe(path))
+        if segments is None:
+            result['error'] = "can't compile template '" + source.describe(path) + "'"
+            return result
+        if path == wiz.INSTRUCTION_FILE_NAME and lolly_render.has_includes(segments):
+            result['error'] = "'include' is not supported in instruction file '" + source.describe(path) + "'"
+            return result
+        compiled[path] = segments
+    result['compiled'] = {'format': FORMAT_VERSION, 'name': name, 'options': dict(wiz.OPTIONS),
+                          'files': files, 'compiled': compiled}
+    return result
+
+
+def build_library(templates_dir=None, compiled_dir=None):
+    """
+    The build step: precompiles every template of the library.
+    :param templates_dir: directory of template directories, lollylib/assets/lollywiz_templates by default
+    :param compiled_dir: output directory, lollylib/assets/lollywiz_compiled by default
+    :return: Dict - 'built': list of template names;
+                    'error': empty string if success or error message otherwise;
+    """
+    import pickle
+    result = {'built': [], 'error': ''}
+    if templates_dir is None:
+        templates_dir = _package_dir() + '/' + TEMPLATES_DIR
+    if compiled_dir is None:
+        compiled_dir = _package_dir() + '/' + COMPILED_DIR
+    if not lolly_helpers.dir_exists(templates_dir):
+        result['error'] = "templates directory '" + templates_dir + "' does not exist"
+        return result
+    lolly_helpers.silent_create_path(compiled_dir)
+    for name in sorted(os.listdir(templates_dir)):
+        if not lolly_helpers.dir_exists(templates_dir + '/' + name):
+            continue
+        compiled = compile_template_dir(templates_dir + '/' + name, name)
+        if compiled['error']:
+            result['error'] = compiled['error']
+            return result
+        data = pickle.dumps(compiled['compiled'], protocol=4)
+        written = lolly_helpers.silent_write_binary_file(compiled_dir + '/' + name + COMPILED_EXTENSION, data)
+        if written['error']:
+            result['error'] = written['error']
+            return result
+        result['built'].append(name)
+    clear_registry()
+    return result
+
+
+if __name__ == '__main__':
+    built = build_library()
+    if built['error']:
+        print('* lolly_library build error: ', built['error'])
+    else:
+        print('* lolly_library: precompiled templates: ', ', '.join(built['built']))
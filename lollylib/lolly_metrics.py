@@ -0,0 +1,356 @@
+"""
+Runtime metrics of long-running generators (render servers, watchers) in Prometheus text format.
+
+    metrics = lolly_metrics.enable()          # LollyMetrics fed by LollyWiz, template sources and lolly_helpers
+    ...
+    metrics.registry.write('/var/lib/node_exporter/lollywiz.prom')    # for the textfile collector
+    lolly_metrics.MetricsServer(metrics.registry, ('127.0.0.1', 9464)).start()   # or scrape GET /metrics
+
+Counters and histograms aggregate per thread: every thread updates its own shard without taking a lock,
+shards are summed when metrics are collected. Shards of finished threads are folded into a total, so short-lived
+worker threads do not accumulate. Nothing is measured until enable() is called.
+"""
+import bisect
+import http.server
+import math
+import os
+import threading
+from . import lolly_helpers
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+    """
+    Base of metrics with per-thread shards; a shard is a dict: tuple of label values: value.
+    Subclasses implement _merge().
+    """
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []  # (thread, shard) of threads that recorded values
+        self._total = {}  # values of finished threads
+        self._lock = threading.Lock()  # guards the list of shards and the total
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            with self._lock:
+                self._fold_finished()
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+            return shard
+
+    def _collect_shards(self):
+        with self._lock:
+            self._fold_finished()
+            # copying a dict is atomic, owners may update it meanwhile
+            return [dict(self._total)] + [dict(shard) for thread, shard in self._shards]
+
+    def _fold_finished(self):
+        """ Merges shards of finished threads into the total, the lock must be held. """
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for labels, value in shard.items():
+                    self._total[labels] = self._merge(self._total.get(labels), value)
+        self._shards = live
+
+    def _merge(self, total, value):
+        """
+        :param total: value in the total or None
+        :param value: value of a shard
+        :return: new value in the total
+        """
+        raise NotImplementedError
+
+    def _labels_text(self, labels, extra=''):
+        pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value, e.g. number of rendered templates.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """
+        :param amount: non-negative number
+        :param labels: tuple of label values, one for each of labelnames
+        """
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self):
+        """
+        :return: Dict - tuple of label values: sum over all threads
+        """
+        totals = {}
+        for shard in self._collect_shards():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def value(self, labels=()):
+        return self.values().get(labels, 0)
+
+    def _merge(self, total, value):
+        return value if total is None else total + value
+
+    def render(self):
+        lines = []
+        for labels, value in sorted(self.values().items()):
+            lines.append(self.name + self._labels_text(labels) + ' ' + _format_value(value))
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. durations in seconds) in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """
+        :param value: observed value
+        :param labels: tuple of label values, one for each of labelnames
+        """
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # buckets, +Inf, sum
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def values(self):
+        """
+        :return: Dict - tuple of label values: Dict 'buckets': list of cumulative counts (last one is +Inf);
+                                                    'count': number of observations; 'sum': sum of observations;
+        """
+        totals = {}
+        for shard in self._collect_shards():
+            for labels, counts in shard.items():
+                counts = list(counts)
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = counts
+                else:
+                    totals[labels] = [a + b for a, b in zip(total, counts)]
+        result = {}
+        for labels, counts in totals.items():
+            cumulative = []
+            running = 0
+            for count in counts[:-1]:
+                running += count
+                cumulative.append(running)
+            result[labels] = {'buckets': cumulative, 'count': running, 'sum': counts[-1]}
+        return result
+
+    def _merge(self, total, value):
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+    def render(self):
+        lines = []
+        for labels, value in sorted(self.values().items()):
+            bounds = [_format_value(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, value['buckets']):
+                lines.append(self.name + '_bucket' + self._labels_text(labels, 'le="' + bound + '"') + ' ' +
+                             str(count))
+            lines.append(self.name + '_sum' + self._labels_text(labels) + ' ' + _format_value(value['sum']))
+            lines.append(self.name + '_count' + self._labels_text(labels) + ' ' + str(value['count']))
+        return lines
+
+
+class Registry:
+    """
+    Named metrics exported together.
+    """
+    def __init__(self):
+        self._metrics = {}  # name: metric, in order of registration
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        :return: Counter 'name', created if it's not registered yet
+        """
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :return: Histogram 'name', created if it's not registered yet
+        """
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        :return: all metrics in Prometheus text exposition format 0.0.4
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            help_text = metric.documentation.replace('\\', r'\\').replace('\n', r'\n')
+            lines.append('# HELP ' + metric.name + ' ' + help_text)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        Writes render() to a file atomically, so a scraper never reads a partial file.
+        :return: Dict - 'error': empty string if success, or error message otherwise.
+        """
+        tmp_filename = filename + '.tmp.' + str(os.getpid())
+        result = lolly_helpers.silent_write_text_file(tmp_filename, self.render())
+        if result['error']:
+            return result
+        try:
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            lolly_helpers.silent_remove_file(tmp_filename)
+            result['error'] = str(e)
+        return result
+
+    def _register(self, cls, name, documentation, labelnames, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, *args)
+        return metric
+
+
+class LollyMetrics:
+    """
+    Metrics collected by lollylib when set with lolly_helpers.set_metrics() (see enable()).
+    """
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else Registry()
+        r = self.registry
+        self.instantiations = r.counter('lollywiz_instantiations_total', 'Finished LollyWiz instantiations.')
+        self.templates_rendered = r.counter('lollywiz_templates_rendered_total', 'Rendered template files.')
+        self.instruction_seconds = r.histogram('lollywiz_instruction_duration_seconds',
+                                               'Duration of lollywiz.txt instructions.', ('cmd',))
+        self.errors = r.counter('lollywiz_errors_total', 'LollyWiz errors by category.', ('category',))
+        self.bytes_read = r.counter('lollylib_read_bytes_total', 'Bytes read from files and template sources.')
+        self.bytes_written = r.counter('lollylib_written_bytes_total', 'Bytes written to files.')
+        self.cache_requests = r.counter('lollylib_cache_requests_total', 'Cache lookups by cache and result.',
+                                        ('cache', 'result'))
+
+    def cache_lookup(self, cache, hit):
+        """
+        :param cache: name of the cache, e.g. 'read', 'compiled', 'instructions'
+        :param hit: True if the value was found
+        """
+        self.cache_requests.inc(1, (cache, 'hit' if hit else 'miss'))
+
+
+def enable(registry=None):
+    """
+    Starts collecting lollylib metrics: sets new LollyMetrics as lolly_helpers.set_metrics().
+    LollyWiz objects created before use metrics set with LollyWiz.set_metrics() only.
+    :param registry: Registry the metrics are registered in, a new one by default
+    :return: LollyMetrics
+    """
+    metrics = LollyMetrics(registry)
+    lolly_helpers.set_metrics(metrics)
+    return metrics
+
+
+def disable():
+    lolly_helpers.set_metrics(None)
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """
+    Serves GET /metrics on a local TCP port in a background thread.
+    """
+    def __init__(self, registry, address=('127.0.0.1', 0)):
+        """
+        :param address: tuple (host, port); port 0 selects a free port
+        """
+        self.registry = registry
+        self.address = address
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """
+        :return: Dict - 'address': (host, port) the server listens on;
+                        'error': empty string if success or error message otherwise;
+        """
+        result = {'address': None, 'error': ''}
+        try:
+            server = http.server.ThreadingHTTPServer(tuple(self.address), _MetricsRequestHandler)
+        except OSError as e:
+            result['error'] = str(e)
+            return result
+        server.daemon_threads = True
+        server.registry = self.registry
+        self.address = server.server_address[:2]
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, name='lolly_metrics', daemon=True)
+        self._thread.start()
+        result['address'] = self.address
+        return result
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
@@ -0,0 +1,165 @@
+"""
+Opt-in profiling of LollyWiz.instantiate().
+
+    profiler = lolly_profile.Profiler(memory=True)
+    wiz.set_profiler(profiler)
+    wiz.instantiate()
+    profiler.write('/tmp/lollywiz_profile')  # writes lollywiz_profile.pstats and lollywiz_profile_memory.txt
+
+Every phase of instantiation (parsing of lollywiz.txt, batch prerendering, each instruction) is a section
+with its own cProfile.Profile, so time is attributed to individual instructions and their templates.
+With memory=True tracemalloc is running during instantiation and the peak and net allocations of each
+section are recorded. Without a profiler LollyWiz does not call anything from this module.
+"""
+import contextlib
+from . import lolly_helpers
+
+
+class Profiler:
+    """
+    Collects cProfile statistics and optionally tracemalloc peaks of profiled sections.
+    Sections must not be nested, only one profiler may be active at a time.
+    """
+    def __init__(self, memory=False, top=20):
+        """
+        :param memory: trace memory allocations with tracemalloc
+        :param top: number of functions and allocation sites listed in the memory report
+        """
+        self.memory = memory
+        self.top = top
+        self.sections = []  # Dicts - 'name', 'duration', 'memory_peak', 'memory_allocated', 'stats'
+        self._started_tracemalloc = False
+        self._snapshot = None
+
+    def begin(self):
+        """
+        Starts tracemalloc if memory is traced (and it's not started already).
+        :return: None
+        """
+        if self.memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+
+    def end(self):
+        """
+        Takes snapshot of allocations and stops tracemalloc if begin() started it.
+        :return: None
+        """
+        if self.memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                import cProfile
+                import pstats
+                # allocations of the profiler itself and of imports are not interesting
+                self._snapshot = tracemalloc.take_snapshot().filter_traces(
+                    [tracemalloc.Filter(False, f) for f in (cProfile.__file__, pstats.__file__, __file__,
+                                                            tracemalloc.__file__, '<frozen importlib._bootstrap*')])
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """
+        Profiles the body of a with statement as section 'name'.
+        """
+        import cProfile
+        import pstats
+        tracing = False
+        if self.memory:
+            import tracemalloc
+            tracing = tracemalloc.is_tracing()
+            if tracing:
+                if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+                    tracemalloc.reset_peak()
+                memory_before = tracemalloc.get_traced_memory()[0]
+        profile = cProfile.Profile()
+        timer = lolly_helpers.Timer()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            section = {'name': name, 'duration': timer.stop(), 'memory_peak': 0, 'memory_allocated': 0,
+                       'stats': pstats.Stats(profile)}
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                section['memory_peak'] = peak
+                section['memory_allocated'] = current - memory_before
+            self.sections.append(section)
+
+    def stats(self):
+        """
+        :return: pstats.Stats of all sections or None if nothing was profiled
+        """
+        if not self.sections:
+            return None
+        import pstats
+        return pstats.Stats().add(*[section['stats'] for section in self.sections])
+
+    def report(self):
+        """
+        :return: Dict - 'sections': list of Dicts 'name', 'duration', 'memory_peak', 'memory_allocated';
+                        'duration': seconds of all sections; 'memory_peak': bytes, max of section peaks;
+        """
+        sections = [dict((key, s[key]) for key in ('name', 'duration', 'memory_peak', 'memory_allocated'))
+                    for s in self.sections]
+        return {'sections': sections, 'duration': sum(s['duration'] for s in sections),
+                'memory_peak': max([s['memory_peak'] for s in sections] or [0])}
+
+    def write(self, path_prefix):
+        """
+        Writes path_prefix + '.pstats' (may be loaded with pstats or snakeviz) and path_prefix + '_memory.txt'
+        with time and memory of each section, slowest functions and top allocation sites.
+        :param path_prefix: path of report files without extension
+        :return: Dict - 'pstats': file name; 'memory': file name; 'error': empty string or error message;
+        """
+        result = {'pstats': path_prefix + '.pstats', 'memory': path_prefix + '_memory.txt', 'error': ''}
+        stats = self.stats()
+        if stats is None:
+            result['error'] = 'nothing was profiled'
+            return result
+        try:
+            stats.dump_stats(result['pstats'])
+        except OSError as e:
+            result['error'] = "can't write '" + result['pstats'] + "': " + str(e)
+            return result
+        written = lolly_helpers.silent_write_text_file(result['memory'], self.format_report())
+        if written['error']:
+            result['error'] = "can't write '" + result['memory'] + "'"
+        return result
+
+    def format_report(self):
+        """
+        :return: text report, see write()
+        """
+        import io
+        report = self.report()
+        lines = ['LollyWiz profile: %.6f s, memory peak %s' % (report['duration'],
+                                                               _format_bytes(report['memory_peak'])),
+                 '',
+                 '%12s %12s %12s  %s' % ('seconds', 'peak', 'allocated', 'section')]
+        for s in sorted(report['sections'], key=lambda s: -s['duration']):
+            lines.append('%12.6f %12s %12s  %s' % (s['duration'], _format_bytes(s['memory_peak']),
+                                                   _format_bytes(s['memory_allocated']), s['name']))
+        if self._snapshot is not None:
+            lines += ['', 'Top allocation sites:']
+            for stat in self._snapshot.statistics('lineno')[:self.top]:
+                lines.append('    ' + str(stat))
+        stream = io.StringIO()
+        stats = self.stats()
+        if stats is not None:
+            stats.stream = stream
+            stats.sort_stats('cumulative').print_stats(self.top)
+            lines += ['', 'Slowest functions:', stream.getvalue()]
+        return '\n'.join(lines) + '\n'
+
+
+def _format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(n) < 1024:
+            return ('%d ' % n if unit == 'B' else '%.1f ' % n) + unit
+        n /= 1024.0
+    return '%.1f GiB' % n
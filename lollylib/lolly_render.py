@@ -0,0 +1,405 @@
+"""
+Rendering of compiled LollyWiz templates, in the current process or in a pool of worker processes.
+
+A compiled template (see LollyWiz._compile_template()) is a tuple of segments, where each segment is either
+a literal string, a tuple of (condition, text) pairs that represents one if/elif/else group (condition is None
+for 'else'), or an include segment (INCLUDE, path of the partial). Text of a block that contains includes
+is a tuple of segments itself. Include segments are replaced with partials by LollyWiz before rendering
+(see LollyWiz._link_partials_steps()), so rendered templates contain only tuples and strings and are cheap
+to pickle and to ship to worker processes.
+"""
+import os
+from . import lolly_helpers
+from . import lolly_source
+
+INCLUDE = 'include'
+
+
+def has_includes(compiled):
+    """
+    :param compiled: tuple of segments
+    :return: True if the template contains include segments
+    """
+    for segment in compiled:
+        if segment.__class__ is str:
+            continue
+        if segment[0] == INCLUDE:
+            return True
+        for condition, text in segment:
+            if text.__class__ is not str and has_includes(text):
+                return True
+    return False
+
+
+def used_keys(compiled, start_seq='[$$', end_seq='$$]'):
+    """
+    Key-usage index of a template: replacement keys that occur in any block of the template.
+    :param compiled: tuple of segments without include segments
+    :return: frozenset of keys, e.g. '[$$CLASS_NAME$$]'
+    """
+    import re
+    token = re.compile(re.escape(start_seq) + '.*?' + re.escape(end_seq), re.DOTALL)
+    keys = set()
+    _collect_keys(compiled, token, keys)
+    return frozenset(keys)
+
+
+def _collect_keys(compiled, token, keys):
+    for segment in compiled:
+        if segment.__class__ is str:
+            keys.update(token.findall(segment))
+            continue
+        for condition, text in segment:
+            if text.__class__ is str:
+                keys.update(token.findall(text))
+            else:
+                _collect_keys(text, token, keys)
+
+
+def render_compiled(compiled, definitions, replacement_dict):
+    """
+    Renders compiled template: selects matching blocks of each conditional group, then replaces keys.
+    The result is identical to LollyWiz._process_conditional_directives() followed by lolly_helpers.replace_keys().
+    :param compiled: tuple of segments without include segments
+    :param definitions: set (or list) of defined conditions
+    :param replacement_dict: dict of string:string pairs
+    :return: rendered string
+    """
+    parts = []
+    _render_segments(compiled, definitions, parts)
+    return lolly_helpers.replace_keys(''.join(parts), replacement_dict)
+
+
+def _render_segments(compiled, definitions, parts):
+    for segment in compiled:
+        if segment.__class__ is str:
+            parts.append(segment)
+            continue
+        if segment[0] == INCLUDE:
+            raise ValueError("include of '" + segment[1] + "' is not resolved")
+        for condition, text in segment:
+            if condition is None or condition in definitions:
+                if text.__class__ is str:
+                    parts.append(text)
+                else:
+                    _render_segments(text, definitions, parts)
+                break
+
+
+class CompiledEngine:
+    """
+    Default render engine of LollyWiz: a template is compiled once (compiled templates may be cached
+    by the template source) and rendered with render_compiled(), see LollyWiz.set_render_engine().
+
+    A render engine prepares a template once, then renders the prepared template any number of times
+    (e.g. for every item of 'inst_each'):
+        prepare_steps(wiz, src_filename) - generator in the style of LollyWiz instruction executors (it yields
+                                           file operations), returns prepared template or None in case of error
+                                           reported by 'wiz'
+        render(prepared, definitions, replacement_dict) - returns rendered string
+    Prepared templates of engines with batchable = True are compiled templates that may be rendered
+    by LollyWiz render backends (see ProcessPoolRenderer).
+    """
+    name = 'compiled'
+    batchable = True
+
+    def prepare_steps(self, wiz, src_filename):
+        return (yield from wiz._linked_template_steps(src_filename))
+
+    def render(self, prepared, definitions, replacement_dict):
+        return render_compiled(prepared, definitions, replacement_dict)
+
+
+class ReferenceEngine:
+    """
+    Renders templates the original way: LollyWiz._process_conditional_directives() on template text,
+    included partials are expanded in the processed text, then lolly_helpers.replace_keys().
+    Slow, but independent of template compilation, it's the reference for VerifyingEngine.
+    Conditions are applied when the template is prepared, so it's rendered with the definitions of 'wiz'.
+    """
+    name = 'reference'
+    batchable = False
+
+    def prepare_steps(self, wiz, src_filename):
+        return (yield from self._processed_text_steps(wiz, src_filename, ()))
+
+    def render(self, prepared, definitions, replacement_dict):
+        return lolly_helpers.replace_keys(prepared, replacement_dict)
+
+    def _processed_text_steps(self, wiz, filename, including):
+        if filename in including:
+            wiz._report_syntax_error("include cycle: " + ' -> '.join(including + (filename,)))
+            return None
+        contents = yield (wiz._src.read_text_file, filename)
+        if contents['error']:
+            wiz._report_file_operation_error("can't read file '" + wiz._src.describe(filename) + "'.")
+            return None
+        text = wiz._process_conditional_directives(contents['contents'], wiz._src.describe(filename))
+        if wiz.error:
+            return None
+        segments = wiz._split_includes(text, wiz._src.describe(filename))
+        if segments is None:
+            return None
+        parts = []
+        for segment in segments:
+            if segment.__class__ is str:
+                parts.append(segment)
+                continue
+            path = lolly_source._normalize(segment[1])
+            partial = yield from self._processed_text_steps(wiz, path, including + (filename,))
+            if partial is None:
+                return None
+            parts.append(partial)
+        return ''.join(parts)
+
+
+class VerifyingEngine:
+    """
+    Differential verification of a render engine: every template is prepared and rendered by both
+    the reference engine and the candidate engine, outputs are compared byte by byte and the time spent
+    by each engine is measured. Output of the reference engine is written, so rolling out a candidate
+    is safe. One verifying engine may be shared by many LollyWiz objects, also in many threads.
+    """
+    name = 'verify'
+    batchable = False
+
+    def __init__(self, reference='reference', candidate='compiled', max_mismatches=100):
+        """
+        :param reference: engine or name of a registered engine
+        :param candidate: engine or name of a registered engine
+        :param max_mismatches: maximal number of mismatches kept for report()
+        """
+        import threading
+        self.reference = get_engine(reference) if isinstance(reference, str) else reference
+        self.candidate = get_engine(candidate) if isinstance(candidate, str) else candidate
+        self.max_mismatches = max_mismatches
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.mismatch_count = 0
+        self.mismatches = []
+        self.seconds = {'reference': 0.0, 'candidate': 0.0}
+
+    def prepare_steps(self, wiz, src_filename):
+        timer = lolly_helpers.Timer()
+        reference = yield from self.reference.prepare_steps(wiz, src_filename)
+        reference_seconds = timer.stop()
+        if reference is None:
+            return None
+        timer = lolly_helpers.Timer()
+        candidate = yield from self.candidate.prepare_steps(wiz, src_filename)
+        candidate_seconds = timer.stop()
+        if candidate is None:
+            # the reference accepted the template, so this is a mismatch too
+            wiz._clear_error()
+            candidate_seconds = 0.0
+        self._add_seconds(reference_seconds, candidate_seconds)
+        return wiz._src.describe(src_filename), reference, candidate
+
+    def render(self, prepared, definitions, replacement_dict):
+        template, reference, candidate = prepared
+        timer = lolly_helpers.Timer()
+        expected = self.reference.render(reference, definitions, replacement_dict)
+        reference_seconds = timer.stop()
+        actual = None
+        timer = lolly_helpers.Timer()
+        if candidate is not None:
+            try:
+                actual = self.candidate.render(candidate, definitions, replacement_dict)
+            except Exception as e:  # a broken candidate must not break instantiation
+                actual = e
+        candidate_seconds = timer.stop()
+        self._add_seconds(reference_seconds, candidate_seconds)
+        if not isinstance(actual, str):
+            mismatch = {'template': template, 'offset': 0, 'expected': expected[:40],
+                        'actual': "candidate failed: " + (repr(actual) if actual is not None else 'see errors')}
+        else:
+            mismatch = _compare_bytes(template, expected.encode('utf-8'), actual.encode('utf-8'))
+        with self._lock:
+            self.renders += 1
+            if mismatch is not None:
+                self.mismatch_count += 1
+                if len(self.mismatches) < self.max_mismatches:
+                    self.mismatches.append(mismatch)
+        return expected
+
+    def report(self):
+        """
+        :return: Dict - 'renders': number of rendered templates; 'mismatches': number of outputs that differ;
+                        'details': list of Dicts 'template', 'offset' (of the first differing byte),
+                                   'expected', 'actual' (bytes around the offset);
+                        'reference_seconds', 'candidate_seconds': time spent preparing and rendering;
+                        'speedup': reference_seconds / candidate_seconds;
+        """
+        with self._lock:
+            reference_seconds = self.seconds['reference']
+            candidate_seconds = self.seconds['candidate']
+            return {'renders': self.renders, 'mismatches': self.mismatch_count, 'details': list(self.mismatches),
+                    'reference_seconds': reference_seconds, 'candidate_seconds': candidate_seconds,
+                    'speedup': reference_seconds / candidate_seconds if candidate_seconds else 0.0}
+
+    def summary(self):
+        """
+        :return: one line summary of report()
+        """
+        report = self.report()
+        return ('%s vs %s: %d renders, %d mismatches, %.6f s vs %.6f s, speedup %.2fx' %
+                (self.candidate.name, self.reference.name, report['renders'], report['mismatches'],
+                 report['candidate_seconds'], report['reference_seconds'], report['speedup']))
+
+    def _add_seconds(self, reference_seconds, candidate_seconds):
+        with self._lock:
+            self.seconds['reference'] += reference_seconds
+            self.seconds['candidate'] += candidate_seconds
+
+
+def _compare_bytes(template, expected, actual):
+    """
+    :return: None if equal or Dict - 'template', 'offset' of the first differing byte, 'expected', 'actual'
+    """
+    if expected == actual:
+        return None
+    offset = 0
+    for offset, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            break
+    else:
+        offset = min(len(expected), len(actual))
+    start = max(0, offset - 10)
+    return {'template': template, 'offset': offset, 'expected': expected[start:offset + 30],
+            'actual': actual[start:offset + 30]}
+
+
+_engines = {'compiled': CompiledEngine(), 'reference': ReferenceEngine()}
+
+
+def register_engine(engine):
+    """
+    Makes an engine available by its name, see LollyWiz.set_render_engine().
+    :param engine: object with 'name', 'batchable', prepare_steps() and render(), see CompiledEngine
+    :return: None
+    """
+    _engines[engine.name] = engine
+
+
+def get_engine(name):
+    """
+    :param name: 'compiled', 'reference' or name of a registered engine
+    :return: engine or None if there is no engine with this name
+    """
+    return _engines.get(name)
+
+
+def _render_chunk(chunk):
+    """
+    Worker process entry point.
+    :param chunk: list of jobs (job_id, compiled, definitions, replacement_dict)
+    :return: list of tuples (job_id, rendered string, error)
+    """
+    results = []
+    definition_sets = {}
+    for job_id, compiled, definitions, replacement_dict in chunk:
+        # jobs of one chunk usually share the same definitions object, convert it to a set once
+        key = id(definitions)
+        if key not in definition_sets:
+            definition_sets[key] = frozenset(definitions)
+        try:
+            results.append((job_id, render_compiled(compiled, definition_sets[key], replacement_dict), ''))
+        except Exception as e:
+            results.append((job_id, '', str(e)))
+    return results
+
+
+class ProcessPoolRenderer:
+    """
+    Renders compiled templates in a pool of worker processes, so CPU-bound rendering of large batches
+    is not limited by the GIL. Worker processes are started on first use and kept alive between batches
+    until close() is called, so process startup is paid once.
+    Jobs are shipped to the workers in chunks; templates, definitions and replacement dicts that are shared
+    by jobs of the same chunk are pickled only once per chunk.
+    May be used as a context manager.
+    """
+    def __init__(self, max_workers=None, chunk_size=32, mp_context=None):
+        """
+        :param max_workers: number of worker processes, defaults to the number of CPUs
+        :param chunk_size: max number of jobs sent to a worker at once
+        :param mp_context: multiprocessing context, e.g. multiprocessing.get_context('spawn')
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+        self._mp_context = mp_context
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stops worker processes.
+        :return: None
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def render_batch(self, jobs):
+        """
+        Renders a batch of jobs and yields results as soon as they are ready (in completion order).
+        'jobs' are consumed lazily, only a few chunks per worker are in flight at any time.
+        :param jobs: iterable of tuples (job_id, compiled, definitions, replacement_dict)
+        :return: generator of tuples (job_id, rendered string, error), error is empty string if success
+        """
+        from concurrent import futures
+        executor = self._get_executor()
+        max_in_flight = self.max_workers * 2
+        in_flight = set()
+        chunks = self._chunks(jobs)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    in_flight.add(executor.submit(_render_chunk, chunk))
+                if not in_flight:
+                    return
+                done, in_flight = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        yield result
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def render(self, compiled, definitions, replacement_dict):
+        """
+        Renders a single template in a worker process.
+        :return: Dict - 'contents': rendered string;
+                        'error': empty string if success or error message otherwise;
+        """
+        for job_id, contents, error in self.render_batch([(0, compiled, definitions, replacement_dict)]):
+            return {'contents': contents, 'error': error}
+
+    def _get_executor(self):
+        from concurrent import futures
+        if self._executor is None:
+            if self._mp_context is None:
+                self._executor = futures.ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                             mp_context=self._mp_context)
+        return self._executor
+
+    def _chunks(self, jobs):
+        chunk = []
+        for job in jobs:
+            chunk.append(job)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
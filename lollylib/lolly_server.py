@@ -0,0 +1,505 @@
+"""
+Render server: a long-lived process that instantiates templates on request and keeps everything it can warm
+in memory between requests - template sources with their compiled templates (see lolly_source.CompilingDirSource),
+the shared read cache of file contents and parsed instruction files.
+
+The server speaks plain HTTP with JSON bodies over a Unix socket or a local TCP port:
+    POST /render  {'src': template dir or 'lib': library template name, 'dest': destination dir,
+                   'definitions': list of strings, 'replacements': dict of string:string pairs}
+                  -> {'error': empty string or LollyWiz error, 'message': details, 'duration': seconds,
+                      'instructions_cached': True if parsed instruction file was reused}
+    GET /status   -> {'requests': number of handled render requests, 'instructions_cache_hits': ...,
+                      'sources': number of warm template sources, 'workers': size of the worker pool}
+    GET /metrics  -> metrics in Prometheus text format if they are collected, see lolly_metrics.enable()
+Requests are handled concurrently by a bounded pool of worker threads.
+Render requests must have 'Content-Type: application/json', so a web page can't send one without a CORS
+preflight, which the server does not answer. A server started with a token also requires it in the
+'X-Lolly-Token' header of render requests.
+
+Start a server:
+    python -m lollylib.lolly_server --socket /tmp/lollywiz.sock
+Render with the thin client, which does not import LollyWiz at all:
+    RenderClient('/tmp/lollywiz.sock').render('my_template', 'out', definitions=['LICENSE_TYPE_MIT'])
+"""
+import hmac
+import http.client
+import http.server
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+from . import lolly_helpers
+
+# common replacements (see LollyWiz._generate_common_replacements()) change with time, instruction files
+# that refer to them are parsed on every request
+_COMMON_REPLACEMENT_PREFIX = '[$$__'
+
+TOKEN_HEADER = 'X-Lolly-Token'
+
+
+class _RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        metrics = lolly_helpers.get_metrics()
+        if self.path == '/metrics' and metrics is not None:
+            body = metrics.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != '/status':
+            self._send_json(404, {'error': 'not_found', 'message': "unknown path '" + self.path + "'"})
+            return
+        self._send_json(200, self.server.render_server.status())
+
+    def do_POST(self):
+        if self.path != '/render':
+            self._send_json(404, {'error': 'not_found', 'message': "unknown path '" + self.path + "'"})
+            return
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            self._send_json(415, {'error': 'request', 'message': "'Content-Type: application/json' is expected"})
+            return
+        token = self.server.render_server.token
+        if token is not None and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode('utf-8'),
+                                                         token.encode('utf-8')):
+            self._send_json(403, {'error': 'forbidden', 'message': "missing or wrong '" + TOKEN_HEADER + "' header"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            self._send_json(400, {'error': 'request', 'message': 'malformed request: ' + str(e)})
+            return
+        try:
+            result = self.server.render_server.render(request)
+        except Exception as e:  # keep serving other requests
+            self._send_json(500, {'error': 'internal', 'message': repr(e)})
+            return
+        self._send_json(200, result)
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # requests are not logged, errors are returned to clients
+
+
+class _PooledServerMixIn:
+    """
+    Handles each connection in a thread of a bounded pool (socketserver.ThreadingMixIn starts a thread per
+    connection). Connections are closed after each request, so an idle client never holds a worker.
+    """
+    executor = None
+    render_server = None
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_in_worker, request, client_address)
+
+    def _process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class _TCPRenderServer(_PooledServerMixIn, http.server.HTTPServer):
+    pass
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixRenderServer(_PooledServerMixIn, socketserver.UnixStreamServer):
+        def get_request(self):
+            request, client_address = self.socket.accept()
+            return request, ('unix', 0)  # BaseHTTPRequestHandler expects (host, port)
+
+
+class RenderServer:
+    """
+    Instantiates templates requested over HTTP, see module description.
+    """
+    def __init__(self, address=None, max_workers=4, max_cached_instructions=1024, token=None):
+        """
+        :param address: path of a Unix socket or tuple (host, port); port 0 selects a free port;
+                        None if the object only renders in process, see render()
+        :param max_workers: maximal number of requests handled concurrently
+        :param max_cached_instructions: maximal number of parsed instruction files kept in memory
+        :param token: string required in the X-Lolly-Token header of render requests, None if not required
+        """
+        from collections import OrderedDict
+        self.address = address
+        self.token = token
+        self.max_workers = max_workers
+        self.max_cached_instructions = max_cached_instructions
+        self._sources = {}  # ('src', dir) or ('lib', name): template source
+        # (source key, definitions, replacements): (lollywiz.txt stamp, dest, parsed instructions, replacements),
+        # least recently used first
+        self._instructions = OrderedDict()
+        self._lock = threading.Lock()
+        self._server = None
+        self._executor = None
+        self._thread = None
+        self.requests = 0
+        self.instructions_cache_hits = 0
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        :return: Dict - 'address': socket path or (host, port) the server listens on;
+                        'error': empty string if success or error message otherwise;
+        """
+        import concurrent.futures
+        result = {'address': None, 'error': ''}
+        try:
+            if isinstance(self.address, str):
+                if not hasattr(socketserver, 'UnixStreamServer'):
+                    result['error'] = 'unix sockets are not supported on this platform'
+                    return result
+                if os.path.lexists(self.address):
+                    if not stat.S_ISSOCK(os.lstat(self.address).st_mode):
+                        result['error'] = "'" + self.address + "' exists and is not a socket"
+                        return result
+                    os.remove(self.address)  # left by a server that was not closed
+                server = _UnixRenderServer(self.address, _RenderRequestHandler)
+            else:
+                server = _TCPRenderServer(tuple(self.address), _RenderRequestHandler)
+                self.address = server.server_address[:2]
+        except OSError as e:
+            result['error'] = str(e)
+            return result
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        server.executor = self._executor
+        server.render_server = self
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, name='lolly_server', daemon=True)
+        self._thread.start()
+        result['address'] = self.address
+        return result
+
+    def serve_forever(self):
+        """
+        Starts the server (if not started) and blocks until close() is called from another thread
+        or KeyboardInterrupt.
+        :return: Dict - 'error': empty string if the server was started or error message otherwise
+        """
+        if self._server is None:
+            started = self.start()
+            if started['error']:
+                return {'error': started['error']}
+        try:
+            while self._thread is not None and self._thread.is_alive():
+                self._thread.join(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        return {'error': ''}
+
+    def close(self):
+        """
+        Stops serving, waits for requests that are being handled and removes the Unix socket.
+        :return: None
+        """
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._executor.shutdown(wait=True)
+        self._server.server_close()
+        if isinstance(self.address, str):
+            lolly_helpers.silent_remove_file(self.address)
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def status(self):
+        with self._lock:
+            return {'requests': self.requests, 'instructions_cache_hits': self.instructions_cache_hits,
+                    'sources': len(self._sources), 'workers': self.max_workers}
+
+    def render(self, request):
+        """
+        Instantiates a template in the calling thread, see module description for the request format.
+        :param request: Dict
+        :return: Dict - 'error', 'message', 'duration', 'instructions_cached'
+        """
+        timer = lolly_helpers.Timer()
+        result = {'error': '', 'message': '', 'duration': 0.0, 'instructions_cached': False}
+        with self._lock:
+            self.requests += 1
+        definitions = request.get('definitions') or []
+        replacements = request.get('replacements') or {}
+        dest = request.get('dest')
+        if not isinstance(dest, str) or not isinstance(definitions, list) or not isinstance(replacements, dict):
+            result['error'] = 'request'
+            result['message'] = "'dest' string, 'definitions' list and 'replacements' dict are expected"
+            return result
+        source = self._get_source(request)
+        if isinstance(source, str):
+            result['error'] = 'request'
+            result['message'] = source
+            return result
+        wiz = self._new_wiz(source)
+        if wiz.error:
+            result['error'] = wiz.error
+            result['message'] = "can't use template source '" + source.describe('') + "'"
+            return result
+        wiz.set_dest(dest)
+        wiz.set_definitions(list(definitions))
+        wiz.set_replacements(dict(replacements))
+        key = (self._source_key(request), tuple(sorted(definitions)), tuple(sorted(replacements.items())))
+        result['instructions_cached'] = self._use_cached_instructions(wiz, key, source)
+        if not result['instructions_cached']:
+            wiz._parse_instructions()
+            if not wiz.error:
+                wiz._is_instr_file_parsed = True
+                self._cache_instructions(wiz, key, source)
+        if not wiz.error:
+            wiz.instantiate()
+        if wiz.error:
+            result['error'] = wiz.error
+            result['message'] = "can't instantiate template '" + source.describe('') + "'"
+        result['duration'] = timer.stop()
+        return result
+
+    # PRIVATE METHODS
+
+    def _new_wiz(self, source):
+        from .lolly_wiz import LollyWiz
+        wiz = LollyWiz()
+        wiz.set_src_backend(source)
+        return wiz
+
+    def _source_key(self, request):
+        if request.get('lib'):
+            return 'lib', request['lib']
+        return 'src', os.path.realpath(str(request.get('src')))
+
+    def _get_source(self, request):
+        """
+        :return: warm template source or error message
+        """
+        from . import lolly_library
+        from . import lolly_source
+        key = self._source_key(request)
+        with self._lock:
+            source = self._sources.get(key)
+        if source is not None:
+            return source
+        if key[0] == 'lib':
+            source = lolly_library.get_template(key[1])
+            if source is None:
+                return "library template '" + key[1] + "' does not exist"
+        else:
+            if not request.get('src') or not lolly_helpers.dir_exists(key[1]):
+                return "template source directory '" + str(request.get('src')) + "' does not exist"
+            source = lolly_source.CompilingDirSource(key[1], _TemplateCompiler())
+        with self._lock:
+            return self._sources.setdefault(key, source)
+
+    def _instruction_file_stamp(self, wiz, source):
+        return source._stamp(wiz.INSTRUCTION_FILE_NAME)
+
+    def _use_cached_instructions(self, wiz, key, source):
+        with self._lock:
+            cached = self._instructions.get(key)
+            if cached is not None:
+                self._instructions.move_to_end(key)
+        hit = cached is not None and cached[0] == self._instruction_file_stamp(wiz, source)
+        metrics = lolly_helpers.get_metrics()
+        if metrics is not None:
+            metrics.cache_lookup('instructions', hit)
+        if not hit:
+            return False
+        stamp, dest, instructions, cached_replacements = cached
+        if dest != wiz.dest_root_dir:
+            instructions = [self._rebase_instruction(wiz, i, dest) for i in instructions]
+        wiz._instr_file_data = list(instructions)
+        # user replacements and fresh common replacements take priority over cached defaults of lollywiz.txt
+        wiz._generate_common_replacements()
+        wiz._setup_instr_file_replacements()
+        replacements = dict(cached_replacements)
+        replacements.update(wiz.replacement_dict)
+        wiz.replacement_dict = replacements
+        wiz._is_instr_file_read = True
+        wiz._is_instr_file_parsed = True
+        with self._lock:
+            self.instructions_cache_hits += 1
+        return True
+
+    def _cache_instructions(self, wiz, key, source):
+        import copy
+        raw = source.compiled_template(wiz.INSTRUCTION_FILE_NAME, wiz.OPTIONS)
+        if raw is None:
+            raw = source.read_text_file(wiz.INSTRUCTION_FILE_NAME)['contents']
+        if _COMMON_REPLACEMENT_PREFIX in str(raw):
+            return
+        stamp = self._instruction_file_stamp(wiz, source)
+        if not source._is_settled(stamp):
+            return  # lollywiz.txt was just modified, it may change again without changing its stamp
+        # instantiate() executes instructions without modifying them, so cache hits share them
+        cached = (stamp, wiz.dest_root_dir, copy.deepcopy(wiz._instr_file_data), dict(wiz.replacement_dict))
+        with self._lock:
+            self._instructions[key] = cached
+            self._instructions.move_to_end(key)
+            while len(self._instructions) > self.max_cached_instructions:
+                self._instructions.popitem(last=False)
+
+    def _rebase_instruction(self, wiz, i, dest):
+        """
+        :return: copy of instruction 'i' that was parsed for destination 'dest' with paths in wiz.dest_root_dir
+        """
+        index = wiz._dest_arg_index(i)
+        if index is None:
+            return i
+        args = list(i['args'])
+        args[index] = wiz.dest_root_dir + args[index][len(dest):]
+        rebased = dict(i)
+        rebased['args'] = args
+        return rebased
+
+
+class _TemplateCompiler:
+    """
+    Compile function of template sources shared by requests. Templates are compiled by a helper LollyWiz,
+    so errors are not reported on the LollyWiz of a request: a template with errors is not compiled (None),
+    the LollyWiz of the request reads and compiles it itself and reports the error.
+    """
+    def __init__(self):
+        from .lolly_wiz import LollyWiz
+        self._wiz = LollyWiz()
+        self._lock = threading.Lock()  # the helper keeps the error of the last compilation
+
+    def __call__(self, text, filename):
+        with self._lock:
+            self._wiz.error = ''
+            compiled = self._wiz._compile_template(text, filename)
+            return None if self._wiz.error else compiled
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super(_UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RenderClient:
+    """
+    Thin client of RenderServer. Methods do not raise exceptions, connection errors are returned in 'error'.
+    """
+    def __init__(self, address, timeout=60, token=None):
+        """
+        :param address: path of a Unix socket or tuple (host, port)
+        :param timeout: seconds
+        :param token: token of the server, see RenderServer
+        """
+        self.address = address
+        self.timeout = timeout
+        self.token = token
+
+    def render(self, src, dest, definitions=None, replacements=None, lib=None):
+        """
+        :param src: template source directory, ignored if 'lib' is given
+        :param dest: destination directory
+        :param lib: name of a library template, see LollyWiz.set_src_from_lib()
+        :return: Dict - see RenderServer.render()
+        """
+        request = {'dest': os.path.abspath(dest), 'definitions': definitions or [], 'replacements': replacements or {}}
+        if lib:
+            request['lib'] = lib
+        else:
+            request['src'] = os.path.abspath(src)
+        return self.render_request(request)
+
+    def render_request(self, request):
+        """
+        :param request: Dict - render request, see module description
+        :return: Dict - see RenderServer.render()
+        """
+        return self._request('POST', '/render', request)
+
+    def status(self):
+        """
+        :return: Dict - see RenderServer.status(), 'error' key is added
+        """
+        return self._request('GET', '/status')
+
+    def _request(self, method, path, obj=None):
+        if isinstance(self.address, str):
+            connection = _UnixHTTPConnection(self.address, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+        try:
+            body = None if obj is None else json.dumps(obj).encode('utf-8')
+            headers = {} if body is None else {'Content-Type': 'application/json'}
+            if self.token is not None:
+                headers[TOKEN_HEADER] = self.token
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            result = json.loads(response.read().decode('utf-8'))
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            return {'error': 'connection', 'message': str(e)}
+        finally:
+            connection.close()
+        result.setdefault('error', '')
+        return result
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m lollylib.lolly_server',
+                                     description='Long-lived LollyWiz render server.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--socket', help='path of the Unix socket to listen on')
+    group.add_argument('--port', type=int, help='local TCP port to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='interface for --port, 127.0.0.1 by default')
+    parser.add_argument('--workers', type=int, default=4, help='maximal number of concurrent requests')
+    parser.add_argument('--metrics', action='store_true', help='collect metrics served by GET /metrics')
+    parser.add_argument('--token-file', help='file with a token clients must send in the X-Lolly-Token header')
+    args = parser.parse_args(argv)
+    token = None
+    if args.token_file:
+        read = lolly_helpers.silent_read_text_file(args.token_file)
+        if read['error']:
+            print('* lolly_server error: ', "can't read token file '" + args.token_file + "'")
+            return 1
+        token = read['contents'].strip()
+    if args.metrics:
+        from . import lolly_metrics
+        lolly_metrics.enable()
+    address = args.socket if args.socket else (args.host, args.port)
+    server = RenderServer(address, max_workers=args.workers, token=token)
+    started = server.start()
+    if started['error']:
+        print('* lolly_server error: ', started['error'])
+        return 1
+    print('* lolly_server: serving on ', started['address'])
+    served = server.serve_forever()
+    if served['error']:
+        print('* lolly_server error: ', served['error'])
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
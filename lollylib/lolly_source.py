@@ -0,0 +1,598 @@
+"""
+Sources that LollyWiz reads templates from, see LollyWiz.set_src_backend().
+All paths are relative to the template root (the directory that contains lollywiz.txt) and use '/' as delimiter.
+Like lolly_helpers 'silent_*' functions, the methods do not raise exceptions and return dicts with 'error' key.
+
+Sources keep an index of their entries (path: 'file' or 'dir') and share a read cache, so repeated reads of
+the same template are served from memory. Archive, package and in-memory sources are treated as immutable;
+local directories are re-validated by size and modification time on each read.
+"""
+import os
+import io
+import threading
+import time
+import itertools
+from collections import OrderedDict
+from . import lolly_helpers
+
+_unique_ids = itertools.count()
+
+
+def _normalize(path):
+    parts = [p for p in path.replace('\\', '/').split('/') if p and p != '.']
+    return '/'.join(parts)
+
+
+def _file_identity(filename):
+    st = os.stat(filename)
+    return os.path.realpath(filename), st.st_size, st.st_mtime_ns
+
+
+def _decode_text(data):
+    """ Decodes bytes exactly like a file opened with open(filename, 'r') is read. """
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def is_pattern(path):
+    """
+    :return: True if 'path' is a pattern: '*' and '?' match within one path segment,
+             '**' segment matches any number of directories
+    """
+    return '*' in path or '?' in path
+
+
+def split_pattern(pattern):
+    """
+    :return: tuple (base, rest): leading directories without wildcards and the rest of the pattern,
+             e.g. 'src/**/*.lwt' -> ('src', '**/*.lwt')
+    """
+    segments = _normalize(pattern).split('/')
+    n = 0
+    while n < len(segments) - 1 and not is_pattern(segments[n]):
+        n += 1
+    return '/'.join(segments[:n]), '/'.join(segments[n:])
+
+
+def _pattern_regex(pattern):
+    import re
+    regex = ''
+    segments = pattern.split('/')
+    for n, segment in enumerate(segments):
+        last = n == len(segments) - 1
+        if segment == '**':
+            regex += '.*' if last else '(?:[^/]+/)*'
+            continue
+        for c in segment:
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            else:
+                regex += re.escape(c)
+        if not last:
+            regex += '/'
+    return re.compile(regex + r'\Z')
+
+
+def _index_of_files(names):
+    """ Index of files and all their parent directories. """
+    index = {}
+    for name in names:
+        index[name] = 'file'
+        parts = name.split('/')
+        for n in range(1, len(parts)):
+            index['/'.join(parts[:n])] = 'dir'
+    return index
+
+
+class ReadCache:
+    """
+    Thread-safe LRU cache of file contents limited by total size in bytes.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key: (stamp, value, size)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stamp=None):
+        """
+        :param key: hashable key
+        :param stamp: if not None, cached value is returned only if it was stored with the same stamp
+        :return: cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            metrics = lolly_helpers.get_metrics()
+            if entry is None or entry[0] != stamp:
+                self.misses += 1
+                if metrics is not None:
+                    metrics.cache_lookup('read', False)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if metrics is not None:
+                metrics.cache_lookup('read', True)
+            return entry[1]
+
+    def put(self, key, value, size, stamp=None):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[2]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (stamp, value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                k, (s, v, old_size) = self._entries.popitem(last=False)
+                self._size -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+shared_read_cache = ReadCache()
+
+
+class TemplateSource:
+    """
+    Base class of template sources. Subclasses implement _build_index() and _read() at least.
+    """
+    def __init__(self, cache=None):
+        """
+        :param cache: ReadCache, lolly_source.shared_read_cache by default; False disables caching
+        """
+        self._cache = shared_read_cache if cache is None else cache
+        self._index = None
+        self._lock = threading.Lock()
+        # identifies the source in the shared cache, subclasses set it to a value that stays the same
+        # for all objects reading the same unchanged data
+        self._cache_id = ('unique', next(_unique_ids))
+
+    def describe(self, path):
+        """ Human readable location of 'path' for messages. """
+        return path
+
+    def local_path(self, path):
+        """
+        :return: path of the item on the local file system or None if the source is not a local directory
+        """
+        return None
+
+    def compiled_template(self, path, options):
+        """
+        Precompiled form of a template, see LollyWiz._compile_template().
+        :param options: LollyWiz.OPTIONS the template must have been compiled with
+        :return: tuple of segments or None if the source has no precompiled form of the template
+        """
+        return None
+
+    def index(self):
+        """
+        :return: Dict - path: 'file' or 'dir' for every entry of the source
+        """
+        with self._lock:
+            if self._index is None:
+                self._index = self._build_index()
+            return self._index
+
+    def get_item_type(self, path):
+        """
+        :return: Dict - 'exists': True or False; 'type': 'file', 'dir' or empty string
+        """
+        result = {'exists': False, 'type': ''}
+        name = _normalize(path)
+        item_type = 'dir' if not name else self.index().get(name)
+        if item_type is not None:
+            result['exists'] = True
+            result['type'] = item_type
+        return result
+
+    def walk(self, path):
+        """
+        Lists everything inside a directory, parents go before their contents.
+        :return: list of tuples (path relative to 'path', 'file' or 'dir')
+        """
+        name = _normalize(path)
+        prefix = name + '/' if name else ''
+        return sorted((p[len(prefix):], t) for p, t in self.index().items() if p.startswith(prefix) and p != name)
+
+    def iter_files(self, path, max_depth=None):
+        """
+        Streams files inside a directory and its subdirectories.
+        :param max_depth: None for unlimited, 1 for files of 'path' only...
+        :return: generator of file paths relative to 'path'
+        """
+        for rel_name, item_type in self.walk(path):
+            if item_type == 'file' and (max_depth is None or rel_name.count('/') < max_depth):
+                yield rel_name
+
+    def glob(self, pattern):
+        """
+        Finds files matching a pattern, see is_pattern(). Only the directory that precedes the first
+        wildcard is walked, and only as deep as the pattern reaches.
+        :return: Dict - 'base': directory that precedes the first wildcard;
+                        'files': sorted list of matching paths relative to 'base';
+        """
+        base, rest = split_pattern(pattern)
+        result = {'base': base, 'files': []}
+        if self.get_item_type(base)['type'] != 'dir':
+            return result
+        max_depth = None if '**' in rest.split('/') else rest.count('/') + 1
+        regex = _pattern_regex(rest)
+        result['files'] = sorted(f for f in self.iter_files(base, max_depth) if regex.match(f))
+        return result
+
+    def read_binary_file(self, path):
+        """
+        :return: Dict - 'contents': bytes; 'error': empty string if success or error message otherwise;
+        """
+        return self._cached_read(path, 'b')
+
+    def read_text_file(self, path):
+        """
+        :return: Dict - 'contents': string; 'error': empty string if success or error message otherwise;
+        """
+        return self._cached_read(path, 't')
+
+    # PRIVATE METHODS
+
+    def _stamp(self, name):
+        """ Version of the item used to validate cache entries, None for immutable sources. """
+        return None
+
+    def _is_settled(self, stamp):
+        """ False if the item may change again without changing 'stamp', so it must not be cached. """
+        return True
+
+    def _cached_read(self, path, mode):
+        result = {'contents': b'' if mode == 'b' else '', 'error': ''}
+        name = _normalize(path)
+        if self.get_item_type(name)['type'] != 'file':
+            result['error'] = 'file_not_exists'
+            return result
+        stamp = self._stamp(name)
+        key = (self._cache_id, name, mode)
+        if self._cache:
+            cached = self._cache.get(key, stamp)
+            if cached is not None:
+                result['contents'] = cached
+                return result
+        try:
+            data = self._read(name)
+        except Exception as e:
+            result['error'] = str(e)
+            return result
+        metrics = lolly_helpers.get_metrics()
+        if metrics is not None:
+            metrics.bytes_read.inc(len(data))
+        if mode == 't':
+            data = _decode_text(data)
+        if self._cache and self._is_settled(stamp):
+            self._cache.put(key, data, len(data), stamp)
+        result['contents'] = data
+        return result
+
+    def _build_index(self):
+        raise NotImplementedError
+
+    def _read(self, name):
+        raise NotImplementedError
+
+
+class DirSource(TemplateSource):
+    """
+    Templates located in a local directory. The directory is not indexed in advance: items are looked up
+    on the file system, so changes of the directory are visible immediately.
+    """
+    def __init__(self, root_dir, cache=None):
+        super(DirSource, self).__init__(cache)
+        self.root_dir = root_dir
+        self._cache_id = ('dir', os.path.realpath(root_dir))
+
+    def describe(self, path):
+        return self.local_path(path)
+
+    def local_path(self, path):
+        return self.root_dir + '/' + path if path else self.root_dir
+
+    def get_item_type(self, path):
+        return lolly_helpers.get_filesystem_item_type(self.local_path(path))
+
+    def _build_index(self):
+        index = {}
+        for root, dirs, files in os.walk(self.root_dir):
+            rel_root = _normalize(os.path.relpath(root, self.root_dir))
+            prefix = rel_root + '/' if rel_root else ''
+            for d in dirs:
+                index[prefix + d] = 'dir'
+            for f in files:
+                index[prefix + f] = 'file'
+        return index
+
+    def index(self):
+        return self._build_index()  # never cached, the directory may change
+
+    def iter_files(self, path, max_depth=None):
+        # one directory listing at a time instead of the index of the whole tree
+        pending = [('', 1)]
+        root = self.local_path(_normalize(path))
+        while pending:
+            rel_dir, depth = pending.pop()
+            try:
+                with os.scandir(root + '/' + rel_dir if rel_dir else root) as it:
+                    entries = sorted((e.name, e.is_dir()) for e in it)
+            except OSError:
+                continue
+            subdirs = []
+            for name, is_dir in entries:
+                rel_name = rel_dir + '/' + name if rel_dir else name
+                if not is_dir:
+                    yield rel_name
+                elif max_depth is None or depth < max_depth:
+                    subdirs.append((rel_name, depth + 1))
+            pending.extend(reversed(subdirs))
+
+    def _stamp(self, name):
+        try:
+            st = os.stat(self.local_path(name))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _is_settled(self, stamp):
+        # same rule as lolly_helpers.FingerprintStore: a file modified within the resolution of file system
+        # timestamps before it was read may be modified again without changing size or mtime
+        return stamp is not None and time.time_ns() - stamp[1] > lolly_helpers._FINGERPRINT_RACY_WINDOW_NS
+
+    def _read(self, name):
+        with open(self.local_path(name), 'rb') as f:
+            return f.read()
+
+
+class CompilingDirSource(DirSource):
+    """
+    DirSource that compiles templates on first use and keeps them in memory, validated by size and
+    modification time, for long-running processes that instantiate the same templates many times
+    (see lolly_watch and lolly_server).
+    """
+    def __init__(self, root_dir, compile_template, cache=None):
+        """
+        :param compile_template: function(text, filename) that returns tuple of segments or None,
+                                 e.g. LollyWiz._compile_template of a LollyWiz object with the same OPTIONS
+        """
+        super(CompilingDirSource, self).__init__(root_dir, cache)
+        self._compile_template = compile_template
+        self._compiled = {}  # (path, options): (stamp, compiled template)
+        self.compiled_count = 0
+
+    def compiled_template(self, path, options):
+        name = _normalize(path)
+        stamp = self._stamp(name)
+        if stamp is None:
+            return None
+        key = (name, tuple(sorted(options.items())))
+        with self._lock:
+            cached = self._compiled.get(key)
+        hit = cached is not None and cached[0] == stamp
+        metrics = lolly_helpers.get_metrics()
+        if metrics is not None:
+            metrics.cache_lookup('compiled', hit)
+        if hit:
+            return cached[1]
+        contents = self.read_text_file(name)
+        if contents['error']:
+            return None
+        compiled = self._compile_template(contents['contents'], self.describe(name))
+        if compiled is None:
+            return None  # LollyWiz reads the file itself and reports the error
+        with self._lock:
+            self.compiled_count += 1
+            if self._is_settled(stamp):
+                self._compiled[key] = (stamp, compiled)
+        return compiled
+
+
+class ZipSource(TemplateSource):
+    """
+    Templates stored in a zip file (e.g. a zipped application or a wheel), read without extraction.
+    """
+    def __init__(self, zip_file, prefix='', cache=None):
+        """
+        :param zip_file: path to zip file or binary file-like object
+        :param prefix: directory inside the zip file that is the template root
+        """
+        import zipfile
+        super(ZipSource, self).__init__(cache)
+        self.zip_file = zip_file
+        self.prefix = _normalize(prefix)
+        self._zip = zipfile.ZipFile(zip_file)
+        if isinstance(zip_file, str):
+            self._cache_id = ('zip', _file_identity(zip_file))
+
+    def describe(self, path):
+        return str(self.zip_file) + ':' + self._member_name(_normalize(path))
+
+    def close(self):
+        self._zip.close()
+
+    def _member_name(self, name):
+        return self.prefix + '/' + name if self.prefix else name
+
+    def _build_index(self):
+        index = {}
+        prefix = self.prefix + '/' if self.prefix else ''
+        for member in self._zip.namelist():
+            if not member.startswith(prefix):
+                continue
+            name = _normalize(member[len(prefix):])
+            if not name:
+                continue
+            index[name] = 'dir' if member.endswith('/') else 'file'
+            # zip files don't always contain entries for directories
+            parts = name.split('/')
+            for n in range(1, len(parts)):
+                index['/'.join(parts[:n])] = 'dir'
+        return index
+
+    def _read(self, name):
+        with self._lock:
+            return self._zip.read(self._member_name(name))
+
+
+class TarSource(TemplateSource):
+    """
+    Templates stored in a tar archive (plain or compressed), read without extraction.
+    """
+    def __init__(self, tar_file, prefix='', cache=None):
+        """
+        :param tar_file: path to tar archive
+        :param prefix: directory inside the archive that is the template root
+        """
+        import tarfile
+        super(TarSource, self).__init__(cache)
+        self.tar_file = tar_file
+        self.prefix = _normalize(prefix)
+        self._tar = tarfile.open(tar_file, 'r:*')
+        self._cache_id = ('tar', _file_identity(tar_file))
+
+    def describe(self, path):
+        return self.tar_file + ':' + self._member_name(_normalize(path))
+
+    def close(self):
+        self._tar.close()
+
+    def _member_name(self, name):
+        return self.prefix + '/' + name if self.prefix else name
+
+    def _build_index(self):
+        index = {}
+        self._members = {}
+        prefix = self.prefix + '/' if self.prefix else ''
+        for member in self._tar.getmembers():
+            member_name = _normalize(member.name)
+            if not member_name.startswith(prefix):
+                continue
+            name = member_name[len(prefix):]
+            if not name or not (member.isdir() or member.isfile()):
+                continue
+            index[name] = 'dir' if member.isdir() else 'file'
+            self._members[name] = member
+            parts = name.split('/')
+            for n in range(1, len(parts)):
+                index['/'.join(parts[:n])] = 'dir'
+        return index
+
+    def _read(self, name):
+        self.index()
+        with self._lock:
+            return self._tar.extractfile(self._members[name]).read()
+
+
+class BundleSource(TemplateSource):
+    """
+    Templates kept in memory as a dict of path: contents (string or bytes).
+    """
+    def __init__(self, files, name='<bundle>', cache=None):
+        super(BundleSource, self).__init__(cache)
+        self.name = name
+        self._files = dict((_normalize(path), contents) for path, contents in files.items())
+
+    def describe(self, path):
+        return self.name + ':' + _normalize(path)
+
+    def _build_index(self):
+        return _index_of_files(self._files)
+
+    def _read(self, name):
+        data = self._files[name]
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return data
+
+
+class PackageSource(TemplateSource):
+    """
+    Templates shipped as resources of an installed python package, read with importlib.resources
+    whether the package is a directory or is imported from a zip file.
+    """
+    def __init__(self, package, resource_dir, cache=None):
+        """
+        :param package: package name, e.g. 'lollylib'
+        :param resource_dir: template root relative to the package, e.g. 'assets/lollywiz_templates/git'
+        """
+        super(PackageSource, self).__init__(cache)
+        import importlib.resources
+        self.package = package
+        self.resource_dir = _normalize(resource_dir)
+        self._root = importlib.resources.files(package)
+        for part in self.resource_dir.split('/'):
+            if part:
+                self._root = self._root.joinpath(part)
+        self._cache_id = ('package', package, self.resource_dir)
+
+    def describe(self, path):
+        return self.package + ':' + '/'.join(p for p in (self.resource_dir, _normalize(path)) if p)
+
+    def local_path(self, path):
+        if isinstance(self._root, os.PathLike):
+            root = os.fspath(self._root)
+            return root + '/' + path if path else root
+        return None
+
+    def _build_index(self):
+        index = {}
+        if not self._root.is_dir():
+            return index
+        pending = [('', self._root)]
+        while pending:
+            prefix, node = pending.pop()
+            for child in node.iterdir():
+                name = prefix + child.name
+                if child.is_dir():
+                    index[name] = 'dir'
+                    pending.append((name + '/', child))
+                else:
+                    index[name] = 'file'
+        return index
+
+    def _read(self, name):
+        node = self._root
+        for part in name.split('/'):
+            node = node.joinpath(part)
+        return node.read_bytes()
+
+
+class PrecompiledSource(TemplateSource):
+    """
+    Template compiled ahead of time by lolly_library.compile_template_dir(): raw contents of all files
+    and precompiled form of every text file, so instantiation does not parse conditional directives.
+    """
+    def __init__(self, compiled, cache=False):
+        """
+        :param compiled: Dict - 'name', 'options', 'files' (path: bytes), 'compiled' (path: tuple of segments)
+        """
+        super(PrecompiledSource, self).__init__(cache)
+        self.name = compiled['name']
+        self.options = compiled['options']
+        self._files = compiled['files']
+        self._compiled = compiled['compiled']
+
+    def describe(self, path):
+        return self.name + ':' + _normalize(path)
+
+    def compiled_template(self, path, options):
+        if options != self.options:
+            return None
+        return self._compiled.get(_normalize(path))
+
+    def _build_index(self):
+        return _index_of_files(self._files)
+
+    def _read(self, name):
+        return self._files[name]
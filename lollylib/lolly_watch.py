@@ -0,0 +1,393 @@
+"""
+Watch mode: keeps destination of a LollyWiz object up to date while its template source directory is edited.
+
+TemplateWatcher instantiates the template once, then waits for changes of the source directory
+(inotify on Linux, periodic polling of sizes and modification times elsewhere). Bursts of changes,
+e.g. an editor saving several files, are collected until the directory has been quiet for 'debounce' seconds
+and are then applied in one round:
+    - if lollywiz.txt changed, the whole template is instantiated again;
+    - otherwise only 'inst' and 'copy' instructions whose source file or directory changed are executed again,
+      followed by later instructions whose destination overlaps their output (e.g. 'remove' of a file
+      inside a directory that was copied again).
+Compiled templates are cached between rounds by source file size and modification time, so unchanged templates
+are neither read nor parsed again.
+
+Usage:
+    wiz = LollyWiz('my_template', 'out')
+    watcher = TemplateWatcher(wiz)
+    watcher.run()  # until KeyboardInterrupt or watcher.stop() from another thread
+"""
+import os
+import threading
+import time
+from . import lolly_helpers
+from . import lolly_source
+
+BACKENDS = ('auto', 'inotify', 'poll')
+
+
+class _PollingBackend:
+    """
+    Detects changes by comparing snapshots of the directory tree: (type, size, mtime_ns) of every item.
+    """
+    def __init__(self, root_dir, interval=0.5):
+        self.root_dir = root_dir
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.root_dir):
+            rel_root = lolly_source._normalize(os.path.relpath(root, self.root_dir))
+            prefix = rel_root + '/' if rel_root else ''
+            for d in dirs:
+                snapshot[prefix + d] = ('dir', 0, 0)
+            for f in files:
+                try:
+                    st = os.stat(root + '/' + f)
+                except OSError:  # removed while scanning
+                    continue
+                snapshot[prefix + f] = ('file', st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        """
+        :param timeout: seconds, None to wait until something changes
+        :return: set of changed paths relative to the root (may be empty if nothing changed within timeout)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(p for p in set(snapshot) | set(self._snapshot) if snapshot.get(p) != self._snapshot.get(p))
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return changed
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+class _InotifyBackend:
+    """
+    Linux inotify through ctypes. Every directory of the tree is watched; directories created later
+    are added to the watch, and their contents are reported as changed, because files may have been
+    created in them before the watch was added.
+    """
+    _IN_MODIFY = 0x00000002
+    _IN_ATTRIB = 0x00000004
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_FROM = 0x00000040
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_DELETE = 0x00000200
+    _IN_DELETE_SELF = 0x00000400
+    _IN_MOVE_SELF = 0x00000800
+    _IN_Q_OVERFLOW = 0x00004000
+    _IN_IGNORED = 0x00008000
+    _IN_ISDIR = 0x40000000
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+    _MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+             _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF)
+
+    def __init__(self, root_dir):
+        """
+        :raise OSError: if inotify is not available
+        """
+        import ctypes
+        import ctypes.util
+        self.root_dir = root_dir
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not supported')
+        self._fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}  # watch descriptor: directory path relative to the root
+        self._buffer = b''
+        self.overflowed = False
+        try:
+            self._add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, rel_dir):
+        import ctypes
+        path = self.root_dir + '/' + rel_dir if rel_dir else self.root_dir
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "can't watch '" + path + "'")
+        self._watches[wd] = rel_dir
+
+    def _add_tree(self, rel_dir):
+        """
+        :return: list of all paths inside the added tree
+        """
+        added = []
+        self._add_watch(rel_dir)
+        path = self.root_dir + '/' + rel_dir if rel_dir else self.root_dir
+        for root, dirs, files in os.walk(path):
+            rel_root = lolly_source._normalize(os.path.relpath(root, self.root_dir))
+            prefix = rel_root + '/' if rel_root else ''
+            for d in dirs:
+                try:
+                    self._add_watch(prefix + d)
+                except OSError:  # removed meanwhile
+                    continue
+                added.append(prefix + d)
+            for f in files:
+                added.append(prefix + f)
+        return added
+
+    def _read_events(self):
+        import struct
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self._buffer += data
+        header = struct.calcsize('iIII')
+        pos = 0
+        while pos + header <= len(self._buffer):
+            wd, mask, cookie, length = struct.unpack_from('iIII', self._buffer, pos)
+            if pos + header + length > len(self._buffer):
+                break
+            name = self._buffer[pos + header:pos + header + length].rstrip(b'\0')
+            pos += header + length
+            if mask & self._IN_Q_OVERFLOW:
+                self.overflowed = True  # events were lost, everything must be treated as changed
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & self._IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if not name:  # event of the watched directory itself
+                if rel_dir:
+                    changed.add(rel_dir)
+                continue
+            rel_name = (rel_dir + '/' if rel_dir else '') + os.fsdecode(name)
+            changed.add(rel_name)
+            if mask & self._IN_ISDIR and mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                try:
+                    changed.update(self._add_tree(rel_name))
+                except OSError:
+                    pass
+        self._buffer = self._buffer[pos:]
+        return changed
+
+    def wait(self, timeout):
+        """
+        :param timeout: seconds, None to wait until something changes
+        :return: set of changed paths relative to the root (may be empty if nothing changed within timeout)
+        """
+        import select
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, w, x = select.select([self._fd], [], [], remaining)
+            changed = self._read_events() if ready else set()
+            if changed or self.overflowed or not ready and remaining is not None:
+                return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _is_inside(path, parent):
+    return path == parent or not parent or path.startswith(parent + '/')
+
+
+class TemplateWatcher:
+    """
+    Re-instantiates parts of a template when its source directory changes, see module description.
+    """
+    def __init__(self, wiz, debounce=0.05, backend='auto', poll_interval=0.5):
+        """
+        :param wiz: LollyWiz with source directory, destination, definitions and replacements set,
+                    that has not been instantiated yet
+        :param debounce: seconds without changes after which collected changes are applied
+        :param backend: 'inotify', 'poll' or 'auto' (inotify if available)
+        :param poll_interval: seconds between scans of the 'poll' backend
+        """
+        self.wiz = wiz
+        self.debounce = debounce
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self.backend_name = ''
+        self.rounds = 0
+        self._backend = None
+        self._source = None
+        self._replacements = {}
+        self._full_rebuild_required = True
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """
+        Instantiates the whole template and starts watching its source directory.
+        :return: Dict - 'rendered': list of executed instructions; 'full': True; 'error': LollyWiz error or message
+        """
+        result = {'changed': [], 'rendered': [], 'full': True, 'error': ''}
+        if self.backend not in BACKENDS:
+            result['error'] = "unknown watch backend '" + str(self.backend) + "'"
+            return result
+        root_dir = self.wiz._src.local_path('') if self.wiz._src is not None else None
+        if root_dir is None or not lolly_helpers.dir_exists(root_dir):
+            result['error'] = 'watch mode requires template source in a local directory'
+            return result
+        # parsing of lollywiz.txt transforms replacement keys in place, each full round starts from the original
+        self._replacements = dict(self.wiz.replacement_dict)
+        self._source = lolly_source.CompilingDirSource(root_dir, self.wiz._compile_template)
+        self.wiz._use_source(self._source)
+        self._backend = None
+        if self.backend in ('auto', 'inotify'):
+            try:
+                self._backend = _InotifyBackend(root_dir)
+                self.backend_name = 'inotify'
+            except (OSError, AttributeError):
+                if self.backend == 'inotify':
+                    result['error'] = 'inotify is not available'
+                    return result
+        if self._backend is None:
+            self._backend = _PollingBackend(root_dir, self.poll_interval)
+            self.backend_name = 'poll'
+        self._stop_event.clear()
+        return self._apply(None, result)
+
+    def poll(self, timeout=None):
+        """
+        Waits for changes of the source directory and applies them.
+        :param timeout: seconds, None to wait until something changes
+        :return: Dict - 'changed': sorted list of changed source paths (empty if timed out);
+                        'rendered': list of executed instructions (dicts with 'cmd' and 'args');
+                        'full': True if the whole template was instantiated again;
+                        'error': empty string if success or LollyWiz error otherwise;
+        """
+        result = {'changed': [], 'rendered': [], 'full': False, 'error': ''}
+        if self._backend is None:
+            result['error'] = 'watcher is not started'
+            return result
+        changed = self._backend.wait(timeout)
+        if not changed and not self._backend_overflowed():
+            return result
+        # debounce: collect the rest of the burst
+        while not self._stop_event.is_set():
+            more = self._backend.wait(self.debounce)
+            if not more:
+                break
+            changed |= more
+        result['changed'] = sorted(changed)
+        if self._backend_overflowed():
+            self._backend.overflowed = False
+            return self._apply(None, result)
+        return self._apply(changed, result)
+
+    def run(self, on_round=None):
+        """
+        Starts watching (if not started) and applies changes until stop() is called or KeyboardInterrupt.
+        :param on_round: optional callable that receives result of each round, see poll()
+        :return: None
+        """
+        if self._backend is None:
+            result = self.start()
+            if on_round is not None:
+                on_round(result)
+            if self._backend is None:
+                return
+        try:
+            while not self._stop_event.is_set():
+                result = self.poll(min(self.poll_interval, 0.5))
+                if on_round is not None and result['changed']:
+                    on_round(result)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stop(self):
+        """
+        Makes run() return, may be called from any thread.
+        :return: None
+        """
+        self._stop_event.set()
+
+    def close(self):
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+
+    # PRIVATE METHODS
+
+    def _backend_overflowed(self):
+        return getattr(self._backend, 'overflowed', False)
+
+    def _apply(self, changed, result):
+        """
+        :param changed: set of changed source paths or None to instantiate the whole template
+        """
+        wiz = self.wiz
+        self.rounds += 1
+        wiz._clear_error()
+        # partials may be included by any template
+        if changed is None or self._full_rebuild_required or wiz.INSTRUCTION_FILE_NAME in changed or \
+                not changed.isdisjoint(wiz._partial_files):
+            wiz.set_replacements(dict(self._replacements))
+            wiz.instantiate()
+            result['full'] = True
+            result['rendered'] = list(wiz._instr_file_data) if not wiz.error else []
+            self._full_rebuild_required = bool(wiz.error)
+        else:
+            wiz.replacement_dict = lolly_helpers.bind_lazy_values(wiz.replacement_dict)  # computed again each round
+            for i in self._affected_instructions(changed):
+                wiz._execute_instruction(i)
+                if wiz.error:
+                    break
+                result['rendered'].append(i)
+            wiz._partials = {}
+            wiz._key_index = {}
+        result['error'] = wiz.error
+        return result
+
+    def _affected_instructions(self, changed):
+        """
+        Instructions whose source is in 'changed' and the instructions after them that may depend on their output.
+        """
+        affected = []
+        dirty_dests = []
+        for i in self.wiz._instr_file_data:
+            args = i['args']
+            if not args:
+                continue
+            dest = args[-1]
+            if i['cmd'] == 'inst_each' and len(args) == 3:
+                # names of written files depend on items, dir before the first key is written
+                dest = args[1].split(self.wiz.REPLACEMENT_START_SEQ)[0].rpartition('/')[0]
+            overlaps = any(_is_inside(dest, d) or _is_inside(d, dest) for d in dirty_dests)
+            if i['cmd'] in ('inst', 'copy') and len(args) == 2 or i['cmd'] == 'inst_each' and len(args) == 3:
+                if i['cmd'] == 'inst_each':  # replacements are applied to its arguments when executed
+                    args = [lolly_helpers.replace_keys(arg, self.wiz.replacement_dict) for arg in args]
+                sources = [lolly_source._normalize(args[0])]
+                if lolly_source.is_pattern(sources[0]):
+                    sources[0] = lolly_source.split_pattern(sources[0])[0]  # any change below the pattern base
+                if i['cmd'] == 'inst_each':
+                    sources.append(lolly_source._normalize(args[2]))  # file with items
+                if overlaps or any(_is_inside(p, src) for p in changed for src in sources):
+                    affected.append(i)
+                    dirty_dests.append(dest)
+            elif overlaps:
+                affected.append(i)  # e.g. 'remove' of a file inside a directory that was copied again
+        return affected
@@ -1,7 +1,11 @@
+import contextlib
 import os
 import ntpath
-import lolly_helpers
-import semver
+from . import lolly_helpers
+from . import lolly_dest
+from . import lolly_source
+from . import lolly_library
+from . import lolly_render
 
 
 class LollyWiz:
@@ -33,7 +37,8 @@ class LollyWiz:
         self.COND_END_SEQ = '##]'
 
         self.INSTRUCTION_FILE_NAME = 'lollywiz.txt'
-        self.SUPPORTED_INSTRUCTIONS = ['copy', 'remove', 'inst', 'mkdir']
+        self.TEMPLATE_EXTENSION = '.lwt'  # stripped from destination names of 'inst' with a pattern
+        self.SUPPORTED_INSTRUCTIONS = ['copy', 'remove', 'inst', 'mkdir', 'inst_each']
         self._MAX_LOOP_ITERS = 1000  # prevent looping forever in case of unexpected error
 
         # internal status variables
@@ -46,6 +51,33 @@ class LollyWiz:
         self._instr_file_full_path = ''
         self._instr_file_data = None
 
+        # where templates are read from, see set_src() and set_src_backend()
+        self._src = None
+
+        # where instantiated templates are written, see set_dest_backend()
+        self._dest = lolly_dest.DiskDestination()
+
+        # source of __DATE__, __TIME__... replacements, see set_clock()
+        self._clock = None
+
+        # how templates are rendered, see set_render_engine()
+        self._engine = lolly_render.get_engine('compiled')
+
+        # optional bulk rendering of templates, see set_render_backend()
+        self._render_backend = None
+        self._prerendered = {}  # source file name: rendered template
+        self._key_index = {}  # compiled template: keys used by it, kept during one instantiation
+
+        # optional profiling of instantiate(), see set_profiler()
+        self._profiler = None
+
+        # runtime metrics, see set_metrics()
+        self._metrics = lolly_helpers.get_metrics()
+
+        # partials included with [## include path ##], see _partial_text_steps()
+        self._partials = {}  # (path, definitions): partial with applied conditions, kept during one instantiation
+        self._partial_files = set()  # paths of all partials that were included
+
         # error handling
         # empty: no error;
         # other possible values: 'syntax', 'file', 'procedural', 'version';
@@ -68,30 +100,54 @@ class LollyWiz:
         :param src_dir: string
         :return: None
         """
-        self._is_src_dir_set = False
-        self._is_instr_file_parsed = False
         self._clear_error()
         self.src_root_dir = src_dir
-        self._instr_file_full_path = self.src_root_dir + self.PATH_DELIMITER_CHAR + self.INSTRUCTION_FILE_NAME
         src_root_dir_exists = lolly_helpers.dir_exists(self.src_root_dir)
         if not src_root_dir_exists:
             self._report_file_operation_error("template source directory '" + self.src_root_dir
                                               + "' does not exist")
-        if not lolly_helpers.file_exists(self._instr_file_full_path):
-            self._report_file_operation_error("instruction file '" + self._instr_file_full_path
-                                              + "' does not exist")
-            return
-        self._is_src_dir_set = True
+        self._use_source(lolly_source.DirSource(self.src_root_dir))
+
+    def set_src_backend(self, source):
+        """
+        An alternative way to set template source: a zip or tar archive, package resources or
+        an in-memory bundle, see lolly_source. The source must contain lollywiz.txt in its root.
+        :param source: lolly_source.TemplateSource
+        :return: None
+        """
+        self._clear_error()
+        self.src_root_dir = None
+        self._use_source(source)
 
     def set_src_from_lib(self, template_name):
         """
         An alternative way to set src folder from mini template library that is shipped with lollylib.
+        Precompiled templates are used when available (see lolly_library), otherwise templates are read
+        as package resources, so they are found even if lollylib is imported from a zip file.
         :param template_name: string - name of the template
         :return: None
         """
-        head, tail = ntpath.split(os.path.realpath(__file__))
-        templates_dir = head + '/assets/lollywiz_templates/'
-        self.set_src(templates_dir + template_name)
+        source = lolly_library.get_template(template_name)
+        if source is None:
+            resource_dir = lolly_library.TEMPLATES_DIR + '/' + template_name
+            try:
+                source = lolly_source.PackageSource('lollylib', resource_dir)
+            except (ImportError, AttributeError):  # package is not importable or python is older than 3.9
+                head, tail = ntpath.split(os.path.realpath(__file__))
+                source = lolly_source.DirSource(head + '/' + resource_dir)
+        self.set_src_backend(source)
+
+    def _use_source(self, source):
+        self._is_src_dir_set = False
+        self._is_instr_file_parsed = False
+        self._is_instr_file_read = False
+        self._src = source
+        self._instr_file_full_path = self._src.describe(self.INSTRUCTION_FILE_NAME)
+        if self._src.get_item_type(self.INSTRUCTION_FILE_NAME)['type'] != 'file':
+            self._report_file_operation_error("instruction file '" + self._instr_file_full_path
+                                              + "' does not exist")
+            return
+        self._is_src_dir_set = True
 
     def set_dest(self, dest_dir):
         """
@@ -103,6 +159,19 @@ class LollyWiz:
         self.dest_root_dir = dest_dir
         self._is_dest_dir_set = True
 
+    def set_dest_backend(self, backend):
+        """
+        Sets where instantiated templates are written: local file system (default),
+        an archive stream (lolly_dest.ArchiveDestination), memory (lolly_dest.MemoryDestination)
+        or any other implementation of lolly_dest.Destination. The backend is not closed by LollyWiz.
+        Destination dir must still be set with set_dest(); for archives it becomes top-level directory.
+        :param backend: destination object or None for the local file system
+        :return: None
+        """
+        self._dest = backend
+        if self._dest is None:
+            self._dest = lolly_dest.DiskDestination()
+
     def set_definitions(self, condition_list):
         """
         Sets condition definitions that will be used during template instantiation and when parsing lollywiz.txt.
@@ -118,7 +187,10 @@ class LollyWiz:
     def set_replacements(self, replacement_dict):
         """
         Sets condition definitions that will be used during template instantiation and when parsing lollywiz.txt.
-        :param replacement_dict: dict of string:string pairs
+        A value may also be a callable without arguments (or lolly_helpers.LazyValue) that returns a string,
+        e.g. for values that are expensive to compute: it's called at most once per instantiation and only
+        if the key occurs in lollywiz.txt or in an instantiated template.
+        :param replacement_dict: dict of string:string or string:callable pairs
         :return: None
         """
         self._is_instr_file_parsed = False  # signal re-parsing of instructions is required
@@ -127,24 +199,140 @@ class LollyWiz:
         if self.replacement_dict is None:
             self.replacement_dict = {}
 
+    def set_clock(self, clock):
+        """
+        Sets clock that common replacements (__DATE__, __DATETIME__, __TIME__, __YEAR__) are taken from.
+        All of them are derived from one snapshot per instantiation; to give a batch of LollyWiz objects
+        the same time, share one lolly_helpers.FixedClock between them.
+        :param clock: lolly_helpers.Clock or None for lolly_helpers.get_clock()
+        :return: None
+        """
+        self._is_instr_file_parsed = False  # signal re-parsing of instructions is required
+        self._clock = clock
+
+    def set_render_engine(self, engine):
+        """
+        Sets engine that renders templates: 'compiled' (default), 'reference' (the original, slow way of
+        processing templates), a registered engine or an engine object, e.g. lolly_render.VerifyingEngine
+        that compares outputs of two engines.
+        :param engine: engine name, engine object or None for the default engine
+        :return: None
+        """
+        if engine is None:
+            engine = 'compiled'
+        if isinstance(engine, str):
+            name = engine
+            engine = lolly_render.get_engine(name)
+            if engine is None:
+                self._report_procedural_error("unknown render engine '" + name + "'")
+                return
+        self._engine = engine
+
+    def set_render_backend(self, backend):
+        """
+        Sets backend that renders all templates of 'inst' instructions in one batch before instructions
+        are executed, e.g. lolly_render.ProcessPoolRenderer for CPU-heavy templates.
+        The backend is not closed by LollyWiz and may be shared by many LollyWiz objects.
+        :param backend: object with render_batch() method or None to render templates in place
+        :return: None
+        """
+        self._render_backend = backend
+
+    def set_profiler(self, profiler):
+        """
+        Profiles parsing and every instruction of instantiate() as separate sections, see lolly_profile.Profiler.
+        instantiate_async() is not profiled: other tasks of the event loop run between file operations.
+        :param profiler: lolly_profile.Profiler or None to disable profiling
+        :return: None
+        """
+        self._profiler = profiler
+
+    def set_metrics(self, metrics):
+        """
+        Sets metrics this object feeds: rendered templates, duration of instructions, errors.
+        By default it's lolly_helpers.get_metrics() at the time the object is created, see lolly_metrics.enable().
+        :param metrics: lolly_metrics.LollyMetrics or None to disable metrics
+        :return: None
+        """
+        self._metrics = metrics
+
     def instantiate(self):
         """
         Instantiates template according to parsed lollywiz.txt file.
         :return:
         """
-        # Parse instruction if not parsed yet
-        if not self._is_instr_file_parsed:
-            self._parse_instructions()
-        if not self.error:
-            # Execute each instruction
-            for i in self._instr_file_data:
-                if self.error:
-                    break
-                self._execute_instruction(i)
-            self._is_instr_file_parsed = True
+        if self._profiler is None:
+            self._run_steps(self._instantiate_steps(None))
+            return
+        self._profiler.begin()
+        try:
+            self._run_steps(self._instantiate_steps(self._profiler))
+        finally:
+            self._profiler.end()
+
+    async def instantiate_async(self):
+        """
+        Asynchronous variant of instantiate(). Blocking file operations are offloaded to the bounded
+        thread pool of lolly_helpers.run_blocking_io(), so many templates (each with its own LollyWiz object)
+        may be instantiated concurrently on one event loop, e.g. with asyncio.gather().
+        The task may be cancelled at any file operation, in this case destination may be left partially instantiated.
+        :return:
+        """
+        await self._run_steps_async(self._instantiate_steps(None))
 
     # PRIVATE METHODS
 
+    def _instantiate_steps(self, profiler):
+        """
+        Steps of instantiate() and instantiate_async(): parsing of lollywiz.txt, batch prerendering and
+        every instruction are phases, see _instantiation_phase().
+        :param profiler: lolly_profile.Profiler or None
+        :return: None
+        """
+        self.replacement_dict = lolly_helpers.bind_lazy_values(self.replacement_dict)
+        if not self._is_instr_file_parsed:
+            with self._instantiation_phase(profiler, 'parse ' + self.INSTRUCTION_FILE_NAME):
+                if self._is_src_dir_set and self._is_dest_dir_set and not self._is_instr_file_read:
+                    yield from self._read_instruction_file_steps()
+                    if not self._is_instr_file_read:
+                        return
+                self._parse_instructions()
+        if self.error:
+            return
+        if self._render_backend is not None:
+            with self._instantiation_phase(profiler, 'prerender'):
+                yield from self._prerender_steps()
+        for i in self._instr_file_data:
+            if self.error:
+                break
+            with self._instantiation_phase(profiler, None, i):
+                yield from self._instruction_steps(i)
+        self._is_instr_file_parsed = True
+        self._prerendered = {}
+        self._partials = {}
+        self._key_index = {}
+        if self._metrics is not None and not self.error:
+            self._metrics.instantiations.inc()
+
+    @contextlib.contextmanager
+    def _instantiation_phase(self, profiler, name, i=None):
+        """
+        Profiles the body of a with statement as section 'name' of 'profiler' (if it's not None).
+        Duration of instruction 'i' is observed in metrics, its section is named after the instruction.
+        """
+        timer = lolly_helpers.Timer() if i is not None and self._metrics is not None else None
+        try:
+            if profiler is None:
+                yield
+            else:
+                if i is not None:
+                    name = i['cmd'] + ' ' + ' '.join("'" + arg + "'" for arg in i['args'])
+                with profiler.section(name):
+                    yield
+        finally:
+            if timer is not None:
+                self._metrics.instruction_seconds.observe(timer.stop(), (i['cmd'],))
+
     def _check_version(self, str_list):
         """
         Search for LOLLYWIZ_TEXTFILE_VERSION in str_list and check
@@ -153,6 +341,7 @@ class LollyWiz:
         :param str_list: list of strings
         :return: processed str_list;
         """
+        import semver
         if self.error == 'version':
             self.error = ''
         v_index = lolly_helpers.find_line_starting_with_seq(str_list, self._TEXTFILE_VERSION_VAR_NAME)
@@ -181,13 +370,16 @@ class LollyWiz:
 
     def _generate_common_replacements(self):
         """
-        Generates common replacements such as __DATE__, __DATETIME__, __TIME__, __YEAR__
+        Generates common replacements such as __DATE__, __DATETIME__, __TIME__, __YEAR__.
+        They are lazy: the clock is read only if any of them is used, once for all of them.
         :return: None
         """
-        self.replacement_dict['__DATE__'] = lolly_helpers.current_date_utc()
-        self.replacement_dict['__DATETIME__'] = lolly_helpers.current_datetime_utc()
-        self.replacement_dict['__TIME__'] = lolly_helpers.current_time_utc()
-        self.replacement_dict['__YEAR__'] = lolly_helpers.current_year_utc()
+        clock = self._clock if self._clock is not None else lolly_helpers.get_clock()
+        snapshot = lolly_helpers.LazyValue(clock.snapshot)
+        self.replacement_dict['__DATE__'] = lolly_helpers.LazyValue(lambda: snapshot().date)
+        self.replacement_dict['__DATETIME__'] = lolly_helpers.LazyValue(lambda: snapshot().datetime)
+        self.replacement_dict['__TIME__'] = lolly_helpers.LazyValue(lambda: snapshot().time)
+        self.replacement_dict['__YEAR__'] = lolly_helpers.LazyValue(lambda: snapshot().year)
 
     def _parse_instructions(self):
         if not self._is_src_dir_set:
@@ -242,6 +434,99 @@ class LollyWiz:
         :param filename: string
         :return: processed data
         """
+        groups = self._parse_conditional_groups(data, filename)
+        if groups is None:
+            return data
+
+        # process data according to parsed definitions
+        processed_data = ''
+        cur_index = 0
+        if groups:
+            for g in groups:
+                # add everything before group start
+                processed_data = processed_data + data[cur_index:g['blocks'][0]['start']]
+                for b in g['blocks']:
+                    if b['is_true']:
+                        # Add block contents with matching condition
+                        processed_data = processed_data + data[b['dir_end']:b['end']]
+                cur_index = g['endif'][1]
+        # Add everything between last group and data end
+        processed_data = processed_data + data[cur_index:]
+        return processed_data
+
+    def _compile_template(self, data, filename):
+        """
+        Compiles template into a form that can be rendered with any definitions and replacements
+        without parsing the template again, see lolly_render.render_compiled().
+        'filename' is used for error messages only.
+        :param data: string
+        :param filename: string
+        :return: tuple of segments or None in case of error
+        """
+        groups = self._parse_conditional_groups(data, filename)
+        if groups is None:
+            return None
+        segments = []
+        cur_index = 0
+        for g in groups:
+            text = self._split_includes(data[cur_index:g['blocks'][0]['start']], filename)
+            if text is None:
+                return None
+            segments.extend(text)
+            blocks = []
+            for b in g['blocks']:
+                text = self._split_includes(data[b['dir_end']:b['end']], filename)
+                if text is None:
+                    return None
+                blocks.append((b['cond'], text[0] if len(text) == 1 and text[0].__class__ is str else tuple(text)))
+            segments.append(tuple(blocks))
+            cur_index = g['endif'][1]
+        text = self._split_includes(data[cur_index:], filename)
+        if text is None:
+            return None
+        segments.extend(text)
+        return tuple(segments)
+
+    def _split_includes(self, data, filename):
+        """
+        Splits text at [## include path ##] directives.
+        'filename' is used for error messages only.
+        :param data: string without conditional groups
+        :param filename: string
+        :return: list of literal strings and include segments (see lolly_render) or None in case of error
+        """
+        segments = []
+        cur_index = 0
+        search_index = 0
+        remove_trailing_newlines = self.OPTIONS['remove_trailing_new_lines_after_conditional_directives_in_template']
+        while True:
+            found = lolly_helpers.substr_enclosed_in_seq(data, self.COND_START_SEQ, self.COND_END_SEQ,
+                                                         search_index, -1, remove_trailing_newlines)
+            if found['start'] == -1 or found['error']:
+                break
+            search_index = found['end']
+            inst = lolly_helpers.split_line_into_cmd_and_args(found['value'])
+            if inst['cmd'] != lolly_render.INCLUDE:
+                continue
+            if len(inst['args']) != 1:
+                self._report_syntax_error("'include' in source file '" + filename +
+                                          "' must have exactly one argument.")
+                return None
+            segments.append(data[cur_index:found['start']])
+            segments.append((lolly_render.INCLUDE, inst['args'][0]))
+            cur_index = found['end']
+        segments.append(data[cur_index:])
+        return segments
+
+    def _parse_conditional_groups(self, data, filename):
+        """
+        Finds all if/elif/else/endif groups in data. Each block of a group keeps its condition ('cond',
+        None for 'else') and 'is_true' flag that is evaluated according to self.definitions.
+        'filename' is used for error messages only.
+        :param data: string
+        :param filename: string
+        :return: list of groups or None in case of error
+        """
         groups = []
         iterations = 0
         cur_index = 0
@@ -253,7 +538,7 @@ class LollyWiz:
             if iterations > self._MAX_LOOP_ITERS:
                 self._report_procedural_error("endless loop detected in _process_conditional_directives. "
                                               "Report this to the developer.")
-                return data
+                return None
 
             group = {'blocks': [], 'endif': [-1, -1]}
 
@@ -264,13 +549,15 @@ class LollyWiz:
             else:
                 inst = found[0]
                 cur_index = found[2]
-                if_block = {'start': found[1], 'dir_end': found[2], 'end': -1, 'is_true': False}  # -1: not yet known
+                if_block = {'start': found[1], 'dir_end': found[2], 'end': -1,  # -1: not yet known
+                            'cond': None, 'is_true': False}
                 # check number of arguments and if condition is true
                 if len(inst['args']) != 1:
                     self._report_syntax_error("'if' in source file '" + filename +
                                               "' must have exactly one argument.")
-                    return data
-                if inst['args'][0] in self.definitions:
+                    return None
+                if_block['cond'] = inst['args'][0]
+                if if_block['cond'] in self.definitions:
                     if_block['is_true'] = True
                 group['blocks'].append(if_block)
 
@@ -279,7 +566,7 @@ class LollyWiz:
                 if found[0] is None:
                     self._report_syntax_error("'if' directive does not have matching 'endif' in source file '"
                                               + filename + "'.")
-                    return data
+                    return None
                 else:  # in case 'endif' found
                     group['endif'] = [found[1], found[2]]
                     group['blocks'][0]['end'] = group['endif'][0]
@@ -293,12 +580,12 @@ class LollyWiz:
                     else:  # if 'else' directive found
                         inst = found[0]
                         else_block = {'start': found[1], 'dir_end': found[2], 'end': group['endif'][0],
-                                      'is_true': False}
+                                      'cond': None, 'is_true': False}
                         # check number of arguments and that condition is true
                         if len(inst['args']):
                             self._report_syntax_error("'else' in source file '" + filename +
                                                       "' must not have arguments.")
-                            return data
+                            return None
                         # 3.1 Check if any conditional directives between 'if' and 'else'
                         if self._no_conditional_directives_in_range(data, filename, if_block['dir_end'],
                                                                     else_block['start']):
@@ -316,7 +603,7 @@ class LollyWiz:
                         else:
                             self._report_syntax_error("there must be no directives between 'else' and 'endif' "
                                                       "in source file '" + filename + "'.")
-                            return data
+                            return None
 
                 # Fetch all elif blocks
                 cur_index = if_block['dir_end']
@@ -363,22 +650,7 @@ class LollyWiz:
 
                 cur_index = group['endif'][1]
                 search_lim_index = -1
-
-        # process data according to parsed definitions
-        processed_data = ''
-        cur_index = 0
-        if groups:
-            for g in groups:
-                # add everything before group start
-                processed_data = processed_data + data[cur_index:g['blocks'][0]['start']]
-                for b in g['blocks']:
-                    if b['is_true']:
-                        # Add block contents with matching condition
-                        processed_data = processed_data + data[b['dir_end']:b['end']]
-                cur_index = g['endif'][1]
-        # Add everything between last group and data end
-        processed_data = processed_data + data[cur_index:]
-        return processed_data
+        return groups
 
     def _get_first_cond_directive(self, data, data_filename, directive_name, from_index, to_index):
         result = [None, -1, -1]
@@ -481,14 +753,15 @@ class LollyWiz:
             else:
                 inst = found[0]
                 block = {'start': found[1], 'dir_end': found[2], 'end': -1,
-                         'is_true': False}  # -1 means: not yet known
+                         'cond': None, 'is_true': False}  # -1 means: not yet known
                 # check number of arguments
                 if len(inst['args']) != 1:
                     self._report_syntax_error("'elif' in source file '" + filename +
                                               "' must have exactly one argument.")
                     return result
                 # Check condition
-                if inst['args'][0] in self.definitions:
+                block['cond'] = inst['args'][0]
+                if block['cond'] in self.definitions:
                     block['is_true'] = True
                 result.append(block)
                 from_index = found[2]
@@ -523,43 +796,380 @@ class LollyWiz:
             if not self._check_instruction_supported(parsed):
                 self._report_syntax_error("unknown instruction '" + parsed['cmd'] + "'")
                 return
+            self._resolve_instruction_paths(parsed)
             validated.append(parsed)
         self._instr_file_data = validated
 
+    def _resolve_instruction_paths(self, i):
+        """
+        Appends dest root part to instruction arguments (must be done once, right after parsing),
+        source paths stay relative to the template source.
+        Wrong number of arguments is reported later, when the instruction is executed.
+        :param i: parsed instruction
+        :return: None
+        """
+        index = self._dest_arg_index(i)
+        if index is not None:
+            i['args'][index] = self.dest_root_dir + self.PATH_DELIMITER_CHAR + i['args'][index]
+
+    def _dest_arg_index(self, i):
+        """
+        :param i: parsed instruction
+        :return: index of the argument that is a destination path or None
+        """
+        if i['cmd'] in ('inst', 'copy') and len(i['args']) == 2:
+            return 1
+        if i['cmd'] == 'inst_each' and len(i['args']) == 3:
+            return 1
+        if i['cmd'] in ('remove', 'mkdir') and len(i['args']) == 1:
+            return 0
+        return None
+
     # Instruction executors
-    def _execute_inst(self, i):
+    #
+    # Each executor is a generator that yields file operations as tuples (function, arg1, arg2...)
+    # and receives the result of the operation back. This way the same instruction logic is driven
+    # synchronously by _run_steps() and asynchronously by _run_steps_async().
+
+    def _run_steps(self, steps):
+        """
+        Executes all file operations yielded by 'steps' generator in the calling thread.
+        :param steps: generator
+        :return: None
+        """
+        try:
+            op = next(steps)
+            while True:
+                op = steps.send(op[0](*op[1:]))
+        except StopIteration:
+            pass
+
+    async def _run_steps_async(self, steps):
+        """
+        Executes all file operations yielded by 'steps' generator in the thread pool of lolly_helpers.
+        :param steps: generator
+        :return: None
+        """
+        try:
+            op = next(steps)
+            while True:
+                result = await lolly_helpers.run_blocking_io(op[0], *op[1:])
+                op = steps.send(result)
+        except StopIteration:
+            pass
+        finally:
+            steps.close()
+
+    def _inst_steps(self, i):
         """
         Instantiates single template file
         :param i: string list
         :return: None
         """
-        # append src and dest root parts to names (must be done once)
-        if not self._is_instr_file_parsed:
-            i['args'][0] = self.src_root_dir + self.PATH_DELIMITER_CHAR + i['args'][0]
-            i['args'][1] = self.dest_root_dir + self.PATH_DELIMITER_CHAR + i['args'][1]
-
+        if len(i['args']) != 2:
+            self._report_syntax_error("'inst' has wrong number of arguments, 2 expected")
+            return
         src_filename = i['args'][0]
         dest_filename = i['args'][1]
+        if src_filename in self._prerendered:
+            contents = self._prerendered[src_filename]
+        else:
+            prepared = yield from self._engine.prepare_steps(self, src_filename)
+            if prepared is None:
+                return
+            contents = self._engine.render(prepared, self.definitions, self.replacement_dict)
+        yield from self._write_text_steps(dest_filename, contents)
+        if self._metrics is not None and not self.error:
+            self._metrics.templates_rendered.inc()
+
+    def _linked_template_steps(self, src_filename):
+        """
+        Compiled template with included partials, see _link_partials_steps().
+        :return: tuple of segments or None in case of error
+        """
+        compiled = self._src.compiled_template(src_filename, self.OPTIONS)
+        if compiled is None:
+            contents = yield (self._src.read_text_file, src_filename)
+            if contents['error']:
+                self._report_file_operation_error("can't read file '" + self._src.describe(src_filename) + "'.")
+                return None
+            compiled = self._compile_template(contents['contents'], self._src.describe(src_filename))
+            if compiled is None:
+                return None
+        return (yield from self._link_partials_steps(compiled, src_filename, ()))
+
+    def _link_partials_steps(self, compiled, filename, including):
+        """
+        Replaces include segments of a compiled template with text of the partials, so the template can be
+        rendered by lolly_render.render_compiled(). Keys are not replaced in partials, they are replaced
+        once in the whole rendered template.
+        :param compiled: tuple of segments
+        :param filename: path of the template in the source
+        :param including: tuple of paths of templates that include this one, to detect cycles
+        :return: tuple of segments or None in case of error
+        """
+        if not lolly_render.has_includes(compiled):
+            return compiled
+        linked = []
+        for segment in compiled:
+            if segment.__class__ is str:
+                linked.append(segment)
+            elif segment[0] == lolly_render.INCLUDE:
+                text = yield from self._partial_text_steps(segment[1], including + (filename,))
+                if text is None:
+                    return None
+                linked.append(text)
+            else:
+                blocks = []
+                for condition, text in segment:
+                    if text.__class__ is not str:
+                        text = yield from self._link_partials_steps(text, filename, including)
+                        if text is None:
+                            return None
+                    blocks.append((condition, text))
+                linked.append(tuple(blocks))
+        return tuple(linked)
+
+    def _partial_text_steps(self, path, including):
+        """
+        Partial with applied conditions. Each partial is read, compiled and processed once per instantiation
+        and definitions, no matter how many templates include it.
+        :param path: path of the partial in the template source
+        :param including: tuple of paths of templates that include the partial
+        :return: string or None in case of error
+        """
+        path = lolly_source._normalize(path)
+        if path in including:
+            self._report_syntax_error("include cycle: " + ' -> '.join(including + (path,)))
+            return None
+        key = (path, tuple(sorted(self.definitions)))
+        if key in self._partials:
+            return self._partials[key]
+        self._partial_files.add(path)
+        compiled = self._src.compiled_template(path, self.OPTIONS)
+        if compiled is None:
+            contents = yield (self._src.read_text_file, path)
+            if contents['error']:
+                self._report_file_operation_error("can't read partial '" + self._src.describe(path) + "' included by '"
+                                                  + self._src.describe(including[-1]) + "'.")
+                return None
+            compiled = self._compile_template(contents['contents'], self._src.describe(path))
+            if compiled is None:
+                return None
+        compiled = yield from self._link_partials_steps(compiled, path, including)
+        if compiled is None:
+            return None
+        text = lolly_render.render_compiled(compiled, self.definitions, {})
+        self._partials[key] = text
+        return text
+
+    def _write_text_steps(self, dest_filename, contents, created_dirs=None):
+        """
+        :param created_dirs: optional set of destination dirs that already exist, they are not created again
+        """
         split_df = lolly_helpers.path_base_and_leaf(dest_filename)
-        contents = lolly_helpers.silent_read_text_file(src_filename)
-        if contents['error']:
-            self._report_file_operation_error("can't read file '" + src_filename + "'.")
-            return
-        # process conditions
-        contents = self._process_conditional_directives(contents['contents'], src_filename)
-        contents = lolly_helpers.replace_keys(contents, self.replacement_dict)
         # make sure dest directory exists
-        lolly_helpers.silent_create_path(split_df['base'])
-        if not lolly_helpers.dir_exists(split_df['base']):
-            self._report_file_operation_error("can't create folder: '" + split_df['base'] + "'")
-            return
-        lolly_helpers.silent_write_text_file(dest_filename, contents)
-        if not lolly_helpers.file_exists(dest_filename):
+        if created_dirs is None or split_df['base'] not in created_dirs:
+            yield (self._dest.create_path, split_df['base'])
+            if (yield (self._dest.get_item_type, split_df['base']))['type'] != 'dir':
+                self._report_file_operation_error("can't create folder: '" + split_df['base'] + "'")
+                return
+            if created_dirs is not None:
+                created_dirs.add(split_df['base'])
+        yield (self._dest.write_text_file, dest_filename, contents)
+        if (yield (self._dest.get_item_type, dest_filename))['type'] != 'file':
             self._report_file_operation_error("can't write file: '" + dest_filename +
                                               "'")
             return
 
-    def _execute_copy(self, i):
+    def _inst_pattern_steps(self, i):
+        """
+        Instantiates all templates that match a pattern, e.g. inst 'src/**/*.lwt' 'include', as one batch:
+        src/a/b.hpp.lwt is written to include/a/b.hpp. Matching files are found when the instruction is executed.
+        :param i: parsed instruction
+        :return: None
+        """
+        dest_dir = i['args'][1].rstrip(self.PATH_DELIMITER_CHAR)
+        found = yield (self._src.glob, i['args'][0])
+        jobs = []
+        for rel_name in found['files']:
+            src_filename = found['base'] + self.PATH_DELIMITER_CHAR + rel_name if found['base'] else rel_name
+            prepared = yield from self._engine.prepare_steps(self, src_filename)
+            if prepared is None:
+                return
+            if rel_name.endswith(self.TEMPLATE_EXTENSION):
+                rel_name = rel_name[:-len(self.TEMPLATE_EXTENSION)]
+            jobs.append((dest_dir + self.PATH_DELIMITER_CHAR + rel_name, prepared, self.definitions,
+                         self.replacement_dict))
+        yield from self._render_jobs_steps(jobs)
+
+    def _inst_each_steps(self, i):
+        """
+        Instantiates one template for every item of a list, e.g.
+            inst_each 'module.hpp' 'modules/[$$MODULE$$].hpp' 'modules.json'
+        Items are a JSON list of objects with string values, taken from the replacement with the given name
+        or read from the given file of the template source. Keys of an item override replacements of
+        the template and are replaced in the destination name. The template is compiled once for all items.
+        Replacements are not applied to 'inst_each' lines of lollywiz.txt when it's parsed: the destination name
+        gets keys of the item first and then replacements, so an item key that is also a replacement still
+        makes a distinct name for every item.
+        :param i: parsed instruction
+        :return: None
+        """
+        if len(i['args']) != 3:
+            self._report_syntax_error("'inst_each' has wrong number of arguments, 3 expected")
+            return
+        src_filename, dest_pattern, items_name = i['args']
+        src_filename = lolly_helpers.replace_keys(src_filename, self.replacement_dict)
+        items_name = lolly_helpers.replace_keys(items_name, self.replacement_dict)
+        items = yield from self._inst_each_items_steps(items_name)
+        if items is None:
+            return
+        prepared = yield from self._engine.prepare_steps(self, src_filename)
+        if prepared is None:
+            return
+        jobs = []
+        dest_filenames = set()
+        for item in items:
+            item_replacements = {}
+            for key, value in item.items():
+                item_replacements[self.REPLACEMENT_START_SEQ + key + self.REPLACEMENT_END_SEQ] = value
+            dest_filename = lolly_helpers.replace_keys(dest_pattern, item_replacements)
+            dest_filename = lolly_helpers.replace_keys(dest_filename, self.replacement_dict)
+            if dest_filename in dest_filenames:
+                self._report_procedural_error("'inst_each' writes '" + dest_filename + "' more than once, "
+                                              "destination name must depend on item keys")
+                return
+            dest_filenames.add(dest_filename)
+            replacements = dict(self.replacement_dict)
+            replacements.update(item_replacements)
+            jobs.append((dest_filename, prepared, self.definitions, replacements))
+        yield from self._render_jobs_steps(jobs)
+
+    def _inst_each_items_steps(self, items_name):
+        """
+        :param items_name: name of a replacement or path of a JSON file in the template source
+        :return: list of dicts of string:string pairs or None in case of error
+        """
+        import json
+        key = self.REPLACEMENT_START_SEQ + items_name + self.REPLACEMENT_END_SEQ
+        if key in self.replacement_dict:
+            data = self.replacement_dict[key]
+            if data.__class__ is not str:
+                data = data()  # lazy value, see set_replacements()
+            description = "replacement '" + items_name + "'"
+        else:
+            description = "'" + self._src.describe(items_name) + "'"
+            contents = yield (self._src.read_text_file, items_name)
+            if contents['error']:
+                self._report_file_operation_error("can't read 'inst_each' items " + description + ".")
+                return None
+            data = contents['contents']
+        try:
+            items = json.loads(data)
+        except (ValueError, TypeError) as e:
+            self._report_syntax_error("'inst_each' items " + description + " are not valid JSON: " + str(e))
+            return None
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            self._report_syntax_error("'inst_each' items " + description + " must be a list of objects")
+            return None
+        for item in items:
+            for key, value in item.items():
+                if not isinstance(value, str):
+                    self._report_syntax_error("'inst_each' items " + description + ": value of '" + key +
+                                              "' must be a string")
+                    return None
+        return items
+
+    def _render_jobs_steps(self, jobs):
+        """
+        Renders jobs (dest file name, prepared template, definitions, replacements) with self._render_backend
+        in one batch (if the engine supports it) or in place and writes them, each destination dir is created once.
+        :return: None
+        """
+        if self._render_backend is not None and self._engine.batchable and jobs:
+            results = yield (self._render_with_backend, jobs)
+        else:
+            results = [(job[0], self._engine.render(job[1], job[2], job[3]), '') for job in jobs]
+        created_dirs = set()
+        for dest_filename, contents, error in results:
+            if error:
+                self._report_procedural_error("can't render template for '" + dest_filename + "': " + error)
+                return
+            yield from self._write_text_steps(dest_filename, contents, created_dirs)
+            if self.error:
+                return
+            if self._metrics is not None:
+                self._metrics.templates_rendered.inc()
+
+    def _prerender_steps(self):
+        """
+        Reads and compiles templates of all 'inst' instructions and renders them with self._render_backend
+        in one batch. _inst_steps() then writes rendered templates instead of rendering them in place.
+        :return: None
+        """
+        self._prerendered = {}
+        if not self._engine.batchable:
+            return  # templates are rendered by _inst_steps()
+        jobs = []
+        compiled_sources = set()
+        for i in self._instr_file_data:
+            if i['cmd'] != 'inst' or len(i['args']) != 2:
+                continue
+            src_filename = i['args'][0]
+            if src_filename in compiled_sources or lolly_source.is_pattern(src_filename):
+                continue
+            compiled_sources.add(src_filename)
+            compiled = yield from self._engine.prepare_steps(self, src_filename)
+            if compiled is None:
+                return
+            jobs.append((src_filename, compiled, self.definitions, self.replacement_dict))
+        if not jobs:
+            return
+        results = yield (self._render_with_backend, jobs)
+        for src_filename, contents, error in results:
+            if error:
+                self._report_procedural_error("can't render template '" + self._src.describe(src_filename) +
+                                              "': " + error)
+                return
+            self._prerendered[src_filename] = contents
+
+    def _render_with_backend(self, jobs):
+        return list(self._render_backend.render_batch([self._resolve_lazy_replacements(job) for job in jobs]))
+
+    def _resolve_lazy_replacements(self, job):
+        """
+        Render backends may render in other processes, so lazy values are computed before jobs are sent.
+        Only lazy values of keys in the key-usage index of the template (see lolly_render.used_keys())
+        are computed, unless a value may bring other keys into the rendered text.
+        :param job: tuple (job id, compiled template, definitions, replacements)
+        :return: job with string replacements
+        """
+        job_id, compiled, definitions, replacements = job
+        if all(value.__class__ is str for value in replacements.values()):
+            return job
+        keys = self._key_index.get(compiled)  # keyed by the tuple itself, an id may be reused by a new template
+        if keys is None:
+            keys = self._key_index[compiled] = lolly_render.used_keys(compiled, self.REPLACEMENT_START_SEQ,
+                                                                      self.REPLACEMENT_END_SEQ)
+        used = dict((key, value()) for key, value in replacements.items()
+                    if value.__class__ is not str and key in keys)
+        # keys replaced in order may also replace keys brought by values of preceding keys
+        chained = any(self.REPLACEMENT_START_SEQ in value for value in used.values()) or \
+            any(value.__class__ is str and self.REPLACEMENT_START_SEQ in value for value in replacements.values())
+        resolved = {}
+        for key, value in replacements.items():
+            if value.__class__ is not str:
+                if key in used:
+                    value = used[key]
+                elif chained:
+                    value = value()
+                else:
+                    continue
+            resolved[key] = value
+        return job_id, compiled, definitions, resolved
+
+    def _copy_steps(self, i):
         """
         Copies file or dir tree. If src is directory, dest with same name will be removed before copying.
         :param i:
@@ -568,76 +1178,124 @@ class LollyWiz:
         if len(i['args']) != 2:
             self._report_syntax_error("'copy' has wrong number of arguments, 2 expected")
             return
-        # append src and dest root parts to names (must be done once)
-        if not self._is_instr_file_parsed:
-            i['args'][0] = self.src_root_dir + self.PATH_DELIMITER_CHAR + i['args'][0]
-            i['args'][1] = self.dest_root_dir + self.PATH_DELIMITER_CHAR + i['args'][1]
-
         src_filename = i['args'][0]
         dest_filename = i['args'][1]
 
-        src_props = lolly_helpers.get_filesystem_item_type(src_filename)
+        src_props = yield (self._src.get_item_type, src_filename)
         if not src_props['exists']:
-            self._report_file_operation_error("required source '" + src_filename + "' doesn't exist")
+            self._report_file_operation_error("required source '" + self._src.describe(src_filename) +
+                                              "' doesn't exist")
             return
-        dest_props = lolly_helpers.get_filesystem_item_type(dest_filename)
+        dest_props = yield (self._dest.get_item_type, dest_filename)
 
         # delete old filesystem entity if exists
         if dest_props['exists']:
             if dest_props['type'] == 'dir':
-                lolly_helpers.silent_remove_dir(dest_filename)
+                yield (self._dest.remove_dir, dest_filename)
             elif dest_props['type'] == 'file':
-                lolly_helpers.silent_remove_file(dest_filename)
+                yield (self._dest.remove_file, dest_filename)
             elif dest_props['type'] == 'symlink':
-                lolly_helpers.silent_remove_symlink(dest_filename)
-        dest_props = lolly_helpers.get_filesystem_item_type(dest_filename)
+                yield (self._dest.remove_symlink, dest_filename)
+        dest_props = yield (self._dest.get_item_type, dest_filename)
 
         # report error if old destination can't be deleted
         if dest_props['exists']:
-            self._report_file_operation_error("can't delete file or folder: '" + src_filename +
+            self._report_file_operation_error("can't delete file or folder: '" + dest_filename +
                                               "'")
             return
 
-        # copy src to dest
+        # copy src to dest; local files are copied directly, other sources are read and written
+        local_src = self._src.local_path(src_filename)
         if src_props['type'] == 'dir':
-            lolly_helpers.silent_copy_dir(src_filename, dest_filename)
+            if local_src is not None:
+                yield (self._dest.copy_dir, local_src, dest_filename)
+            else:
+                yield from self._copy_source_dir_steps(src_filename, dest_filename)
         elif src_props['type'] == 'file':
-            lolly_helpers.silent_copy_file(src_filename, dest_filename)
+            if local_src is not None:
+                yield (self._dest.copy_file, local_src, dest_filename)
+            else:
+                yield from self._copy_source_file_steps(src_filename, dest_filename)
         elif src_props['type'] == 'symlink':
             pass  # TODO: deside how to be with symlinks, for now just ignore them
 
-        dest_props = lolly_helpers.get_filesystem_item_type(dest_filename)
+        dest_props = yield (self._dest.get_item_type, dest_filename)
 
         # report error if destination does not exist
         if not dest_props['exists']:
-            self._report_file_operation_error("can't create file or folder: '" + src_filename +
+            self._report_file_operation_error("can't create file or folder: '" + dest_filename +
                                               "'")
 
-    def _execute_remove(self, i):
+    def _copy_pattern_steps(self, i):
+        """
+        Copies all files that match a pattern, e.g. copy 'assets/**/*.png' 'img', keeping their paths
+        relative to the directory that precedes the first wildcard. Existing files are overwritten.
+        :param i: parsed instruction
+        :return: None
+        """
+        dest_dir = i['args'][1].rstrip(self.PATH_DELIMITER_CHAR)
+        found = yield (self._src.glob, i['args'][0])
+        created_dirs = set()
+        for rel_name in found['files']:
+            src_filename = found['base'] + self.PATH_DELIMITER_CHAR + rel_name if found['base'] else rel_name
+            dest_filename = dest_dir + self.PATH_DELIMITER_CHAR + rel_name
+            split_df = lolly_helpers.path_base_and_leaf(dest_filename)
+            if split_df['base'] not in created_dirs:
+                if (yield (self._dest.create_path, split_df['base']))['error']:
+                    self._report_file_operation_error("can't create folder: '" + split_df['base'] + "'")
+                    return
+                created_dirs.add(split_df['base'])
+            local_src = self._src.local_path(src_filename)
+            if local_src is not None:
+                if (yield (self._dest.copy_file, local_src, dest_filename))['error']:
+                    self._report_file_operation_error("can't copy file '" + local_src + "'")
+                    return
+            else:
+                yield from self._copy_source_file_steps(src_filename, dest_filename)
+                if self.error:
+                    return
+
+    def _copy_source_file_steps(self, src_filename, dest_filename):
+        data = yield (self._src.read_binary_file, src_filename)
+        if data['error']:
+            self._report_file_operation_error("can't read file '" + self._src.describe(src_filename) + "'.")
+            return
+        yield (self._dest.write_binary_file, dest_filename, data['contents'])
+
+    def _copy_source_dir_steps(self, src_dirname, dest_dirname):
+        yield (self._dest.create_path, dest_dirname)
+        entries = yield (self._src.walk, src_dirname)
+        for rel_name, item_type in entries:
+            if item_type == 'dir':
+                yield (self._dest.create_path, dest_dirname + self.PATH_DELIMITER_CHAR + rel_name)
+            else:
+                yield from self._copy_source_file_steps(src_dirname + self.PATH_DELIMITER_CHAR + rel_name,
+                                                        dest_dirname + self.PATH_DELIMITER_CHAR + rel_name)
+                if self.error:
+                    return
+
+    def _remove_steps(self, i):
         # print("*DEBUG removing: ", i)
         if len(i['args']) != 1:
             self._report_syntax_error("'remove' must have one argument")
             return
-        # append src and dest root parts to names (must be done once)
-        if not self._is_instr_file_parsed:
-            i['args'][0] = self.dest_root_dir + self.PATH_DELIMITER_CHAR + i['args'][0]
         filename = i['args'][0]
-        file_props = lolly_helpers.get_filesystem_item_type(filename)
+        file_props = yield (self._dest.get_item_type, filename)
         if not file_props['exists']:  # nothing to remove
             return
 
         if file_props['type'] == 'dir':
-            lolly_helpers.silent_remove_dir(filename)
+            yield (self._dest.remove_dir, filename)
         elif file_props['type'] == 'file':
-            lolly_helpers.silent_remove_file(filename)
-        file_props = lolly_helpers.get_filesystem_item_type(filename)
+            yield (self._dest.remove_file, filename)
+        file_props = yield (self._dest.get_item_type, filename)
         # report error if old destination can't be deleted
         if file_props['exists']:
             self._report_file_operation_error("can't delete file or folder: '" +
                                               filename + "'")
             return
 
-    def _execute_mkdir(self, i):
+    def _mkdir_steps(self, i):
         """
         Creates new directory if doesn't exist;
         :param i: string list
@@ -646,33 +1304,43 @@ class LollyWiz:
         if len(i['args']) != 1:
             self._report_syntax_error("'mkdir' must have one argument")
             return
-        # append src and dest root parts to names (must be done once)
-        if not self._is_instr_file_parsed:
-            i['args'][0] = self.dest_root_dir + self.PATH_DELIMITER_CHAR + i['args'][0]
         dirname = i['args'][0]
-        file_props = lolly_helpers.get_filesystem_item_type(dirname)
+        file_props = yield (self._dest.get_item_type, dirname)
         if file_props['exists']:  # nothing to remove
             if file_props['type'] == 'dir':
                 return
             if file_props['type'] == 'file':
-                lolly_helpers.silent_remove_file(dirname)
+                yield (self._dest.remove_file, dirname)
             if file_props['type'] == 'symlink':
-                lolly_helpers.silent_remove_symlink(dirname)
+                yield (self._dest.remove_symlink, dirname)
             else:  # item exists and is of unknown type
                 self._report_syntax_error("'mkdir' can't remove existing '" + dirname + "'")
                 return
-        lolly_helpers.silent_create_path(dirname)
+        yield (self._dest.create_path, dirname)
 
-    def _execute_instruction(self, i):
+    def _instruction_steps(self, i):
         # print ("* Debug executing instruction: ", i)
+        if self._is_pattern_instruction(i):  # instruction applies to all files that match a pattern
+            if i['cmd'] == 'copy':
+                return self._copy_pattern_steps(i)
+            return self._inst_pattern_steps(i)
         if i['cmd'] == 'copy':  # copies file or directory tree without changes
-            self._execute_copy(i)
+            return self._copy_steps(i)
         elif i['cmd'] == 'inst':  # instantiates template
-            self._execute_inst(i)
+            return self._inst_steps(i)
+        elif i['cmd'] == 'inst_each':  # instantiates template for every item of a list
+            return self._inst_each_steps(i)
         elif i['cmd'] == 'remove':  # removes file or directory tree
-            self._execute_remove(i)
+            return self._remove_steps(i)
         elif i['cmd'] == 'mkdir':  # creates an empty dir
-            self._execute_mkdir(i)
+            return self._mkdir_steps(i)
+        return iter(())
+
+    def _is_pattern_instruction(self, i):
+        return i['cmd'] in ('inst', 'copy') and len(i['args']) == 2 and lolly_source.is_pattern(i['args'][0])
+
+    def _execute_instruction(self, i):
+        self._run_steps(self._instruction_steps(i))
 
     def _clear_error(self):
         self.error = ''
@@ -682,26 +1350,45 @@ class LollyWiz:
               self._instr_file_full_path, ': ',
               msg)
         self.error = 'version'
+        if self._metrics is not None:
+            self._metrics.errors.inc(1, ('version',))
 
     def _report_syntax_error(self, msg):
         print("* LollyWiz syntax error in file ",
               self._instr_file_full_path, ': ',
               msg)
         self.error = 'syntax'
+        if self._metrics is not None:
+            self._metrics.errors.inc(1, ('syntax',))
 
     def _report_file_operation_error(self, msg):
         print("* LollyWiz file operation error: ",
               msg)
         self.error = 'file'
+        if self._metrics is not None:
+            self._metrics.errors.inc(1, ('file',))
 
     def _report_procedural_error(self, msg):
         print("* LollyWiz procedural error: ",
               msg)
         self.error = 'procedural'
+        if self._metrics is not None:
+            self._metrics.errors.inc(1, ('procedural',))
 
     def _read_instruction_file(self):
+        self._run_steps(self._read_instruction_file_steps())
+
+    def _read_instruction_file_steps(self):
         self._is_instr_file_read = False
-        raw_file_contents = lolly_helpers.silent_read_text_file(self._instr_file_full_path)
+        compiled = self._src.compiled_template(self.INSTRUCTION_FILE_NAME, self.OPTIONS)
+        if compiled is not None:
+            if lolly_render.has_includes(compiled):
+                self._report_syntax_error("'include' is not supported in instruction file")
+                return
+            self._instr_file_data = compiled  # conditional directives are applied without parsing
+            self._is_instr_file_read = True
+            return
+        raw_file_contents = yield (self._src.read_text_file, self.INSTRUCTION_FILE_NAME)
         if raw_file_contents['error']:
             self._report_file_operation_error("can't read instruction file '" + self._instr_file_full_path + "'")
             return
@@ -715,20 +1402,29 @@ class LollyWiz:
         self._instr_file_data = self._parse_instr_file_default_replacement_map(self._instr_file_data)
 
     def _remove_comments(self, the_string):
-        iterations = 0
-        while True:
-            iterations += 1
-            if iterations >= self._MAX_LOOP_ITERS:
-                self._report_procedural_error("endless loop detected in '_remove_comments() method'")
-                return ''
-            result = lolly_helpers.extract_substr_enclosed_in_seq(the_string, self.COMMENT_START_SEQ,
-                                                                  self.COMMENT_END_SEQ)
-            if result['error']:
+        """
+        Removes comments. A comment may start anywhere except inside a quoted value (quotes start a value
+        and do not span lines), so patterns with '/*' like 'src/**/*.lwt' must be quoted in instructions.
+        :param the_string: string
+        :return: string without comments or empty string in case of error
+        """
+        import re
+        start = re.escape(self.COMMENT_START_SEQ)
+        end = re.escape(self.COMMENT_END_SEQ)
+        quoted = r"""(?<![^\s=])'[^'\n]*'?|(?<![^\s=])"[^"\n]*"?"""
+        comment = start + '(?:(?!' + start + ').)*?' + end  # comments are not nested
+        tokens = re.compile(quoted + '|' + comment + '|(' + start + ')', re.DOTALL)
+        parts = []
+        pos = 0
+        for match in tokens.finditer(the_string):
+            if match.group(1) is not None:
                 self._report_syntax_error("unterminated comment.")
                 return ''
-            if not result['extracted']:
-                return result['remainder']
-            the_string = result['remainder']
+            if match.group(0).startswith(self.COMMENT_START_SEQ):
+                parts.append(the_string[pos:match.start()])
+                pos = match.end()
+        parts.append(the_string[pos:])
+        return ''.join(parts)
 
     def _parse_instr_file_default_replacement_map(self, doc):
         initial_seq = '#default_replacement_map_begin'
@@ -762,7 +1458,16 @@ class LollyWiz:
 
     def _apply_replacements_to_instr_file(self):
         self._setup_instr_file_replacements()
-        self._instr_file_data = lolly_helpers.replace_in_string_list(self._instr_file_data, self.replacement_dict)
+        tmp = []
+        for line in self._instr_file_data:
+            if lolly_helpers.extract_first_word(line)['value'] == 'inst_each':
+                tmp.append(line)  # keys of items may be replacements too, arguments are replaced when executed
+            else:
+                tmp.append(lolly_helpers.replace_keys(line, self.replacement_dict))
+        self._instr_file_data = tmp
 
     def _apply_definitions_to_instr_file(self):
+        if isinstance(self._instr_file_data, tuple):  # precompiled instruction file
+            self._instr_file_data = lolly_render.render_compiled(self._instr_file_data, self.definitions, {})
+            return
         self._instr_file_data = self._process_conditional_directives(self._instr_file_data, self._instr_file_full_path)
@@ -1,18 +1,17 @@
 import unittest
 import os
-import sys
 import ntpath
 
 
 def run(test_name='all'):
     loader = unittest.TestLoader()
     head, tail = ntpath.split(os.path.realpath(__file__))
-    sys.path.append(head)
     start_dir = head + '/tests'
+    top_level_dir = os.path.dirname(head)  # tests are imported as lollylib.tests.*
     if test_name == 'all':
-        suite = loader.discover(start_dir)
+        suite = loader.discover(start_dir, top_level_dir=top_level_dir)
 
     else:
-        suite = loader.discover(start_dir, test_name + '*')
+        suite = loader.discover(start_dir, test_name + '*', top_level_dir=top_level_dir)
     runner = unittest.TextTestRunner()
     runner.run(suite)
@@ -13,11 +13,11 @@ import sys
 import ntpath
 
 """
-Following code adds parent directory of this file to sys.path so that
-all python files in the parent directory can be directly imported by tests.
-Thus, the tests will always use library version
-located in their parent dir.
+Tests import the library as package 'lollylib'. Following code makes the directory that contains
+the package importable, so that the tests always use library version located in their parent dir.
 """
 
 head, tail = ntpath.split(os.path.realpath(__file__))
-sys.path.append(os.path.dirname(head))
+package_parent_dir = os.path.dirname(os.path.dirname(head))
+if package_parent_dir not in sys.path:
+    sys.path.insert(0, package_parent_dir)
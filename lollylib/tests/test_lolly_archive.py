@@ -0,0 +1,138 @@
+from unittest import TestCase
+import io
+import os
+import ntpath
+import tarfile
+from pathlib import Path
+from lollylib import lolly_archive
+from lollylib import lolly_helpers
+
+
+class TestLollyArchive(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyArchive, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.TEST_DATA_DIR = head + '/test_data'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+        self.ARCH_DIR = self.TMP_DIR + '/archive_tests'
+
+    def __create_test_tree(self):
+        """ Creates directory 'tree' with several files, some of which are larger than compression block """
+        tree = self.ARCH_DIR + '/tree'
+        lolly_helpers.silent_remove_dir(self.ARCH_DIR)
+        lolly_helpers.silent_create_path(tree + '/sub/deeper')
+        if not lolly_helpers.dir_exists(tree):
+            raise OSError("'TestLollyArchive' error: can't create temporary directory '" + tree + "'")
+        lolly_helpers.silent_write_text_file(tree + '/small.txt', 'small file')
+        lolly_helpers.silent_write_text_file(tree + '/sub/big.txt', 'line of text\n' * 20000)
+        lolly_helpers.silent_write_text_file(tree + '/sub/deeper/other.txt', 'other file\n' * 5000)
+        return tree
+
+    def test_compression_from_filename(self):
+        assert lolly_archive.compression_from_filename('a.tar.gz') == 'gz'
+        assert lolly_archive.compression_from_filename('A.TGZ') == 'gz'
+        assert lolly_archive.compression_from_filename('a.tar.xz') == 'xz'
+        assert lolly_archive.compression_from_filename('a.tar') == ''
+        assert lolly_archive.compression_from_filename('a.zip') is None
+
+    def test_parallel_compressed_writer(self):
+        data = b''.join([str(n).encode() + b' some data\n' for n in range(50000)])
+        for compression in lolly_archive.supported_compressions():
+            out = io.BytesIO()
+            with lolly_archive.ParallelCompressedWriter(out, compression, threads=4, block_size=64 * 1024) as w:
+                w.write(data[:1000])
+                w.write(data[1000:])
+            assert w.bytes_in == len(data) and w.bytes_out == len(out.getvalue())
+            out.seek(0)
+            with lolly_archive._open_decompressed(io.BufferedReader(out)) as stream:
+                assert stream.read() == data
+
+    def test_create_and_extract_archive(self):
+        tree = self.__create_test_tree()
+        arch = self.ARCH_DIR + '/tree.tar.gz'
+        progress = []
+        result = lolly_archive.create_archive(tree, arch, threads=4, block_size=16 * 1024, progress=progress.append)
+        assert not result['error']
+        assert result['members'] == 6 and len(progress) == 6
+        assert lolly_helpers.file_exists(arch) and not lolly_helpers.file_exists(arch + '.part')
+
+        # the archive is readable by standard tarfile
+        with tarfile.open(arch, 'r:gz') as tar:
+            assert sorted(tar.getnames()) == ['tree', 'tree/small.txt', 'tree/sub', 'tree/sub/big.txt',
+                                              'tree/sub/deeper', 'tree/sub/deeper/other.txt']
+
+        # extract selected members only
+        dest = self.ARCH_DIR + '/extracted'
+        result = lolly_archive.extract_archive(arch, dest, members=['tree/small.txt'])
+        assert not result['error'] and result['extracted'] == ['tree/small.txt']
+        assert lolly_helpers.file_exists(dest + '/tree/small.txt')
+        assert not lolly_helpers.dir_exists(dest + '/tree/sub')
+
+        # a directory selects its contents
+        result = lolly_archive.extract_archive(arch, dest, members=['tree/sub/deeper'])
+        assert not result['error']
+        assert result['extracted'] == ['tree/sub/deeper', 'tree/sub/deeper/other.txt']
+
+        # files that are already up to date are skipped
+        result = lolly_archive.extract_archive(arch, dest)
+        assert not result['error']
+        # existing directories are skipped as well
+        assert result['skipped'] == ['tree', 'tree/small.txt', 'tree/sub', 'tree/sub/deeper',
+                                     'tree/sub/deeper/other.txt']
+        assert result['extracted'] == ['tree/sub/big.txt']
+        expected = lolly_helpers.silent_read_text_file(tree + '/sub/big.txt')['contents']
+        assert lolly_helpers.silent_read_text_file(dest + '/tree/sub/big.txt')['contents'] == expected
+
+        result = lolly_archive.extract_archive(arch, dest, skip_existing=False, members=lambda n: n.endswith('.txt'))
+        assert len(result['extracted']) == 3 and not result['skipped']
+
+    def test_other_compressions(self):
+        tree = self.__create_test_tree()
+        for compression in lolly_archive.supported_compressions():
+            arch = self.ARCH_DIR + '/tree_' + compression + '.tar'
+            result = lolly_archive.create_archive(tree, arch, compression=compression, block_size=32 * 1024)
+            assert not result['error']
+            dest = self.ARCH_DIR + '/extracted_' + compression
+            result = lolly_archive.extract_archive(arch, dest)
+            assert not result['error'] and len(result['extracted']) == 6
+
+    def test_unsafe_members_are_rejected(self):
+        lolly_helpers.silent_create_path(self.ARCH_DIR)
+        arch = self.ARCH_DIR + '/unsafe.tar'
+        with tarfile.open(arch, 'w') as tar:
+            for name in ['../escape.txt', '/absolute.txt', 'good.txt']:
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b'data'))
+            link = tarfile.TarInfo('link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '../../outside'
+            tar.addfile(link)
+        dest = self.ARCH_DIR + '/unsafe'
+        result = lolly_archive.extract_archive(arch, dest)
+        assert not result['error']
+        if hasattr(tarfile, 'data_filter'):
+            # the 'data' extraction filter writes absolute names below the destination
+            assert result['extracted'] == ['/absolute.txt', 'good.txt']
+            assert sorted(result['rejected']) == ['../escape.txt', 'link']
+            assert lolly_helpers.file_exists(dest + '/absolute.txt')
+        else:
+            assert result['extracted'] == ['good.txt']
+            assert sorted(result['rejected']) == ['../escape.txt', '/absolute.txt', 'link']
+        assert not lolly_helpers.file_exists(self.ARCH_DIR + '/escape.txt')
+        # fallback check of Pythons without extraction filters
+        for name in ['../escape.txt', '/absolute.txt']:
+            assert not lolly_archive.is_safe_member(tarfile.TarInfo(name), dest)
+        assert lolly_archive.is_safe_member(tarfile.TarInfo('good.txt'), dest)
+
+    def test_sad_path(self):
+        assert lolly_archive.create_archive(self.ARCH_DIR + '/not_exists', self.ARCH_DIR + '/a.tar.gz')['error']
+        assert lolly_archive.extract_archive(self.ARCH_DIR + '/not_exists.tar.gz', self.ARCH_DIR)['error']
+        for arcname in ('/abs', '../up', 'a/../../up'):
+            result = lolly_archive.create_archive(self.ARCH_DIR, self.ARCH_DIR + '/../bad.tar', arcname=arcname)
+            assert result['error'] and not lolly_helpers.file_exists(self.ARCH_DIR + '/../bad.tar')
+
+    def test_zzz_cleanup(self):
+        lolly_helpers.silent_remove_dir(self.ARCH_DIR)
@@ -0,0 +1,97 @@
+from unittest import TestCase
+import io
+import json
+import os
+import ntpath
+import subprocess
+import sys
+from pathlib import Path
+from lollylib.lolly_server import RenderServer
+from lollylib import lolly_cli
+from lollylib import lolly_helpers
+
+
+class TestLollyCli(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyCli, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.INSTANTIATION_DIR = head + '/test_data/lollywiz/instantiation_tests'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollyCli' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def __manifest(self, dest_dir, count):
+        lines = []
+        for n in range(count):
+            job = {'template': self.INSTANTIATION_DIR, 'dest': dest_dir + '/' + str(n),
+                   'replacements': {'CLASS_NAME': 'Class' + str(n)}}
+            if n % 2:
+                job['definitions'] = ['USE_TEMPLATE1']
+            lines.append(json.dumps(job))
+        return '\n'.join(lines) + '\n'
+
+    def test_render_manifest(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/cli_render'
+        manifest = self.__manifest(dest_dir, 40)
+        manifest += 'not json\n\n{"dest": "no_template"}\n'
+        manifest += json.dumps({'template': self.TMP_DIR + '/not_exists', 'dest': dest_dir + '/x'}) + '\n'
+        renderer = RenderServer()
+        output = io.StringIO()
+        summary = lolly_cli.render_manifest(io.StringIO(manifest), output, max_workers=3, renderer=renderer)
+        assert summary['jobs'] == 43 and summary['failed'] == 3 and not summary['error']
+        results = dict((r['job'], r) for r in map(json.loads, output.getvalue().splitlines()))
+        assert sorted(results) == list(range(1, 42)) + [43, 44]
+        assert results[41]['error'] == 'manifest' and results[43]['error'] == 'manifest'
+        assert results[44]['error'] == 'request'
+        assert not results[1]['error'] and results[1]['dest'] == dest_dir + '/0'
+        # instruction file is parsed once per replacements, jobs with other destinations reuse it
+        assert renderer.instructions_cache_hits == 0
+        for n in (0, 1):
+            contents = lolly_helpers.silent_read_text_file(dest_dir + '/' + str(n) + '/default_class.hpp')['contents']
+            assert contents.startswith('class Class' + str(n))
+            assert ('template1' in contents) == bool(n % 2)
+
+        # same replacements, other destinations
+        manifest = '\n'.join(json.dumps({'template': self.INSTANTIATION_DIR, 'dest': dest_dir + '/same' + str(n)})
+                             for n in range(10))
+        summary = lolly_cli.render_manifest(io.StringIO(manifest), io.StringIO(), max_workers=1, renderer=renderer)
+        assert summary['failed'] == 0 and renderer.instructions_cache_hits == 9
+        assert lolly_helpers.file_exists(dest_dir + '/same9/default_class.hpp')
+        lolly_helpers.silent_remove_dir(dest_dir)
+
+    def test_render_manifest_with_server(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/cli_server'
+        with RenderServer(('127.0.0.1', 0)) as server:
+            output = io.StringIO()
+            summary = lolly_cli.render_manifest(io.StringIO(self.__manifest(dest_dir, 6)), output, server=server.address)
+            assert summary['jobs'] == 6 and summary['failed'] == 0
+            assert server.status()['requests'] == 6
+        assert lolly_helpers.file_exists(dest_dir + '/5/default_class.hpp')
+        summary = lolly_cli.render_manifest(io.StringIO(''), io.StringIO(), server=server.address)
+        assert summary['error']
+        assert lolly_cli._parse_address('localhost:8080') == ('localhost', 8080)
+        assert lolly_cli._parse_address('/tmp/lolly.sock') == '/tmp/lolly.sock'
+        lolly_helpers.silent_remove_dir(dest_dir)
+
+    def test_console_entry_point(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/cli_main'
+        package_parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        manifest = self.__manifest(dest_dir, 3) + json.dumps({'template': 'not_exists', 'dest': dest_dir}) + '\n'
+        proc = subprocess.run([sys.executable, '-m', 'lollylib.lolly_cli', '-', '-j', '2'], cwd=package_parent_dir,
+                              input=manifest.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert proc.returncode == 1
+        results = [json.loads(line) for line in proc.stdout.decode('utf-8').splitlines()]
+        assert sorted(r['job'] for r in results) == [1, 2, 3, 4]
+        summary = json.loads(proc.stderr.decode('utf-8').splitlines()[-1])
+        assert summary['jobs'] == 4 and summary['failed'] == 1
+        assert lolly_cli.main([self.TMP_DIR + '/not_exists.jsonl']) == 2
+        lolly_helpers.silent_remove_dir(dest_dir)
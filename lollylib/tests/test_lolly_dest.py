@@ -0,0 +1,132 @@
+from unittest import TestCase
+import io
+import os
+import ntpath
+import tarfile
+import zipfile
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_dest import ArchiveDestination, MemoryDestination
+from lollylib import lolly_helpers
+
+
+class TestLollyDest(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyDest, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.TEST_DATA_DIR = head + '/test_data'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollyDest' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def test_archive_name(self):
+        assert ArchiveDestination.archive_name('/a/b') == 'a/b'
+        assert ArchiveDestination.archive_name('./a//b/') == 'a/b'
+        assert ArchiveDestination.archive_name('.') == ''
+
+    def test_instantiate_into_tar_stream(self):
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/instantiation_tests'
+        stream = io.BytesIO()
+        with ArchiveDestination(stream, 'tar.gz', mtime=0) as archive:
+            wiz = LollyWiz(src_dir, 'project')
+            wiz.set_dest_backend(archive)
+            wiz.instantiate()
+            assert not wiz.error
+        assert archive.names() == {'project': 'dir', 'project/default_class.hpp': 'file'}
+        verification = lolly_helpers.silent_read_text_file(src_dir + '/verify1.txt')['contents']
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode='r:gz') as tar:
+            assert tar.getnames() == ['project', 'project/default_class.hpp']
+            data = tar.extractfile('project/default_class.hpp').read().decode('utf-8')
+        assert data == verification
+        # nothing is written to disk
+        assert not lolly_helpers.dir_exists('project')
+
+    def test_instantiate_into_zip_file(self):
+        self.__create_test_dir_if_not_exists()
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/generic_tests'
+        arch = self.TMP_DIR + '/dest_test.zip'
+        archive = ArchiveDestination(arch)
+        wiz = LollyWiz(src_dir, '.')
+        wiz.set_dest_backend(archive)
+        wiz._is_instr_file_read = True
+        wiz._instr_file_data = "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n" \
+                               "#instructions_begin\n" \
+                               "mkdir 'empty'\n" \
+                               "copy 'test_dir' 'copied'\n" \
+                               "#instructions_end\n"
+        wiz.instantiate()
+        assert not wiz.error
+        assert not archive.close()['error']
+        with zipfile.ZipFile(arch) as z:
+            assert sorted(z.namelist()) == ['copied/', 'copied/test.txt', 'empty/']
+        lolly_helpers.silent_remove_file(arch)
+
+    def test_archive_is_append_only(self):
+        with ArchiveDestination(io.BytesIO(), 'tar') as archive:
+            assert not archive.write_text_file('dir/a.txt', 'A')['error']
+            assert archive.get_item_type('dir') == {'exists': True, 'type': 'dir'}
+            assert not archive.remove_file('dir/b.txt')['error']  # nothing to remove
+            assert archive.remove_file('dir/a.txt')['error']
+            assert archive.write_text_file('dir/a.txt', 'B')['error']
+        assert archive.write_text_file('dir/c.txt', 'C')['error']  # closed
+
+    def test_archive_rejects_unsafe_names(self):
+        stream = io.BytesIO()
+        with ArchiveDestination(stream, 'tar') as archive:
+            for path in ('/etc/a.txt', '../a.txt', 'dir/../../a.txt', 'C:/a.txt', '\\\\host\\a.txt'):
+                assert archive.write_text_file(path, 'A')['error']
+                assert archive.create_path(path)['error']
+            assert archive.copy_dir(self.TEST_DATA_DIR + '/lollywiz/generic_tests', '../out')['error']
+            assert not archive.write_text_file('./dir//a.txt', 'A')['error']
+        assert archive.names() == {'dir': 'dir', 'dir/a.txt': 'file'}
+        stream.seek(0)
+        with tarfile.open(fileobj=stream, mode='r') as tar:
+            assert tar.getnames() == ['dir', 'dir/a.txt']
+
+    def test_instantiate_into_memory(self):
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/instantiation_tests'
+        memory = MemoryDestination()
+        wiz = LollyWiz(src_dir, 'preview')
+        wiz.set_dest_backend(memory)
+        wiz.set_definitions(['SHOW_BRIEF_COMMENT', 'USE_TEMPLATE1', 'COND1'])
+        wiz.set_replacements({'CLASS_NAME': 'TestClass', 'CLASS_FILE_NAME': 'test_class'})
+        wiz.instantiate()
+        assert not wiz.error
+        verification = lolly_helpers.silent_read_text_file(src_dir + '/verify2.txt')['contents']
+        assert memory.read_text_file('preview/test_class.hpp') == {'contents': verification, 'error': ''}
+        assert list(memory.files().keys()) == ['preview/test_class.hpp']
+        assert not lolly_helpers.dir_exists('preview')
+
+    def test_memory_directory_semantics(self):
+        memory = MemoryDestination()
+        # a file can be written only into existing directory
+        assert memory.write_text_file('a/b.txt', 'B')['error']
+        assert not memory.create_path('a/sub')['error']
+        assert memory.dirs() == ['a', 'a/sub']
+        assert not memory.write_text_file('a/b.txt', 'B')['error']
+        assert not memory.write_binary_file('a/sub/c.bin', b'\x00C')['error']
+        assert memory.get_item_type('./a//b.txt') == {'exists': True, 'type': 'file'}
+        assert memory.get_item_type('a/sub/') == {'exists': True, 'type': 'dir'}
+        assert memory.create_path('a/b.txt/d')['error']
+        assert memory.write_text_file('a', 'A')['error']
+
+        # removing a directory removes its contents
+        assert not memory.remove_dir('a/sub')['error']
+        assert memory.files() == {'a/b.txt': b'B'}
+        assert memory.dirs() == ['a']
+        assert not memory.remove_file('a/b.txt')['error']
+        assert not memory.remove_file('a/not_exists.txt')['error']
+        assert memory.read_text_file('a/b.txt')['error']
+
+        # directory trees are copied from disk
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/generic_tests/test_dir'
+        assert not memory.copy_dir(src_dir, 'a/copied')['error']
+        assert memory.get_item_type('a/copied/test.txt')['type'] == 'file'
+        assert memory.copy_dir(src_dir + '_not_exists', 'a/copied')['error']
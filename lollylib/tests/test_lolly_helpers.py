@@ -1,8 +1,85 @@
 from unittest import TestCase
+import asyncio
+import hashlib
 import os
 import ntpath
+import subprocess
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 from pathlib import Path
-import lolly_helpers
+from lollylib import lolly_helpers
+
+
+class _StubHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for a file server. 'files' is a dict of path: bytes; paths listed in 'truncate'
+    are sent only partially (path: number of failures left); every request is logged.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StubHTTPHandler)
+        self.files = {}
+        self.truncate = {}
+        self.log = []
+        self.connections = set()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + path
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _StubHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.connections.add(self.client_address)
+        server.log.append((self.path, dict(self.headers)))
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/a.bin')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha256(data).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        first = 0
+        range_header = self.headers.get('Range')
+        if range_header:
+            first = int(range_header.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(first) + '-' + str(len(data) - 1) + '/' + str(len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - first))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if server.truncate.get(self.path):
+            server.truncate[self.path] -= 1
+            self.wfile.write(data[first:first + (len(data) - first) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[first:])
 
 
 class TestLollyHelpers(TestCase):
@@ -88,6 +165,14 @@ class TestLollyHelpers(TestCase):
         data = lolly_helpers.silent_read_text_file(path)
         assert data['contents'] == contents
 
+    def test_silent_write_binary_file(self):
+        self.__create_test_dir_if_not_exists()
+        path = self.TMP_DIR + '/' + 'silent_write_binary_file.bin'
+        assert not lolly_helpers.silent_write_binary_file(path, b'\x00\x01')['error']
+        with open(path, 'rb') as f:
+            assert f.read() == b'\x00\x01'
+        assert lolly_helpers.silent_write_binary_file(self.TMP_DIR + '/not_exists/file.bin', b'')['error']
+
     def test_silent_create_path(self):
         # sad path can't be easily tested because python replaces illegal characters in file names with legal
         # some_wrong_path = self.TMP_DIR + "/:::"
@@ -241,6 +326,30 @@ class TestLollyHelpers(TestCase):
     # -----------------------------------------------------------------------------------------------------------------
     # Strings
 
+    def test_async_file_operations(self):
+        self.__create_test_dir_if_not_exists()
+        base_dir = self.TMP_DIR + '/async_test'
+        filename = base_dir + '/async.txt'
+
+        async def scenario():
+            assert not (await lolly_helpers.silent_create_path_async(base_dir))['error']
+            assert not (await lolly_helpers.silent_write_text_file_async(filename, 'ASYNC'))['error']
+            data = await lolly_helpers.silent_read_text_file_async(filename)
+            assert data['contents'] == 'ASYNC'
+            copies = [base_dir + '/copy' + str(n) + '.txt' for n in range(10)]
+            results = await asyncio.gather(*[lolly_helpers.silent_copy_file_async(filename, c) for c in copies])
+            assert not any(r['error'] for r in results)
+            props = await lolly_helpers.get_filesystem_item_type_async(copies[-1])
+            assert props == {'exists': True, 'type': 'file'}
+            assert not (await lolly_helpers.silent_remove_dir_async(base_dir))['error']
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(scenario())
+        finally:
+            loop.close()
+        assert not lolly_helpers.dir_exists(base_dir)
+
     def test_substr_enclosed_in_seq(self):
         data = 'hello'
         initial_seq = ''
@@ -514,6 +623,21 @@ class TestLollyHelpers(TestCase):
         result = lolly_helpers.replace_keys(the_string, the_dict)
         assert result == 'Hello, that was a test'
 
+        # lazy values are computed only if their keys occur, at most once
+        calls = []
+
+        def provider(value):
+            return lambda: calls.append(value) or value
+
+        the_dict = lolly_helpers.bind_lazy_values({'this': provider('that'), 'test': provider('trial'), 'x': 'y'})
+        assert lolly_helpers.replace_keys(the_string, the_dict) == 'Hello, that is a trial'
+        assert lolly_helpers.replace_in_string_list(['this', 'no keys'], the_dict) == ['that', 'no keys']
+        assert calls == ['that', 'trial']
+        assert the_dict['this'].is_evaluated
+        rebound = lolly_helpers.bind_lazy_values(the_dict)
+        assert not rebound['this'].is_evaluated and rebound['x'] == 'y'
+        assert lolly_helpers.replace_keys('this', rebound) == 'that' and calls == ['that', 'trial', 'that']
+
     def test_find_line_starting_with_seq(self):
         the_list = ['one', 'two', 'smallfoot']
         # happy path
@@ -548,6 +672,339 @@ class TestLollyHelpers(TestCase):
     def test_current_time_utc(self):
         lolly_helpers.current_time_utc()
 
+    def test_clock(self):
+        snapshot = lolly_helpers.Clock().snapshot()
+        assert snapshot.date == snapshot.datetime[:10] and snapshot.year == snapshot.date[:4]
+        clock = lolly_helpers.FixedClock('2020-02-29T23:59:59+02:00')
+        assert clock.snapshot() is clock.snapshot()
+        assert clock.snapshot().datetime == '2020-02-29 21:59:59+00:00'
+        lolly_helpers.set_clock(clock)
+        try:
+            assert lolly_helpers.current_date_utc() == '2020-02-29'
+            assert lolly_helpers.current_time_utc() == '21:59:59 UTC+00:00'
+            assert lolly_helpers.utc_timestamp_millis() == 1583013599000
+            assert clock.time() == 1583013599.0
+        finally:
+            lolly_helpers.set_clock()
+        assert lolly_helpers.current_year_utc() != '2020'
+        before = int(time.time() * 1000)
+        assert before - 1 <= lolly_helpers.utc_timestamp_millis() <= int(time.time() * 1000) + 1
+
+        # timers use monotonic clock
+        with lolly_helpers.Timer() as timer:
+            time.sleep(0.01)
+        assert timer.elapsed >= 0.01 and timer.elapsed == timer.elapsed
+        start = lolly_helpers.monotonic_millis()
+        assert lolly_helpers.monotonic_millis() >= start
+
+
+    def test_download_manager(self):
+        self.__create_test_dir_if_not_exists()
+        download_dir = self.TMP_DIR + '/downloads'
+        server = _StubHTTPServer()
+        data = [os.urandom(100000 + n) for n in range(6)]
+        for n, d in enumerate(data):
+            server.files['/f' + str(n)] = d
+        server.files['/a.bin'] = data[0]
+        progress = []
+        try:
+            with lolly_helpers.DownloadManager(max_workers=3, retry_delay=0.01) as manager:
+                jobs = [{'url': server.url('/f' + str(n)), 'dest': download_dir + '/f' + str(n),
+                         'checksum': 'sha256:' + hashlib.sha256(d).hexdigest()} for n, d in enumerate(data)]
+                results = manager.download_many(jobs, progress=lambda url, done, total: progress.append(total))
+                assert [r['error'] for r in results] == [''] * 6
+                for n, d in enumerate(data):
+                    with open(download_dir + '/f' + str(n), 'rb') as f:
+                        assert f.read() == d
+                assert not lolly_helpers.file_exists(download_dir + '/f0.part')
+                assert set(progress) == set(len(d) for d in data)
+                # keep-alive connections are reused
+                assert len(server.connections) <= 3
+
+                # truncated transfer is resumed with Range request
+                server.truncate['/f1'] = 1
+                result = manager.download(server.url('/f1'), download_dir + '/resumed')
+                assert not result['error']
+                assert result['resumed'] and result['attempts'] == 2
+                assert server.log[-1][1]['Range'] == 'bytes=50000-'
+                with open(download_dir + '/resumed', 'rb') as f:
+                    assert f.read() == data[1]
+
+                # redirects are followed
+                assert not manager.download(server.url('/redirect'), download_dir + '/redirected')['error']
+
+                # checksum mismatch leaves no file behind
+                result = manager.download(server.url('/f2'), download_dir + '/bad', checksum='md5:00')
+                assert result['error'].startswith('checksum mismatch')
+                assert not lolly_helpers.file_exists(download_dir + '/bad')
+                assert not lolly_helpers.file_exists(download_dir + '/bad.part')
+
+                # client errors are not retried
+                result = manager.download(server.url('/not_found'), download_dir + '/nf')
+                assert result['status'] == 404 and result['attempts'] == 1
+                assert manager.download('ftp://host/file', download_dir + '/ftp')['error']
+
+            filename, headers = lolly_helpers.silentDownloadFile(server.url('/f3'), download_dir + '/f3')
+            assert filename == download_dir + '/f3' and headers.get('Content-Length') is not None
+            assert lolly_helpers.silentDownloadFile(server.url('/none'), download_dir + '/none') == ['']
+            # partial download of a failed download is removed
+            server.truncate['/f4'] = 10
+            default_manager = lolly_helpers._default_download_manager
+            lolly_helpers._default_download_manager = lolly_helpers.DownloadManager(retry_delay=0.01)
+            try:
+                assert lolly_helpers.silentDownloadFile(server.url('/f4'), download_dir + '/f4') == ['']
+            finally:
+                lolly_helpers._default_download_manager.close()
+                lolly_helpers._default_download_manager = default_manager
+            assert not lolly_helpers.file_exists(download_dir + '/f4.part')
+            # other schemes are downloaded with urlretrieve
+            filename, headers = lolly_helpers.silentDownloadFile(Path(download_dir + '/f3').as_uri(),
+                                                                 download_dir + '/copy')
+            with open(filename, 'rb') as f:
+                assert filename == download_dir + '/copy' and f.read() == data[3]
+            assert lolly_helpers.silentDownloadFile('file:///not_exists', download_dir + '/ne') == ['']
+        finally:
+            server.stop()
+            lolly_helpers.silent_remove_dir(download_dir)
+
+    def test_download_cache(self):
+        self.__create_test_dir_if_not_exists()
+        cache_dir = self.TMP_DIR + '/download_cache'
+        dest = self.TMP_DIR + '/cached_downloads'
+        server = _StubHTTPServer()
+        server.files['/a'] = b'A' * 1000
+        server.files['/b'] = b'B' * 1000
+        server.files['/copy_of_a'] = b'A' * 1000
+        try:
+            with lolly_helpers.DownloadCache(cache_dir, max_bytes=2500) as cache:
+                result = cache.fetch(server.url('/a'), dest + '/a1')
+                assert not result['error'] and result['source'] == 'network'
+                assert result['digest'] == hashlib.sha256(b'A' * 1000).hexdigest()
+
+                # conditional request costs a round-trip only
+                result = cache.fetch(server.url('/a'), dest + '/a2')
+                assert result['source'] == 'revalidated'
+                assert server.log[-1][1]['If-None-Match']
+                with open(dest + '/a2', 'rb') as f:
+                    assert f.read() == b'A' * 1000
+
+                # fresh entry is used without any request
+                requests = len(server.log)
+                assert cache.fetch(server.url('/a'), dest + '/a3', max_age=60)['source'] == 'cache'
+                assert len(server.log) == requests
+
+                # changed contents are downloaded again
+                server.files['/a'] = b'C' * 1000
+                result = cache.fetch(server.url('/a'), dest + '/a4')
+                assert result['source'] == 'network'
+
+                # same contents are stored once
+                assert not cache.fetch(server.url('/copy_of_a'), dest + '/copy')['error']
+                assert cache.stats() == {'entries': 2, 'objects': 2, 'bytes': 2000}
+
+                # least recently used object is evicted
+                os.utime(cache_dir + '/objects/' + result['digest'][:2] + '/' + result['digest'], (1, 1))
+                assert not cache.fetch(server.url('/b'), dest + '/b')['error']
+                assert cache.stats()['objects'] == 2
+                assert cache.fetch(server.url('/a'), dest + '/a5', max_age=60)['source'] == 'network'
+                assert cache.evict(0) == {'removed': 2, 'bytes': 0}
+
+                assert cache.fetch(server.url('/not_found'), dest + '/nf')['error']
+                assert os.listdir(cache_dir + '/tmp') == []
+
+            # many cache objects (as if in different processes) share the directory safely
+            def fetch(n):
+                with lolly_helpers.DownloadCache(cache_dir) as c:
+                    results.append(c.fetch(server.url('/b'), dest + '/b' + str(n))['error'])
+            results = []
+            threads = [threading.Thread(target=fetch, args=(n,)) for n in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert results == [''] * 8
+        finally:
+            server.stop()
+            lolly_helpers.silent_remove_dir(cache_dir)
+            lolly_helpers.silent_remove_dir(dest)
+
+    def test_git_sync_repos(self):
+        self.__create_test_dir_if_not_exists()
+        git_dir = self.TMP_DIR + '/git_sync'
+        identity = ['-c', 'user.name=test', '-c', 'user.email=test@example.com']
+
+        def commit(repo, text):
+            lolly_helpers.silent_write_text_file(repo + '/file.txt', text)
+            subprocess.check_call(['git', '-C', repo, 'add', '.'], stdout=subprocess.DEVNULL)
+            subprocess.check_call(['git'] + identity + ['-C', repo, 'commit', '-q', '-m', text],
+                                  stdout=subprocess.DEVNULL)
+
+        try:
+            origins = []
+            for n in range(3):
+                origin = git_dir + '/origin' + str(n)
+                subprocess.check_call(['git', 'init', '-q', origin])
+                commit(origin, 'first')
+                origins.append('file://' + origin)
+            repos = [(url, git_dir + '/checkout' + str(n)) for n, url in enumerate(origins)]
+            repos.append({'url': git_dir + '/not_a_repo', 'path': git_dir + '/failed', 'timeout': 30})
+            done = []
+            summary = lolly_helpers.git_sync_repos(repos, max_workers=4, depth=1, progress=done.append)
+            assert (summary['cloned'], summary['failed']) == (3, 1)
+            assert summary['error'] and len(done) == 4
+            assert summary['results'][3]['error']
+            assert lolly_helpers.file_exists(git_dir + '/checkout2/file.txt')
+
+            # existing checkouts are fast-forwarded, not cloned again
+            commit(git_dir + '/origin1', 'second')
+            summary = lolly_helpers.git_sync_repos(repos[:3], depth=1)
+            assert not summary['error']
+            assert (summary['updated'], summary['unchanged']) == (1, 2)
+            updated = summary['results'][1]
+            assert updated['action'] == 'update' and updated['changed'] and updated['old_rev'] != updated['new_rev']
+            assert lolly_helpers.silent_read_text_file(git_dir + '/checkout1/file.txt')['contents'] == 'second'
+        finally:
+            lolly_helpers.silent_remove_dir(git_dir)
+
+    def test_run_command(self):
+        py = sys.executable
+        result = lolly_helpers.run_command([py, '-c', 'import sys; print("out"); print("err", file=sys.stderr)'])
+        assert (result['returncode'], result['stdout'], result['stderr'], result['error']) == (0, 'out\n', 'err\n', '')
+        result = lolly_helpers.run_command([py, '-c', 'import os; print(os.environ["LOLLY_VAR"])'],
+                                           env={'LOLLY_VAR': 'value'})
+        assert result['stdout'] == 'value\n'
+        result = lolly_helpers.run_command([py, '-c', 'import sys; print(sys.stdin.read())'], input=b'in')
+        assert result['stdout'] == 'in\n'
+        result = lolly_helpers.run_command([py, '-c', 'raise SystemExit(3)'])
+        assert result['returncode'] == 3 and result['error']
+        assert lolly_helpers.run_command(['not_existing_command_lolly'])['error']
+
+        # streaming output and timeout
+        lines = []
+        result = lolly_helpers.run_command([py, '-u', '-c', 'import time; print("a"); time.sleep(30)'], timeout=0.5,
+                                           on_output=lambda name, line: lines.append((name, line)))
+        assert result['timed_out'] and result['error'] == 'timeout'
+        assert lines == [('stdout', 'a\n')] and result['stdout'] == 'a\n'
+        assert result['duration'] < 10
+
+    def test_run_commands(self):
+        py = sys.executable
+        cmds = [[py, '-c', 'import time; time.sleep(0.5); print(' + str(n) + ')'] for n in range(4)]
+        cmds.append({'cmd': [py, '-c', 'import time; time.sleep(30)'], 'timeout': 0.5})
+        done = []
+        started = time.monotonic()
+        results = lolly_helpers.run_commands(cmds, max_workers=5, progress=lambda i, r: done.append(i))
+        assert time.monotonic() - started < 5  # commands run concurrently
+        assert [r['stdout'] for r in results[:4]] == ['0\n', '1\n', '2\n', '3\n']
+        assert results[4]['timed_out']
+        assert sorted(done) == [0, 1, 2, 3, 4]
+
+    def test_run_commands_async(self):
+        py = sys.executable
+        lines = []
+
+        async def run():
+            cmds = [[py, '-c', 'print(' + str(n) + ')'] for n in range(3)]
+            cmds.append({'cmd': [py, '-c', 'import time; time.sleep(30)'], 'timeout': 0.5})
+            return await lolly_helpers.run_commands_async(cmds, max_concurrency=2,
+                                                          on_output=lambda i, name, line: lines.append((i, line)))
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        assert [r['stdout'] for r in results[:3]] == ['0\n', '1\n', '2\n']
+        assert results[3]['timed_out'] and results[3]['returncode'] is not None
+        assert sorted(lines) == [(0, '0\n'), (1, '1\n'), (2, '2\n')]
+
+    def test_fingerprint_store(self):
+        self.__create_test_dir_if_not_exists()
+        fp_dir = self.TMP_DIR + '/fingerprints'
+        lolly_helpers.silent_create_path(fp_dir)
+        store_file = fp_dir + '/store.json'
+        files = []
+        for n in range(5):
+            filename = fp_dir + '/file' + str(n)
+            lolly_helpers.silent_write_binary_file(filename, os.urandom(3000 + n))
+            os.utime(filename, ns=(10 ** 18, 10 ** 18 + n))  # files older than the racy window
+            files.append(filename)
+        try:
+            with lolly_helpers.FingerprintStore(store_file, use_mmap=True) as store:
+                results = store.fingerprint_many(files)
+                assert [r['hashed'] for r in results] == [True] * 5
+                assert results[0]['digest'] == lolly_helpers.file_digest(files[0])
+                assert store.fingerprint(fp_dir + '/not_exists')['error']
+
+            # unchanged files are not hashed again, even by another store object
+            store = lolly_helpers.FingerprintStore(store_file)
+            assert [r['hashed'] for r in store.fingerprint_many(files)] == [False] * 5
+            assert store.hits == 5
+
+            # changed size or mtime invalidates fingerprint
+            lolly_helpers.silent_write_binary_file(files[1], b'changed')
+            os.utime(files[1], ns=(10 ** 18, 10 ** 18 + 1))
+            result = store.fingerprint(files[1])
+            assert result['hashed'] and result['digest'] == hashlib.sha256(b'changed').hexdigest()
+
+            # recently modified files are hashed every time
+            lolly_helpers.silent_write_binary_file(files[2], b'fresh')
+            assert store.fingerprint(files[2])['hashed']
+            assert store.fingerprint(files[2])['hashed']
+
+            lolly_helpers.silent_remove_file(files[3])
+            assert store.prune() == 1
+            assert not store.save()['error']
+            assert lolly_helpers.FingerprintStore(store_file, algorithm='md5').fingerprint(files[0])['hashed']
+        finally:
+            lolly_helpers.silent_remove_dir(fp_dir)
+
+    def test_dir_diff_and_sync(self):
+        self.__create_test_dir_if_not_exists()
+        src = self.TMP_DIR + '/sync_src'
+        dest = self.TMP_DIR + '/sync_dest'
+        lolly_helpers.silent_remove_dir(src)
+        lolly_helpers.silent_remove_dir(dest)
+        for path in ('a.txt', 'sub/b.txt', 'sub/deep/c.txt'):
+            lolly_helpers.silent_create_path(lolly_helpers.path_base_and_leaf(src + '/' + path)['base'])
+            lolly_helpers.silent_write_text_file(src + '/' + path, path)
+        os.symlink('a.txt', src + '/link')
+        try:
+            assert lolly_helpers.dir_diff(src, dest)['added'] == ['a.txt', 'link', 'sub']
+            result = lolly_helpers.sync_dir(src, dest)
+            assert (result['copied'], result['error']) == (3, '')
+            assert os.readlink(dest + '/link') == 'a.txt'
+            diff = lolly_helpers.dir_diff(src, dest, compare='metadata')
+            assert diff['unchanged'] == ['a.txt', 'link', 'sub', 'sub/b.txt', 'sub/deep', 'sub/deep/c.txt']
+
+            # only the delta is synced
+            lolly_helpers.silent_write_text_file(src + '/sub/b.txt', 'changed')
+            lolly_helpers.silent_write_text_file(src + '/sub/deep/new.txt', 'new')
+            lolly_helpers.silent_write_text_file(dest + '/extra.txt', 'extra')
+            lolly_helpers.silent_remove_dir(dest + '/sub/deep')
+            lolly_helpers.silent_write_text_file(dest + '/sub/deep', 'file in place of dir')
+            entries = []
+            result = lolly_helpers.sync_dir(src, dest, dry_run=True, on_entry=entries.append)
+            assert [(e['path'], e['status']) for e in entries if e['status'] != 'unchanged'] == \
+                [('extra.txt', 'removed'), ('sub/b.txt', 'changed'), ('sub/deep', 'changed')]
+            assert lolly_helpers.file_exists(dest + '/extra.txt')
+            result = lolly_helpers.sync_dir(src, dest, delete_extra=True)
+            assert (result['copied'], result['removed'], result['unchanged'], result['error']) == (2, 1, 2, '')
+            assert lolly_helpers.dir_diff(src, dest, compare='content')['unchanged'] == \
+                ['a.txt', 'link', 'sub', 'sub/b.txt', 'sub/deep', 'sub/deep/c.txt', 'sub/deep/new.txt']
+
+            # same size and mtime but different contents is found by content comparison only
+            lolly_helpers.silent_write_text_file(dest + '/a.txt', 'A.txt')
+            st = os.stat(src + '/a.txt')
+            os.utime(dest + '/a.txt', ns=(st.st_atime_ns, st.st_mtime_ns))
+            assert lolly_helpers.dir_diff(src, dest)['changed'] == []
+            store = lolly_helpers.FingerprintStore()
+            assert lolly_helpers.dir_diff(src, dest, compare='content', fingerprints=store)['changed'] == ['a.txt']
+            assert lolly_helpers.dir_diff(src + '_not_exists', dest)['error']
+            assert lolly_helpers.sync_dir(src + '_not_exists', dest)['error']
+        finally:
+            lolly_helpers.silent_remove_dir(src)
+            lolly_helpers.silent_remove_dir(dest)
 
     def test_zzz_cleanup(self):
         # Tests are executed in alphabetical order, 'zzz' makes it the last in the execution list
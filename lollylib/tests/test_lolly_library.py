@@ -0,0 +1,86 @@
+from unittest import TestCase
+import os
+import ntpath
+import pickle
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_dest import MemoryDestination
+from lollylib.lolly_source import DirSource, PrecompiledSource, CompilingDirSource
+from lollylib import lolly_library
+from lollylib import lolly_helpers
+
+
+class TestLollyLibrary(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyLibrary, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.LIB_DIR = os.path.dirname(head)
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __instantiate(self, wiz):
+        memory = MemoryDestination()
+        wiz.set_dest_backend(memory)
+        wiz.set_definitions(['LICENSE_TYPE_MIT'])
+        wiz.set_replacements({'PROJECT_NAME': 'Lolly', 'CURRENT_YEAR': '2020'})
+        wiz.instantiate()
+        assert not wiz.error
+        return memory.files()
+
+    def test_compiled_library_is_up_to_date(self):
+        templates_dir = self.LIB_DIR + '/' + lolly_library.TEMPLATES_DIR
+        for name in os.listdir(templates_dir):
+            compiled = lolly_library.compile_template_dir(templates_dir + '/' + name, name)
+            assert not compiled['error']
+            with open(self.LIB_DIR + '/' + lolly_library.COMPILED_DIR + '/' + name + '.lwc', 'rb') as f:
+                shipped = pickle.load(f)
+            # run 'python -m lollylib.lolly_library' if this fails
+            assert shipped == compiled['compiled']
+
+    def test_lazy_registry(self):
+        lolly_library.clear_registry()
+        assert lolly_library.get_template('not_exists') is None
+        source = lolly_library.get_template('git')
+        assert isinstance(source, PrecompiledSource)
+        assert lolly_library.get_template('git') is source
+        assert source.compiled_template('README.md.lwt', LollyWiz().OPTIONS) is not None
+        assert source.compiled_template('README.md.lwt', {}) is None
+
+    def test_precompiled_matches_loose_files(self):
+        wiz = LollyWiz(None, 'repo')
+        wiz.set_src_from_lib('git')
+        assert isinstance(wiz._src, PrecompiledSource)
+        precompiled = self.__instantiate(wiz)
+        wiz = LollyWiz(self.LIB_DIR + '/' + lolly_library.TEMPLATES_DIR + '/git', 'repo')
+        assert isinstance(wiz._src, DirSource)
+        parsed = self.__instantiate(wiz)
+        assert sorted(precompiled.keys()) == ['repo/.gitignore', 'repo/LICENSE', 'repo/README.md']
+        assert precompiled == parsed
+
+    def test_build_library(self):
+        compiled_dir = self.TMP_DIR + '/compiled_library'
+        built = lolly_library.build_library(compiled_dir=compiled_dir)
+        assert not built['error']
+        assert 'git' in built['built']
+        assert lolly_helpers.file_exists(compiled_dir + '/git.lwc')
+        lolly_helpers.silent_remove_dir(compiled_dir)
+        assert lolly_library.build_library(templates_dir=compiled_dir)['error']
+
+    def test_includes_in_instruction_file_are_refused(self):
+        src_dir = self.TMP_DIR + '/include_in_instructions'
+        lolly_helpers.silent_create_path(src_dir)
+        lolly_helpers.silent_write_text_file(src_dir + '/lollywiz.txt', "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                                                         "#instructions_begin\n"
+                                                                         "[## include 'more.txt' ##]\n"
+                                                                         "#instructions_end\n")
+        lolly_helpers.silent_write_text_file(src_dir + '/more.txt', "inst 'a.txt' 'a.txt'\n")
+        compiled = lolly_library.compile_template_dir(src_dir, 'include_in_instructions')
+        assert compiled['compiled'] is None and 'include' in compiled['error']
+        # sources that compile lollywiz.txt report a syntax error, as loose files do
+        wiz = LollyWiz(None, 'out')
+        wiz.set_src_backend(CompilingDirSource(src_dir, LollyWiz()._compile_template))
+        wiz.set_dest_backend(MemoryDestination())
+        wiz.instantiate()
+        assert wiz.error == 'syntax'
+        lolly_helpers.silent_remove_dir(src_dir)
@@ -0,0 +1,113 @@
+from unittest import TestCase
+import os
+import ntpath
+import threading
+import urllib.request
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_dest import MemoryDestination
+from lollylib.lolly_server import RenderServer, RenderClient
+from lollylib.lolly_metrics import Registry, MetricsServer
+from lollylib import lolly_metrics
+from lollylib import lolly_source
+from lollylib import lolly_helpers
+
+
+class TestLollyMetrics(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyMetrics, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.INSTANTIATION_DIR = head + '/test_data/lollywiz/instantiation_tests'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollyMetrics' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def test_registry(self):
+        registry = Registry()
+        counter = registry.counter('jobs_total', 'Jobs.', ('kind',))
+        assert registry.counter('jobs_total', 'Jobs.', ('kind',)) is counter
+        histogram = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+
+        def work():
+            for n in range(1000):
+                counter.inc(1, ('a' if n % 2 else 'b',))
+                histogram.observe(0.5)
+
+        threads = [threading.Thread(target=work) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        histogram.observe(0.1)
+        histogram.observe(7)
+        assert counter.values() == {('a',): 2000, ('b',): 2000}
+        assert histogram.values()[()] == {'buckets': [1, 4001, 4002], 'count': 4002, 'sum': 2007.1}
+        text = registry.render()
+        assert '# TYPE jobs_total counter\njobs_total{kind="a"} 2000\njobs_total{kind="b"} 2000\n' in text
+        assert 'latency_seconds_bucket{le="1.0"} 4001\nlatency_seconds_bucket{le="+Inf"} 4002\n' in text
+        assert 'latency_seconds_count 4002\n' in text
+
+        self.__create_test_dir_if_not_exists()
+        filename = self.TMP_DIR + '/metrics.prom'
+        assert not registry.write(filename)['error']
+        assert lolly_helpers.silent_read_text_file(filename)['contents'] == text
+        lolly_helpers.silent_remove_file(filename)
+        with MetricsServer(registry) as server:
+            url = 'http://%s:%d/metrics' % server.address
+            with urllib.request.urlopen(url) as response:
+                assert response.read().decode('utf-8') == registry.render()
+
+        # shards of finished threads are folded into the total
+        for n in range(50):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+            assert len(counter._shards) <= 2 and len(histogram._shards) <= 2
+        assert counter.values() == {('a',): 27000, ('b',): 27000}
+        assert histogram.values()[()]['count'] == 54002 and len(histogram._shards) == 1
+
+    def test_lollywiz_metrics(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/metrics_out'
+        lolly_source.shared_read_cache.clear()  # files are read, not taken from the cache
+        metrics = lolly_metrics.enable()
+        try:
+            wiz = LollyWiz(self.INSTANTIATION_DIR, dest_dir)
+            wiz.instantiate()
+            assert not wiz.error
+            assert metrics.instantiations.value() == 1
+            assert metrics.templates_rendered.value() == 1
+            assert metrics.instruction_seconds.values()[('inst',)]['count'] == 1
+            assert metrics.bytes_written.value() == os.path.getsize(dest_dir + '/default_class.hpp')
+            assert metrics.bytes_read.value() > 0
+
+            wiz = LollyWiz(self.TMP_DIR + '/not_exists', dest_dir)
+            wiz.set_dest_backend(MemoryDestination())
+            wiz.instantiate()
+            # missing source dir and lollywiz.txt are reported by the constructor
+            assert metrics.errors.values() == {('file',): 2, ('procedural',): 1}
+
+            # render server shares warm caches and serves metrics
+            with RenderServer(('127.0.0.1', 0)) as server:
+                client = RenderClient(server.address)
+                for n in range(2):
+                    assert not client.render(self.INSTANTIATION_DIR, dest_dir)['error']
+                assert metrics.cache_requests.value(('instructions', 'hit')) == 1
+                assert metrics.cache_requests.value(('compiled', 'hit')) >= 1
+                url = 'http://%s:%d/metrics' % server.address
+                with urllib.request.urlopen(url) as response:
+                    text = response.read().decode('utf-8')
+                assert 'lollywiz_templates_rendered_total 3\n' in text
+                assert 'lollylib_cache_requests_total{cache="instructions",result="hit"} 1\n' in text
+        finally:
+            lolly_metrics.disable()
+        assert lolly_helpers.get_metrics() is None
+        LollyWiz(self.INSTANTIATION_DIR, dest_dir).instantiate()
+        assert metrics.instantiations.value() == 3
+        lolly_helpers.silent_remove_dir(dest_dir)
@@ -0,0 +1,66 @@
+from unittest import TestCase
+import os
+import ntpath
+import pstats
+import tracemalloc
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_profile import Profiler
+from lollylib.lolly_metrics import LollyMetrics
+from lollylib import lolly_helpers
+
+
+class TestLollyProfile(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyProfile, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.INSTANTIATION_DIR = head + '/test_data/lollywiz/instantiation_tests'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollyProfile' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def test_profile_instantiation(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/profiled'
+        profiler = Profiler(memory=True)
+        metrics = LollyMetrics()
+        wiz = LollyWiz(self.INSTANTIATION_DIR, dest_dir)
+        wiz.set_profiler(profiler)
+        wiz.set_metrics(metrics)
+        wiz.instantiate()
+        assert not wiz.error
+        # metrics are collected while profiling too
+        assert metrics.instantiations.value() == 1
+        assert metrics.instruction_seconds.values()[('inst',)]['count'] == 1
+        assert lolly_helpers.file_exists(dest_dir + '/default_class.hpp')
+        assert not tracemalloc.is_tracing()
+
+        # parsing and each instruction are separate sections
+        report = profiler.report()
+        names = [s['name'] for s in report['sections']]
+        assert names[0] == 'parse lollywiz.txt'
+        assert len(names) == len(wiz._instr_file_data) + 1
+        assert any(name.startswith("inst '") for name in names)
+        assert report['memory_peak'] > 0 and report['duration'] > 0
+
+        written = profiler.write(self.TMP_DIR + '/profile')
+        assert not written['error']
+        stats = pstats.Stats(written['pstats'])
+        assert any(func[2] == '_parse_instructions' for func in stats.stats)
+        memory_report = lolly_helpers.silent_read_text_file(written['memory'])['contents']
+        assert 'parse lollywiz.txt' in memory_report and 'Top allocation sites:' in memory_report
+
+        # profiling stays off unless a profiler is set
+        wiz.set_profiler(None)
+        wiz.instantiate()
+        assert not wiz.error and len(profiler.sections) == len(names)
+        assert Profiler().write(self.TMP_DIR + '/empty')['error']
+        lolly_helpers.silent_remove_dir(dest_dir)
+        lolly_helpers.silent_remove_file(written['pstats'])
+        lolly_helpers.silent_remove_file(written['memory'])
@@ -0,0 +1,156 @@
+from unittest import TestCase
+import os
+import ntpath
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_render import ProcessPoolRenderer
+from lollylib.lolly_dest import MemoryDestination
+from lollylib.lolly_source import BundleSource
+from lollylib import lolly_render
+from lollylib import lolly_helpers
+
+
+class TestLollyRender(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyRender, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.TEST_DATA_DIR = head + '/test_data'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollyRender' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def test_render_compiled(self):
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/condition_tests'
+        wiz = LollyWiz(src_dir, self.TMP_DIR)
+        filename = src_dir + '/cond_template1.hpp'
+        data = lolly_helpers.silent_read_text_file(filename)['contents']
+        compiled = wiz._compile_template(data, filename)
+        assert not wiz.error and compiled is not None
+        replacements = {'[$$CLASS_NAME$$]': 'Compiled'}
+
+        # compiled template renders exactly like the template processed in place
+        for definitions in [[], ['SHOW_FULL_COMMENT'], ['SHOW_BRIEF_COMMENT', 'COND_ALT2'],
+                            ['COND1', 'COND_ALT1'], ['COND_ALT1', 'COND_ALT2']]:
+            wiz.set_definitions(definitions)
+            expected = lolly_helpers.replace_keys(wiz._process_conditional_directives(data, filename), replacements)
+            assert lolly_render.render_compiled(compiled, set(definitions), replacements) == expected
+
+        # sad path
+        assert wiz._compile_template("[## if A ##]no endif", 'test_data (expected error)') is None
+        assert wiz.error == 'syntax'
+
+    def test_render_includes(self):
+        wiz = LollyWiz(None, self.TMP_DIR)
+        compiled = wiz._compile_template("x[## if A ##][## include 'p.txt' ##][## endif ##]", 'includes')
+        assert not wiz.error and lolly_render.has_includes(compiled)
+        assert not lolly_render.has_includes(wiz._compile_template('[## if A ##]a[## endif ##]', 'no includes'))
+        try:
+            lolly_render.render_compiled(compiled, {'A'}, {})
+            assert False
+        except ValueError:
+            pass
+        assert lolly_render.render_compiled(compiled, set(), {}) == 'x'
+
+    def test_process_pool_renderer(self):
+        compiled = ('start.', (('cond1', 'val1'), ('cond2', 'val2'), (None, 'else_val')), '.[$$KEY$$]')
+        jobs = []
+        for n in range(100):
+            definitions = ['cond1'] if n % 2 else []
+            jobs.append((n, compiled, definitions, {'[$$KEY$$]': str(n)}))
+        with ProcessPoolRenderer(max_workers=2, chunk_size=8) as renderer:
+            results = {}
+            for job_id, contents, error in renderer.render_batch(iter(jobs)):
+                assert not error
+                results[job_id] = contents
+            assert len(results) == 100
+            assert results[1] == 'start.val1.1'
+            assert results[2] == 'start.else_val.2'
+
+            # workers are reused by the next batch
+            result = renderer.render(compiled, ['cond2'], {'[$$KEY$$]': 'end'})
+            assert result == {'contents': 'start.val2.end', 'error': ''}
+
+            # errors are reported per job
+            result = renderer.render(compiled, [], {'[$$KEY$$]': None})
+            assert result['error']
+
+    def test_render_backend(self):
+        self.__create_test_dir_if_not_exists()
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/instantiation_tests'
+        dest_dir = self.TMP_DIR + '/render_backend'
+        wiz = LollyWiz(src_dir, dest_dir)
+        wiz.set_definitions(['SHOW_BRIEF_COMMENT', 'USE_TEMPLATE1', 'COND1'])
+        wiz.set_replacements({'CLASS_NAME': 'TestClass', 'CLASS_FILE_NAME': 'test_class'})
+        with ProcessPoolRenderer(max_workers=2) as renderer:
+            wiz.set_render_backend(renderer)
+            wiz.instantiate()
+        assert not wiz.error
+        result = lolly_helpers.silent_read_text_file(dest_dir + '/test_class.hpp')
+        verification = lolly_helpers.silent_read_text_file(src_dir + '/verify2.txt')
+        assert result['contents'] == verification['contents']
+        lolly_helpers.silent_remove_dir(dest_dir)
+
+    def test_render_engines(self):
+        files = {'lollywiz.txt': "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                 "#instructions_begin\n"
+                                 "inst 'a.hpp' 'a.hpp'\n"
+                                 "inst 'src/*.lwt' 'src'\n"
+                                 "inst_each 'item.hpp' 'items/[$$ITEM$$].hpp' ITEMS\n"
+                                 "#instructions_end\n",
+                 'a.hpp': "[## include 'header.txt' ##]\n[## if A ##]A[## else ##]B[## endif ##] [$$NAME$$]",
+                 'header.txt': '// [## if A ##][$$NAME$$][## endif ##]',
+                 'src/b.hpp.lwt': '[## if B ##]b[## elif A ##]a[## endif ##]\n',
+                 'item.hpp': '[## include header.txt ##][$$ITEM$$]'}
+        replacements = {'NAME': 'N', 'ITEMS': '[{"ITEM": "x"}, {"ITEM": "y"}]'}
+        outputs = {}
+        for engine in ('compiled', 'reference'):
+            memory = MemoryDestination()
+            wiz = LollyWiz(None, 'out', ['A'], dict(replacements))
+            wiz.set_src_backend(BundleSource(files))
+            wiz.set_dest_backend(memory)
+            wiz.set_render_engine(engine)
+            wiz.instantiate()
+            assert not wiz.error
+            outputs[engine] = memory.files()
+        assert outputs['compiled'] == outputs['reference']
+        assert outputs['compiled']['out/a.hpp'] == b'// NA N'
+
+        # verification: same outputs, reference output is written
+        verifier = lolly_render.VerifyingEngine('reference', 'compiled')
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'out', ['A'], dict(replacements))
+        wiz.set_src_backend(BundleSource(files))
+        wiz.set_dest_backend(memory)
+        wiz.set_render_engine(verifier)
+        wiz.instantiate()
+        assert not wiz.error and memory.files() == outputs['reference']
+        report = verifier.report()
+        assert report['renders'] == 4 and report['mismatches'] == 0 and report['speedup'] > 0
+        assert verifier.summary().startswith('compiled vs reference: 4 renders, 0 mismatches')
+
+        # mismatches of a drifting engine are reported byte by byte
+        class DriftingEngine(lolly_render.CompiledEngine):
+            name = 'drifting'
+
+            def render(self, prepared, definitions, replacement_dict):
+                return super(DriftingEngine, self).render(prepared, definitions, replacement_dict).replace('N', 'M')
+
+        lolly_render.register_engine(DriftingEngine())
+        verifier = lolly_render.VerifyingEngine('reference', 'drifting')
+        wiz.set_render_engine(verifier)
+        wiz.instantiate()
+        assert not wiz.error and memory.files() == outputs['reference']
+        report = verifier.report()
+        assert report['mismatches'] == 3
+        assert report['details'][0] == {'template': '<bundle>:a.hpp', 'offset': 3, 'expected': b'// NA N',
+                                         'actual': b'// MA M'}
+
+        # sad path
+        wiz.set_render_engine('not_exists')
+        assert wiz.error == 'procedural'
@@ -0,0 +1,127 @@
+from unittest import TestCase, skipUnless
+import os
+import ntpath
+import http.client
+import socketserver
+import threading
+from pathlib import Path
+from lollylib.lolly_server import RenderServer, RenderClient
+from lollylib import lolly_helpers
+
+
+class TestLollyServer(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyServer, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.INSTANTIATION_DIR = head + '/test_data/lollywiz/instantiation_tests'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollyServer' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def __verification(self):
+        return lolly_helpers.silent_read_text_file(self.INSTANTIATION_DIR + '/verify1.txt')['contents']
+
+    @skipUnless(hasattr(socketserver, 'UnixStreamServer'), 'unix sockets are not supported')
+    def test_unix_socket_server(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/server_unix'
+        with RenderServer(self.TMP_DIR + '/lolly_server.sock', max_workers=2) as server:
+            client = RenderClient(server.address)
+            result = client.render(self.INSTANTIATION_DIR, dest_dir)
+            assert not result['error'] and not result['instructions_cached']
+            assert lolly_helpers.silent_read_text_file(dest_dir + '/default_class.hpp')['contents'] == \
+                self.__verification()
+
+            # parsed instruction file is reused
+            lolly_helpers.silent_remove_dir(dest_dir)
+            result = client.render(self.INSTANTIATION_DIR, dest_dir)
+            assert not result['error'] and result['instructions_cached']
+            assert lolly_helpers.silent_read_text_file(dest_dir + '/default_class.hpp')['contents'] == \
+                self.__verification()
+
+            # other definitions are parsed separately
+            result = client.render(self.INSTANTIATION_DIR, dest_dir, definitions=['USE_TEMPLATE1'])
+            assert not result['error'] and not result['instructions_cached']
+            assert client.status() == {'requests': 3, 'instructions_cache_hits': 1, 'sources': 1, 'workers': 2,
+                                       'error': ''}
+
+            # sad path
+            result = client.render(self.TMP_DIR + '/not_exists', dest_dir)
+            assert result['error'] == 'request'
+            assert client._request('GET', '/unknown')['error'] == 'not_found'
+        assert not lolly_helpers.file_exists(self.TMP_DIR + '/lolly_server.sock')
+        assert RenderClient(self.TMP_DIR + '/lolly_server.sock').status()['error'] == 'connection'
+        lolly_helpers.silent_remove_dir(dest_dir)
+
+        # only a stale socket is replaced, never a file that is not a socket
+        not_socket = self.TMP_DIR + '/not_a_socket.sock'
+        lolly_helpers.silent_write_text_file(not_socket, 'data')
+        assert RenderServer(not_socket).start()['error']
+        assert lolly_helpers.silent_read_text_file(not_socket)['contents'] == 'data'
+        lolly_helpers.silent_remove_file(not_socket)
+
+    def test_tcp_server_concurrent_requests(self):
+        self.__create_test_dir_if_not_exists()
+        dest_dir = self.TMP_DIR + '/server_tcp'
+        with RenderServer(('127.0.0.1', 0), max_workers=3) as server:
+            assert server.address[1] != 0
+            client = RenderClient(server.address)
+            results = {}
+
+            def render(n):
+                results[n] = client.render(None, dest_dir + '/' + str(n), lib='git',
+                                           definitions=['LICENSE_TYPE_MIT'], replacements={'PROJECT_NAME': str(n)})
+
+            threads = [threading.Thread(target=render, args=(n,)) for n in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for n in range(8):
+                assert not results[n]['error']
+                readme = lolly_helpers.silent_read_text_file(dest_dir + '/' + str(n) + '/README.md')['contents']
+                assert readme.startswith('\n' + str(n) + '\n')
+                assert lolly_helpers.file_exists(dest_dir + '/' + str(n) + '/LICENSE')
+            assert client.status()['requests'] == 8
+
+            # a form posted by a web page is refused
+            connection = http.client.HTTPConnection(server.address[0], server.address[1], timeout=10)
+            connection.request('POST', '/render', '{"dest": "out"}', {'Content-Type': 'text/plain'})
+            assert connection.getresponse().status == 415
+            connection.close()
+            assert client.status()['requests'] == 8
+        lolly_helpers.silent_remove_dir(dest_dir)
+
+    def test_token(self):
+        with RenderServer(('127.0.0.1', 0), token='secret') as server:
+            assert RenderClient(server.address)._request('POST', '/render', {})['error'] == 'forbidden'
+            assert RenderClient(server.address, token='wrong')._request('POST', '/render', {})['error'] == 'forbidden'
+            result = RenderClient(server.address, token='secret').render(self.TMP_DIR + '/not_exists', 'out')
+            assert result['error'] == 'request'
+            assert server.status()['requests'] == 1
+
+    def test_template_errors_are_reported(self):
+        self.__create_test_dir_if_not_exists()
+        src_dir = self.TMP_DIR + '/server_broken_template'
+        lolly_helpers.silent_create_path(src_dir)
+        lolly_helpers.silent_write_text_file(src_dir + '/lollywiz.txt', "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                                                         "#instructions_begin\n"
+                                                                         "inst 'a.txt' 'a.txt'\n"
+                                                                         "#instructions_end\n")
+        lolly_helpers.silent_write_text_file(src_dir + '/a.txt', 'x [## if A')
+        dest_dir = self.TMP_DIR + '/server_broken_out'
+        server = RenderServer()
+        for n in range(2):  # also when the template source is warm
+            result = server.render({'src': src_dir, 'dest': dest_dir})
+            assert result['error'] == 'syntax'
+        lolly_helpers.silent_write_text_file(src_dir + '/a.txt', 'fixed')
+        assert not server.render({'src': src_dir, 'dest': dest_dir})['error']
+        assert lolly_helpers.silent_read_text_file(dest_dir + '/a.txt')['contents'] == 'fixed'
+        lolly_helpers.silent_remove_dir(src_dir)
+        lolly_helpers.silent_remove_dir(dest_dir)
@@ -0,0 +1,141 @@
+from unittest import TestCase
+import io
+import os
+import ntpath
+import tarfile
+import time
+import zipfile
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_dest import MemoryDestination
+from lollylib.lolly_source import ReadCache, DirSource, ZipSource, TarSource, BundleSource, PackageSource
+from lollylib import lolly_helpers
+
+
+class TestLollySource(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollySource, self).__init__(*args, **kwargs)
+        head, tail = ntpath.split(os.path.realpath(__file__))
+        self.TEST_DATA_DIR = head + '/test_data'
+        self.INSTANTIATION_DIR = self.TEST_DATA_DIR + '/lollywiz/instantiation_tests'
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_test_dir_if_not_exists(self):
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            lolly_helpers.silent_create_path(self.TMP_DIR)
+        if not lolly_helpers.dir_exists(self.TMP_DIR):
+            raise OSError("'TestLollySource' error: can't create temporary directory '" + self.TMP_DIR + "'")
+
+    def __instantiate(self, source):
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'project')
+        wiz.set_src_backend(source)
+        wiz.set_dest_backend(memory)
+        wiz.instantiate()
+        assert not wiz.error
+        verification = lolly_helpers.silent_read_text_file(self.INSTANTIATION_DIR + '/verify1.txt')['contents']
+        assert memory.read_text_file('project/default_class.hpp') == {'contents': verification, 'error': ''}
+
+    def test_dir_source(self):
+        cache = ReadCache()
+        source = DirSource(self.INSTANTIATION_DIR, cache=cache)
+        assert source.get_item_type('lollywiz.txt') == {'exists': True, 'type': 'file'}
+        assert source.get_item_type('not_exists.txt')['exists'] is False
+        expected = lolly_helpers.silent_read_text_file(self.INSTANTIATION_DIR + '/template0.hpp')
+        assert source.read_text_file('template0.hpp') == expected
+        assert source.read_text_file('./template0.hpp') == expected
+        assert cache.hits == 1 and cache.misses == 1
+        assert source.read_text_file('not_exists.txt')['error']
+        assert source.glob('*.hpp') == {'base': '', 'files': ['template0.hpp', 'template1.hpp']}
+        assert source.glob('**/verify?.txt')['files'] == ['verify1.txt', 'verify2.txt']
+        self.__instantiate(source)
+
+    def test_dir_source_racy_files(self):
+        self.__create_test_dir_if_not_exists()
+        src_dir = self.TMP_DIR + '/racy_source'
+        lolly_helpers.silent_create_path(src_dir)
+        filename = src_dir + '/a.txt'
+        cache = ReadCache()
+        source = DirSource(src_dir, cache=cache)
+
+        def rewrite(contents, mtime_ns):
+            lolly_helpers.silent_write_text_file(filename, contents)
+            os.utime(filename, ns=(mtime_ns, mtime_ns))
+
+        # a file modified just now may change again within the mtime resolution, it's not cached
+        now = time.time_ns()
+        rewrite('one', now)
+        assert source.read_text_file('a.txt')['contents'] == 'one'
+        rewrite('two', now)
+        assert source.read_text_file('a.txt')['contents'] == 'two'
+        assert cache.hits == 0
+
+        # older files are cached and validated by size and mtime
+        old = now - 10 * 10 ** 9
+        rewrite('one', old)
+        assert source.read_text_file('a.txt')['contents'] == 'one'
+        assert source.read_text_file('a.txt')['contents'] == 'one'
+        assert cache.hits == 1
+        lolly_helpers.silent_remove_dir(src_dir)
+
+    def test_zip_source(self):
+        stream = io.BytesIO()
+        with zipfile.ZipFile(stream, 'w') as z:
+            for name in ('lollywiz.txt', 'template0.hpp'):
+                z.write(self.INSTANTIATION_DIR + '/' + name, 'templates/' + name)
+        source = ZipSource(stream, 'templates')
+        assert source.index() == {'lollywiz.txt': 'file', 'template0.hpp': 'file'}
+        assert source.describe('template0.hpp').endswith(':templates/template0.hpp')
+        self.__instantiate(source)
+        source.close()
+
+    def test_tar_source(self):
+        self.__create_test_dir_if_not_exists()
+        arch = self.TMP_DIR + '/source_test.tar.gz'
+        with tarfile.open(arch, 'w:gz') as tar:
+            tar.add(self.INSTANTIATION_DIR, 'templates')
+        source = TarSource(arch, 'templates')
+        assert source.get_item_type('verify1.txt')['type'] == 'file'
+        self.__instantiate(source)
+        source.close()
+        lolly_helpers.silent_remove_file(arch)
+
+    def test_bundle_source(self):
+        source = BundleSource({'lollywiz.txt': "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                               "#instructions_begin\n"
+                                               "inst 'a.txt' 'a.txt'\n"
+                                               "copy 'data' 'data'\n"
+                                               "#instructions_end\n",
+                               'a.txt': 'Hello, [$$NAME$$]!',
+                               'data/sub/b.bin': b'\x00\x01'})
+        assert source.walk('data') == [('sub', 'dir'), ('sub/b.bin', 'file')]
+        assert source.glob('data/**/*.bin') == {'base': 'data', 'files': ['sub/b.bin']}
+        assert source.glob('data/*.bin')['files'] == []
+        assert source.glob('*/sub/*')['files'] == ['data/sub/b.bin']
+        assert source.glob('missing/**')['files'] == []
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'out')
+        wiz.set_src_backend(source)
+        wiz.set_dest_backend(memory)
+        wiz.set_replacements({'NAME': 'World'})
+        wiz.instantiate()
+        assert not wiz.error
+        assert memory.files() == {'out/a.txt': b'Hello, World!', 'out/data/sub/b.bin': b'\x00\x01'}
+
+    def test_missing_instruction_file(self):
+        wiz = LollyWiz(None, 'out')
+        wiz.set_src_backend(BundleSource({'a.txt': 'A'}, name='empty'))
+        assert wiz.error == 'file'
+
+    def test_package_source(self):
+        source = PackageSource('lollylib', 'assets/lollywiz_templates/git')
+        assert source.get_item_type('gitignore.lwt')['type'] == 'file'
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'repo')
+        wiz.set_src_from_lib('git')
+        wiz.set_dest_backend(memory)
+        wiz.instantiate()
+        assert not wiz.error
+        assert memory.get_item_type('repo')['type'] == 'dir'
@@ -0,0 +1,179 @@
+from unittest import TestCase, skipUnless
+import sys
+import threading
+from pathlib import Path
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_dest import MemoryDestination
+from lollylib.lolly_source import BundleSource
+from lollylib.lolly_watch import TemplateWatcher
+from lollylib import lolly_helpers
+from lollylib import lolly_render
+
+
+class TestLollyWatch(TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestLollyWatch, self).__init__(*args, **kwargs)
+        # get name of tmp dir for tests in user's home dir
+        home = str(Path.home())
+        self.TMP_DIR = home + '/~tmp_test_lollylib'
+
+    def __create_template(self, name):
+        src_dir = self.TMP_DIR + '/' + name
+        lolly_helpers.silent_remove_dir(src_dir)
+        lolly_helpers.silent_create_path(src_dir + '/data')
+        lolly_helpers.silent_write_text_file(src_dir + '/lollywiz.txt',
+                                             "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                             "#instructions_begin\n"
+                                             "inst 'a.txt' 'a.txt'\n"
+                                             "inst 'b.txt' 'b.txt'\n"
+                                             "copy 'data' 'data'\n"
+                                             "remove 'data/tmp.txt'\n"
+                                             "#instructions_end\n")
+        lolly_helpers.silent_write_text_file(src_dir + '/a.txt', 'A [$$NAME$$]')
+        lolly_helpers.silent_write_text_file(src_dir + '/b.txt', 'B [$$NAME$$]')
+        lolly_helpers.silent_write_text_file(src_dir + '/data/c.txt', 'C')
+        lolly_helpers.silent_write_text_file(src_dir + '/data/tmp.txt', 'removed')
+        return src_dir
+
+    def __check_watcher(self, backend):
+        src_dir = self.__create_template('watch_' + backend)
+        memory = MemoryDestination()
+        wiz = LollyWiz(src_dir, 'out')
+        wiz.set_dest_backend(memory)
+        wiz.set_replacements({'NAME': 'World'})
+        watcher = TemplateWatcher(wiz, debounce=0.05, backend=backend, poll_interval=0.01)
+        started = watcher.start()
+        assert not started['error'] and started['full']
+        assert watcher.backend_name == backend
+        assert memory.files() == {'out/a.txt': b'A World', 'out/b.txt': b'B World', 'out/data/c.txt': b'C'}
+        compiled_count = watcher._source.compiled_count
+
+        # nothing changed
+        assert watcher.poll(0.05) == {'changed': [], 'rendered': [], 'full': False, 'error': ''}
+
+        # only instruction of the changed template is executed, other templates are not compiled again
+        lolly_helpers.silent_write_text_file(src_dir + '/a.txt', 'AA [$$NAME$$]')
+        result = watcher.poll(5)
+        assert not result['error'] and not result['full']
+        assert result['changed'] == ['a.txt']
+        assert [i['args'][0] for i in result['rendered']] == ['a.txt']
+        assert memory.read_text_file('out/a.txt')['contents'] == 'AA World'
+        assert watcher._source.compiled_count == compiled_count + 1
+
+        # copied directory is copied again, later 'remove' is applied again
+        lolly_helpers.silent_create_path(src_dir + '/data/new')
+        lolly_helpers.silent_write_text_file(src_dir + '/data/new/d.txt', 'D')
+        result = watcher.poll(5)
+        assert not result['error'] and not result['full']
+        assert [i['cmd'] for i in result['rendered']] == ['copy', 'remove']
+        assert memory.read_text_file('out/data/new/d.txt')['contents'] == 'D'
+        assert not memory.get_item_type('out/data/tmp.txt')['exists']
+
+        # changed instruction file instantiates whole template
+        lolly_helpers.silent_write_text_file(src_dir + '/lollywiz.txt',
+                                             "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                             "#instructions_begin\n"
+                                             "inst 'b.txt' 'renamed.txt'\n"
+                                             "#instructions_end\n")
+        result = watcher.poll(5)
+        assert not result['error'] and result['full']
+        assert memory.read_text_file('out/renamed.txt')['contents'] == 'B World'
+
+        # errors are reported and watching continues
+        lolly_helpers.silent_write_text_file(src_dir + '/b.txt', '[## if X ##] no endif')
+        result = watcher.poll(5)
+        assert result['error'] == 'syntax'
+        lolly_helpers.silent_write_text_file(src_dir + '/b.txt', 'fixed')
+        result = watcher.poll(5)
+        assert not result['error']
+        assert memory.read_text_file('out/renamed.txt')['contents'] == 'fixed'
+        watcher.close()
+        lolly_helpers.silent_remove_dir(src_dir)
+
+    def test_polling_watcher(self):
+        self.__check_watcher('poll')
+
+    @skipUnless(sys.platform.startswith('linux'), 'inotify is available on Linux only')
+    def test_inotify_watcher(self):
+        self.__check_watcher('inotify')
+
+    def test_run_and_stop(self):
+        src_dir = self.__create_template('watch_run')
+        memory = MemoryDestination()
+        wiz = LollyWiz(src_dir, 'out')
+        wiz.set_dest_backend(memory)
+        rounds = []
+        changed = threading.Event()
+
+        def on_round(result):
+            rounds.append(result)
+            if result['changed']:
+                changed.set()
+
+        watcher = TemplateWatcher(wiz, debounce=0.01, poll_interval=0.01)
+        thread = threading.Thread(target=watcher.run, args=(on_round,))
+        thread.start()
+        while not rounds:
+            changed.wait(0.01)
+        lolly_helpers.silent_write_text_file(src_dir + '/b.txt', 'B2')
+        assert changed.wait(5)
+        watcher.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert rounds[0]['full'] and rounds[-1]['changed'] == ['b.txt']
+        assert memory.read_text_file('out/b.txt')['contents'] == 'B2'
+        lolly_helpers.silent_remove_dir(src_dir)
+
+    def test_inst_each_items_change(self):
+        src_dir = self.__create_template('watch_each')
+        lolly_helpers.silent_write_text_file(src_dir + '/lollywiz.txt',
+                                             "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                             "#instructions_begin\n"
+                                             "inst 'a.txt' 'a.txt'\n"
+                                             "inst_each 'b.txt' 'each/[$$NAME$$].txt' 'data/items.json'\n"
+                                             "remove 'each/old.txt'\n"
+                                             "#instructions_end\n")
+        lolly_helpers.silent_write_text_file(src_dir + '/data/items.json', '[{"NAME": "one"}]')
+        memory = MemoryDestination()
+        wiz = LollyWiz(src_dir, 'out')
+        wiz.set_dest_backend(memory)
+        watcher = TemplateWatcher(wiz, backend='poll', poll_interval=0.01)
+        assert not watcher.start()['error']
+        assert memory.read_text_file('out/each/one.txt')['contents'] == 'B one'
+        lolly_helpers.silent_write_text_file(src_dir + '/data/items.json', '[{"NAME": "one"}, {"NAME": "two"}]')
+        result = watcher.poll(5)
+        assert not result['error'] and not result['full']
+        assert [i['cmd'] for i in result['rendered']] == ['inst_each', 'remove']
+        assert memory.read_text_file('out/each/two.txt')['contents'] == 'B two'
+        watcher.close()
+        lolly_helpers.silent_remove_dir(src_dir)
+
+    def test_lazy_values_with_render_backend(self):
+        src_dir = self.__create_template('watch_lazy')
+        memory = MemoryDestination()
+
+        class Backend:
+            def render_batch(self, jobs):
+                return [(job[0], lolly_render.render_compiled(job[1], job[2], job[3]), '') for job in jobs]
+
+        wiz = LollyWiz(src_dir, 'out')
+        wiz.set_dest_backend(memory)
+        wiz.set_render_backend(Backend())
+        wiz.set_replacements({'NAME': lambda: 'Lazy', 'OTHER': lambda: 'Other'})
+        watcher = TemplateWatcher(wiz, backend='poll', poll_interval=0.01)
+        assert not watcher.start()['error']
+        assert memory.read_text_file('out/a.txt')['contents'] == 'A Lazy'
+        # keys used by templates are indexed again in every round
+        lolly_helpers.silent_write_text_file(src_dir + '/a.txt', 'A [$$OTHER$$]')
+        result = watcher.poll(5)
+        assert not result['error'] and not result['full']
+        assert memory.read_text_file('out/a.txt')['contents'] == 'A Other'
+        assert wiz._key_index == {}
+        watcher.close()
+        lolly_helpers.silent_remove_dir(src_dir)
+
+    def test_requires_local_dir(self):
+        wiz = LollyWiz(None, 'out')
+        wiz.set_src_backend(BundleSource({'lollywiz.txt': 'LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n'}))
+        assert TemplateWatcher(wiz).start()['error']
+        assert TemplateWatcher(wiz, backend='unknown').start()['error']
@@ -1,9 +1,15 @@
 from unittest import TestCase
+import asyncio
 import os
 import ntpath
+import subprocess
+import sys
 from pathlib import Path
-from lolly_wiz import LollyWiz
-import lolly_helpers
+from lollylib.lolly_wiz import LollyWiz
+from lollylib.lolly_dest import MemoryDestination
+from lollylib.lolly_source import BundleSource
+from lollylib import lolly_render
+from lollylib import lolly_helpers
 
 
 class TestLollyWiz(TestCase):
@@ -45,11 +51,27 @@ class TestLollyWiz(TestCase):
         data = "/*test1*/data /*test2*/"
         assert wiz._remove_comments(data) == 'data '
 
+        data = "NAME = x/*test*/"
+        assert wiz._remove_comments(data) == 'NAME = x'
+
+        data = "inst a.lwt b.lwt/*test*/"
+        assert wiz._remove_comments(data) == 'inst a.lwt b.lwt'
+
+        # comments do not start inside quoted values, so patterns with '/*' are quoted
+        data = "inst 'src/**/*.lwt' \"a /*b*/\" /*test*/"
+        assert wiz._remove_comments(data) == "inst 'src/**/*.lwt' \"a /*b*/\" "
+
         # sad path
         data = "/*test"
         assert wiz._remove_comments(data) == ''
         assert wiz.error == 'syntax'
 
+        wiz.error = ''
+        data = "inst src/*.lwt include/ /*test*/"
+        assert wiz._remove_comments(data) == ''
+        assert wiz.error == 'syntax'
+
+        wiz.error = ''
         data = "/*test /*data*/"
         assert wiz._remove_comments(data) == ''
         assert wiz.error == 'syntax'
@@ -197,6 +219,16 @@ class TestLollyWiz(TestCase):
         # assert year placeholder is replaced correctly
         assert wiz._instr_file_data[0][0] == '2' and wiz._instr_file_data[0][1] == '0'
 
+        # all replacements are derived from one moment of injected clock
+        wiz = LollyWiz(src_dir, dest_dir)
+        wiz._instr_file_full_path = 'dummy_test_data (expected error)'
+        wiz.set_clock(lolly_helpers.FixedClock('1999-12-31T23:59:59.5'))
+        wiz._is_instr_file_read = True
+        wiz._instr_file_data = "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n" \
+                               "[$$__YEAR__$$] [$$__DATE__$$] [$$__TIME__$$] [$$__DATETIME__$$]"
+        wiz._parse_instructions()
+        assert wiz._instr_file_data == ['1999 1999-12-31 23:59:59 UTC+00:00 1999-12-31 23:59:59.500000+00:00']
+
     def test_execute_copy(self):
         self.__create_test_dir_if_not_exists()
         src_dir = self.TEST_DATA_DIR + '/lollywiz/generic_tests'
@@ -278,6 +310,237 @@ class TestLollyWiz(TestCase):
         assert not verification['error']
         assert result['contents'] == verification['contents']
 
+    def test_instantiate_async(self):
+        self.__create_test_dir_if_not_exists()
+        src_dir = self.TEST_DATA_DIR + '/lollywiz/instantiation_tests'
+        verification = lolly_helpers.silent_read_text_file(src_dir + '/verify1.txt')
+        dest_dirs = [self.TMP_DIR + '/async' + str(n) for n in range(4)]
+        wizards = [LollyWiz(src_dir, dest_dir) for dest_dir in dest_dirs]
+
+        # several instantiations interleave on the same event loop
+        async def instantiate_all():
+            await asyncio.gather(*[wiz.instantiate_async() for wiz in wizards])
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(instantiate_all())
+        finally:
+            loop.close()
+        for wiz, dest_dir in zip(wizards, dest_dirs):
+            assert not wiz.error
+            result = lolly_helpers.silent_read_text_file(dest_dir + '/default_class.hpp')
+            assert not result['error']
+            assert result['contents'] == verification['contents']
+            lolly_helpers.silent_remove_dir(dest_dir)
+
+        # cancellation
+        wiz = LollyWiz(src_dir, self.TMP_DIR + '/async_cancelled')
+
+        async def cancel_instantiation():
+            task = asyncio.ensure_future(wiz.instantiate_async())
+            await asyncio.sleep(0)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                return True
+            return False
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(cancel_instantiation())
+        finally:
+            loop.close()
+        assert not lolly_helpers.file_exists(self.TMP_DIR + '/async_cancelled/default_class.hpp')
+
+    def test_instantiate_patterns(self):
+        files = {'lollywiz.txt': "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                 "#instructions_begin\n"
+                                 "inst 'src/**/*.lwt' include/ /* headers */\n"
+                                 "inst 'src/*.txt' 'docs'\n"
+                                 "copy 'assets/*/*.bin' 'img'\n"
+                                 "#instructions_end\n",
+                 'src/a.hpp.lwt': '[## if A ##]A[## else ##]B[## endif ##] [$$NAME$$]',
+                 'src/sub/b.hpp.lwt': '[$$NAME$$]',
+                 'src/c.txt': 'C',
+                 'assets/x/1.bin': b'\x01', 'assets/x/y/2.bin': b'\x02', 'assets/3.bin': b'\x03'}
+        batches = []
+
+        class Backend:
+            def render_batch(self, jobs):
+                batches.append(len(jobs))
+                return [(job[0], lolly_render.render_compiled(job[1], job[2], job[3]), '') for job in jobs]
+
+        for backend in (None, Backend()):
+            memory = MemoryDestination()
+            wiz = LollyWiz(None, 'out', ['A'], {'NAME': 'N'})
+            wiz.set_src_backend(BundleSource(files))
+            wiz.set_dest_backend(memory)
+            wiz.set_render_backend(backend)
+            wiz.instantiate()
+            assert not wiz.error
+            assert memory.files() == {'out/include/a.hpp': b'A N', 'out/include/sub/b.hpp': b'N',
+                                      'out/docs/c.txt': b'C', 'out/img/x/1.bin': b'\x01'}
+        assert batches == [2, 1]
+
+        # local directory source
+        self.__create_test_dir_if_not_exists()
+        src_dir = self.TMP_DIR + '/patterns'
+        for name, contents in files.items():
+            lolly_helpers.silent_create_path(lolly_helpers.path_base_and_leaf(src_dir + '/' + name)['base'])
+            if isinstance(contents, str):
+                lolly_helpers.silent_write_text_file(src_dir + '/' + name, contents)
+            else:
+                lolly_helpers.silent_write_binary_file(src_dir + '/' + name, contents)
+        wiz = LollyWiz(src_dir, self.TMP_DIR + '/patterns_out', ['A'], {'NAME': 'N'})
+        wiz.instantiate()
+        assert not wiz.error
+        assert lolly_helpers.silent_read_text_file(self.TMP_DIR + '/patterns_out/include/sub/b.hpp')['contents'] == 'N'
+        assert lolly_helpers.file_exists(self.TMP_DIR + '/patterns_out/img/x/1.bin')
+        assert not lolly_helpers.file_exists(self.TMP_DIR + '/patterns_out/img/x/y/2.bin')
+
+    def test_instantiate_includes(self):
+        files = {'lollywiz.txt': "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                 "#instructions_begin\n"
+                                 "inst 'a.hpp' 'a.hpp'\n"
+                                 "inst 'b.hpp' 'b.hpp'\n"
+                                 "#instructions_end\n",
+                 'a.hpp': '[## include partials/header.txt ##]\nA[## if B ##] [## include \'partials/b.txt\' ##]'
+                          '[## endif ##]',
+                 'b.hpp': '[## include partials/header.txt ##]\nB',
+                 'partials/header.txt': '// [$$NAME$$][## if B ##] b[## endif ##][## include partials/footer.txt ##]',
+                 'partials/footer.txt': '.',
+                 'partials/b.txt': '[$$NAME$$]'}
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'out', ['B'], {'NAME': 'N'})
+        wiz.set_src_backend(BundleSource(files))
+        wiz.set_dest_backend(memory)
+        wiz.instantiate()
+        assert not wiz.error
+        # like other directives, include removes the line break after it
+        assert memory.files() == {'out/a.hpp': b'// N b.A N', 'out/b.hpp': b'// N b.B'}
+        assert wiz._partial_files == {'partials/header.txt', 'partials/footer.txt', 'partials/b.txt'}
+        assert wiz._partials == {}
+
+        # sad path
+        for partial, error in (("[## include 'a.hpp' ##]", 'syntax'), ('[## include x y ##]', 'syntax'),
+                               ('[## include not_exists.txt ##]', 'file')):
+            broken = dict(files)
+            broken['partials/b.txt'] = partial
+            wiz = LollyWiz(None, 'out', ['B'], {'NAME': 'N'})
+            wiz.set_src_backend(BundleSource(broken))
+            wiz.set_dest_backend(MemoryDestination())
+            wiz.instantiate()
+            assert wiz.error == error
+
+    def test_instantiate_each(self):
+        files = {'lollywiz.txt': "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                 "#instructions_begin\n"
+                                 "inst_each 'module.hpp' 'modules/[$$MODULE$$].hpp' 'modules.json'\n"
+                                 "inst_each 'module.hpp' 'services/[$$MODULE$$]/api.hpp' SERVICES\n"
+                                 "#instructions_end\n",
+                 'module.hpp': '[## if A ##]a [## endif ##][$$MODULE$$] [$$NAME$$]',
+                 'modules.json': '[{"MODULE": "core"}, {"MODULE": "net", "NAME": "Net"}]'}
+        batches = []
+
+        class Backend:
+            def render_batch(self, jobs):
+                batches.append(len(jobs))
+                return [(job[0], lolly_render.render_compiled(job[1], job[2], job[3]), '') for job in jobs]
+
+        for backend in (None, Backend()):
+            memory = MemoryDestination()
+            wiz = LollyWiz(None, 'out', ['A'], {'NAME': 'N', 'SERVICES': '[{"MODULE": "auth"}]'})
+            wiz.set_src_backend(BundleSource(files))
+            wiz.set_dest_backend(memory)
+            wiz.set_render_backend(backend)
+            wiz.instantiate()
+            assert not wiz.error
+            assert memory.files() == {'out/modules/core.hpp': b'a core N', 'out/modules/net.hpp': b'a net Net',
+                                      'out/services/auth/api.hpp': b'a auth N'}
+        assert batches == [2, 1]
+
+        # items may be a lazy value
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'out', [], {'NAME': 'N', 'SERVICES': lambda: '[{"MODULE": "lazy"}]'})
+        wiz.set_src_backend(BundleSource(files))
+        wiz.set_dest_backend(memory)
+        wiz.instantiate()
+        assert not wiz.error and memory.files()['out/services/lazy/api.hpp'] == b'lazy N'
+
+        # item keys that are replacements too are replaced with item values in destination names
+        memory = MemoryDestination()
+        wiz = LollyWiz(None, 'out', [], {'NAME': 'N', 'MODULE': 'global', 'SERVICES': '[{"MODULE": "auth"}]'})
+        wiz.set_src_backend(BundleSource(files))
+        wiz.set_dest_backend(memory)
+        wiz.instantiate()
+        assert not wiz.error
+        assert sorted(memory.files()) == ['out/modules/core.hpp', 'out/modules/net.hpp', 'out/services/auth/api.hpp']
+
+        # sad path
+        for items, error in (('[{"MODULE": "x"}, {"MODULE": "x"}]', 'procedural'), ('{"MODULE": "x"}', 'syntax'),
+                             (lambda: None, 'syntax'),
+                             ('[{"MODULE": 1}]', 'syntax'), ('not json', 'syntax')):
+            wiz = LollyWiz(None, 'out', [], {'SERVICES': items})
+            wiz.set_src_backend(BundleSource(files))
+            wiz.set_dest_backend(MemoryDestination())
+            wiz.instantiate()
+            assert wiz.error == error
+        wiz = LollyWiz(None, 'out')
+        wiz.set_src_backend(BundleSource(files))
+        wiz.set_dest_backend(MemoryDestination())
+        wiz.instantiate()
+        assert wiz.error == 'file'  # neither replacement SERVICES nor file 'SERVICES' exist
+
+    def test_lazy_replacements(self):
+        files = {'lollywiz.txt': "LOLLYWIZ_TEXTFILE_VERSION = 0.1.0\n"
+                                 "#instructions_begin\n"
+                                 "inst 'a.txt' '[$$DIR$$]/a.txt'\n"
+                                 "inst 'b.txt' '[$$DIR$$]/b.txt'\n"
+                                 "#instructions_end\n",
+                 'a.txt': '[$$CHECKSUM$$] [$$CHECKSUM$$]',
+                 'b.txt': '[$$CHECKSUM$$] [$$NAME$$]'}
+        calls = []
+
+        def provider(value):
+            return lambda: calls.append(value) or value
+
+        class CountingClock(lolly_helpers.FixedClock):
+            snapshots = 0
+
+            def snapshot(self):
+                CountingClock.snapshots += 1
+                return super(CountingClock, self).snapshot()
+
+        class Backend:
+            def render_batch(self, jobs):
+                for job in jobs:
+                    assert all(isinstance(value, str) for value in job[3].values())
+                    assert '[$$UNUSED$$]' not in job[3] and '[$$__DATE__$$]' not in job[3]
+                return [(job[0], lolly_render.render_compiled(job[1], job[2], job[3]), '') for job in jobs]
+
+        for backend in (None, Backend()):
+            calls[:] = []
+            memory = MemoryDestination()
+            wiz = LollyWiz(None, None)
+            wiz.set_src_backend(BundleSource(files))
+            wiz.set_dest('.')
+            wiz.set_dest_backend(memory)
+            wiz.set_replacements({'DIR': provider('out'), 'CHECKSUM': provider('abc'), 'NAME': 'N',
+                                  'UNUSED': provider('unused')})
+            wiz.set_clock(CountingClock('2020-01-01T00:00:00'))
+            wiz.set_render_backend(backend)
+            wiz.instantiate()
+            assert not wiz.error
+            assert memory.files() == {'out/a.txt': b'abc abc', 'out/b.txt': b'abc N'}
+            # each value is computed once, unused values and common replacements are not computed at all
+            assert calls == ['out', 'abc']
+            assert CountingClock.snapshots == 0
+
+            # values are computed again for every instantiation
+            wiz.instantiate()
+            assert calls == ['out', 'abc', 'abc']
+
     # def test_set_src_from_lib(self):
     #     self.__create_test_dir_if_not_exists()
     #     wiz = LollyWiz()
@@ -287,6 +550,16 @@ class TestLollyWiz(TestCase):
     #     wiz.set_replacements({'PROJECT_NAME': 'Git Project'})
     #     wiz.instantiate()
 
+    def test_import_is_lazy(self):
+        # heavy modules must be imported on first use only, see benchmarks/import_time.py
+        heavy = ['asyncio', 'subprocess', 'http.client', 'urllib.request', 'tarfile', 'zipfile', 'datetime',
+                 'concurrent.futures', 'semver', 'json', 'lollylib.lolly_archive']
+        code = 'import sys; import lollylib.lolly_wiz; print(" ".join(m for m in ' + repr(heavy) + \
+               ' if m in sys.modules))'
+        package_parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=package_parent_dir)
+        assert output.decode('utf-8').split() == []
+
     def test_zzz_cleanup(self):
         # Tests are executed in alphabetical order, 'zzz' makes it the last in the list
         self.__remove_test_dir()
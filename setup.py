@@ -28,5 +28,8 @@ setup(name='lollylib',
           'markdown',
           'semver'
       ],
+      entry_points={
+          'console_scripts': ['lollywiz=lollylib.lolly_cli:main'],
+      },
       include_package_data=True,
       zip_safe=False)